@@ -25,13 +25,15 @@ Top-hat baseline corrector
 import copy
 import numpy
 
-from scipy import ndimage
-
 from pyms.Utils.Error import error
-from pyms.GCMS.Function import is_ionchromatogram, ic_window_points
+from pyms.GCMS.Class import IntensityMatrix
+from pyms.GCMS.Function import is_ionchromatogram, ic_window_points, \
+    map_ic_columns
 
 # default structural element as a fraction of total number of points
 _STRUCT_ELM_FRAC = 0.2
+# ion chromatograms corrected together by tophat_ia()
+_BLOCK_COLUMNS = 32
 
 def tophat(ic, struct=None):
 
@@ -53,7 +55,7 @@ def tophat(ic, struct=None):
     if not is_ionchromatogram(ic):
         error("'ic' not an IonChromatogram object")
     else:
-        ia = copy.deepcopy(ic.get_intensity_array())
+        ia = ic.get_intensity_array()
 
     if struct == None:
         struct_pts = int(round(ia.size * _STRUCT_ELM_FRAC))
@@ -62,25 +64,28 @@ def tophat(ic, struct=None):
 
 #    print " -> Top-hat: structural element is %d point(s)" % ( struct_pts )
 
-    str_el = numpy.repeat([1], struct_pts)
-    ia = ndimage.white_tophat(ia, None, str_el)
+    ia = tophat_ia(ia, struct_pts)
 
     ic_bc = copy.deepcopy(ic)
     ic_bc.set_intensity_array(ia)
 
     return ic_bc
 
-def tophat_im(im, struct=None):
+def tophat_im(im, struct=None, processes=None):
     
     """
     @summary: Top-hat baseline correction on Intensity Matrix
 
-              Wraps around the TopHat function above
+              All ion chromatograms are corrected by the same call of
+              tophat_ia(), or shared between processes
 
     @param im: The input Intensity Matrix
     @type im: pyms.GCMS.Class.IntenstiyMatrix
     @param struct: Top-hat structural element as time string
     @type struct: StringType
+    @param processes: The number of processes to correct the ion
+        chromatograms in parallel. If None, they are corrected serially
+    @type processes: IntType
 
     @return: Top-hat corrected Intenstity Matrix
     @rtype: pyms.IO.Class.IntensityMatrix
@@ -89,12 +94,104 @@ def tophat_im(im, struct=None):
     """
     
     n_scan, n_mz = im.get_size()
-    
-    im_smooth = copy.deepcopy(im)
-    
-    for ii in range(n_mz):
-        ic = im_smooth.get_ic_at_index(ii)
-        ic_smooth = tophat(ic, struct)
-        im_smooth.set_ic_at_index(ii, ic_smooth)
-        
-    return im_smooth
+
+    if struct == None:
+        struct_pts = int(round(n_scan * _STRUCT_ELM_FRAC))
+    else:
+        struct_pts = ic_window_points(im.get_ic_at_index(0), struct)
+
+    if processes == None:
+        ia = tophat_ia(im.intensity_array, struct_pts)
+        return IntensityMatrix(im.get_time_list(), im.get_mass_list(), ia)
+    else:
+        return map_ic_columns(im, tophat_ia, (struct_pts,), processes)
+
+def tophat_ia(ia, struct_pts):
+
+    """
+    @summary: Top-hat baseline correction on an intensity array
+
+        A two dimensional array (scan by m/z) is corrected along the
+        time axis, as a block of ion chromatograms. The result is that
+        of scipy.ndimage.white_tophat() with a flat structural element,
+        but the running minima and maxima are found by the van Herk /
+        Gil-Werman algorithm, so the cost does not depend on the size
+        of the structural element.
+
+    @param ia: The input intensity array
+    @type ia: numpy.ndarray
+    @param struct_pts: Top-hat structural element in points
+    @type struct_pts: IntType
+
+    @return: Top-hat corrected intensity array
+    @rtype: numpy.ndarray
+    """
+
+    if struct_pts < 1:
+        error("structural element must be at least one point")
+
+    # a few ion chromatograms at a time stay in cache
+    if ia.ndim > 1 and ia.shape[1] > _BLOCK_COLUMNS:
+        ia_bc = numpy.empty(ia.shape, dtype='d')
+        for lo in range(0, ia.shape[1], _BLOCK_COLUMNS):
+            hi = lo + _BLOCK_COLUMNS
+            ia_bc[:,lo:hi] = tophat_ia(ia[:,lo:hi], struct_pts)
+        return ia_bc
+
+    # opening: erosion followed by dilation. As in scipy.ndimage, an
+    # element of even size is centred to the right for erosion and to
+    # the left for dilation
+    opened = __running_extreme(ia, struct_pts, struct_pts/2, numpy.minimum)
+    opened = __running_extreme(opened, struct_pts, struct_pts-1-struct_pts/2,
+        numpy.maximum)
+
+    return numpy.subtract(ia, opened, out=opened)
+
+def __running_extreme(ia, width, before, extreme):
+
+    """
+    @summary: Running minimum or maximum along the time axis
+
+        Uses the van Herk / Gil-Werman algorithm: the array is cut into
+        blocks of 'width' points, and each window is covered by the end
+        of one block and the start of the next, whose running extremes
+        are found by cumulative minima or maxima.
+
+    @param ia: Intensity array (1-D, or scan by m/z)
+    @type ia: numpy.ndarray
+    @param width: The window width in points
+    @type width: IntType
+    @param before: The number of points in the window before each point
+    @type before: IntType
+    @param extreme: numpy.minimum or numpy.maximum
+    @type extreme: numpy.ufunc
+
+    @return: The extreme of the window around each point
+    @rtype: numpy.ndarray
+    """
+
+    ia = numpy.asarray(ia, dtype='d')
+    n = len(ia)
+
+    # extend beyond the ends by reflection, as scipy.ndimage 'reflect'
+    pad = [(before, width-1-before)] + [(0, 0)]*(ia.ndim-1)
+    padded = numpy.pad(ia, pad, 'symmetric')
+
+    # whole blocks, filled out with a value that never wins
+    num_blocks = -(-len(padded)/width)
+    if extreme is numpy.minimum:
+        fill = numpy.inf
+    else:
+        fill = -numpy.inf
+    blocks = numpy.empty((num_blocks*width,) + ia.shape[1:], dtype='d')
+    blocks[:len(padded)] = padded
+    blocks[len(padded):] = fill
+    blocks = blocks.reshape((num_blocks, width) + ia.shape[1:])
+
+    # extremes from the start of each block, and to the end of it
+    forward = extreme.accumulate(blocks, axis=1)
+    backward = extreme.accumulate(blocks[:,::-1], axis=1)[:,::-1]
+    forward = forward.reshape((num_blocks*width,) + ia.shape[1:])
+    backward = backward.reshape((num_blocks*width,) + ia.shape[1:])
+
+    return extreme(backward[:n], forward[width-1:width-1+n])
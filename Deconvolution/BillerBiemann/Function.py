@@ -28,8 +28,13 @@ import copy
 
 from pyms.Utils.Error import error
 from pyms.Utils.Utils import is_list, is_number, is_int
-from pyms.GCMS.Class import IonChromatogram, MassSpectrum
+from pyms.GCMS.Class import IntensityMatrix, IonChromatogram, MassSpectrum, \
+    SparseMassSpectrum
+from pyms.GCMS.Function import ic_window_points
 from pyms.Peak.Class import Peak
+from pyms.Peak.Function import batch_peak_sum_area
+from pyms.Noise.SavitzkyGolay import savitzky_golay_ia
+from pyms.Baseline.TopHat import tophat_ia, _STRUCT_ELM_FRAC
 
 # If psyco is installed, use it to speed up running time
 try:
@@ -45,7 +50,7 @@ except:
 # 3) sum ions belonging to each maxima scan
 #######################
 
-def BillerBiemann(im, points=3, scans=1):
+def BillerBiemann(im, points=3, scans=1, sparse=False):
 
     """
     @summary: BillerBiemann Deconvolution
@@ -59,6 +64,10 @@ def BillerBiemann(im, points=3, scans=1):
     @param scans: To compensate for spectra skewing,
         peaks from 'scans' scans are combined (Default 1).
     @type scans: IntType
+    @param sparse: Whether the peak mass spectra hold only their nonzero
+        intensities (pyms.GCMS.Class.SparseMassSpectrum), rather than
+        whole rows of the maxima matrix (Default False)
+    @type sparse: BooleanType
 
     @return: List of Peak objects
     @rtype: ListType
@@ -66,22 +75,200 @@ def BillerBiemann(im, points=3, scans=1):
     @author: Andrew Isaac
     """
 
-    rt_list = im.get_time_list()
-    mass_list = im.get_mass_list()
-    peak_list = []
     maxima_im = get_maxima_matrix(im, points, scans)
-    numrows = len(maxima_im)
-    for row in range(numrows):
-        if sum(maxima_im[row]) > 0:
+
+    return __maxima_peaks(maxima_im, im.get_time_list(), im.get_mass_list(),
+        sparse)
+
+def BillerBiemann_pipeline(im, window=7, degree=2, struct=None, points=3,
+        scans=1, percent=2, n=None, cutoff=None, max_bound=0, sparse=False,
+        in_place=False, block_size=64):
+
+    """
+    @summary: Detects peaks in an intensity matrix in a single pass
+
+        Runs the usual sequence of Savitzky-Golay smoothing, top-hat
+        baseline correction, Biller and Biemann deconvolution, ion
+        thresholds and peak area calculation. Smoothing, baseline
+        correction and the search for maxima are done together on
+        blocks of 'block_size' ion chromatograms, so no intermediate
+        matrices are built.
+
+    @param im: An IntensityMatrix object
+    @type im: pyms.GCMS.Class.IntensityMatrix
+    @param window: The Savitzky-Golay window selection parameter, in
+        points or as a time string
+    @type window: IntType or StringType
+    @param degree: degree of the Savitzky-Golay fitting polynomial
+    @type degree: IntType
+    @param struct: Top-hat structural element as time string
+    @type struct: StringType
+    @param points: Peak if maxima over 'points' number of scans
+    @type points: IntType
+    @param scans: To compensate for spectra skewing,
+        peaks from 'scans' scans are combined (Default 1).
+    @type scans: IntType
+    @param percent: Relative threshold percentage of intensity, see
+        rel_threshold() (Default 2%)
+    @type percent: FloatType
+    @param n: Minimum number of ions above 'cutoff', see
+        num_ions_threshold(). If None, no peaks are removed
+    @type n: IntType
+    @param cutoff: The minimum intensity threshold for 'n'
+    @type cutoff: FloatType
+    @param max_bound: Optional value to limit size of detected bound
+        of the peak areas
+    @type max_bound: IntType
+    @param sparse: Whether the peak mass spectra hold only their nonzero
+        intensities, see pyms.GCMS.Class.SparseMassSpectrum (Default
+        False)
+    @type sparse: BooleanType
+    @param in_place: Whether the smoothed and baseline corrected
+        intensities replace those of 'im'. Otherwise they are written to
+        a new matrix, which is discarded after the areas are calculated
+    @type in_place: BooleanType
+    @param block_size: The number of ion chromatograms processed together
+    @type block_size: IntType
+
+    @return: List of Peak objects, with areas set
+    @rtype: ListType
+    """
+
+    if not isinstance(im, IntensityMatrix):
+        error("'im' must be an IntensityMatrix object")
+    if not is_int(block_size) or block_size < 1:
+        error("'block_size' must be a positive integer")
+    if n != None and cutoff == None:
+        error("'cutoff' must be given with 'n'")
+
+    n_scan, n_mz = im.get_size()
+
+    # window sizes in points, from the time step of the chromatograms
+    ic = im.get_ic_at_index(0)
+    wing_length = ic_window_points(ic, window, half_window=True)
+    if struct == None:
+        struct_pts = int(round(n_scan * _STRUCT_ELM_FRAC))
+    else:
+        struct_pts = ic_window_points(ic, struct)
+
+    raw_im = im.intensity_array
+    if in_place:
+        corr_im = raw_im
+    else:
+        corr_im = numpy.empty(raw_im.shape, dtype='d')
+
+    # the maxima are kept as scan and ion indices and intensities
+    maxima_rows = []
+    maxima_cols = []
+    maxima_values = []
+    for lo in range(0, n_mz, block_size):
+        hi = min(lo+block_size, n_mz)
+        block = savitzky_golay_ia(raw_im[:,lo:hi], wing_length, degree)
+        block = tophat_ia(block, struct_pts)
+        corr_im[:,lo:hi] = block
+        rows, cols = __local_maxima(block, points)
+        maxima_rows.append(rows)
+        maxima_cols.append(cols+lo)
+        maxima_values.append(block[rows, cols])
+
+    rows, cols, values = __combine_sparse_scans(
+        numpy.concatenate(maxima_rows), numpy.concatenate(maxima_cols),
+        numpy.concatenate(maxima_values), n_scan, scans)
+    del maxima_rows, maxima_cols, maxima_values
+
+    peak_list = __sparse_maxima_peaks(rows, cols, values, n_mz,
+        im.get_time_list(), im.get_mass_list(), sparse)
+
+    peak_list = rel_threshold(peak_list, percent, copy_peaks=False)
+    if n != None:
+        peak_list = num_ions_threshold(peak_list, n, cutoff,
+            copy_peaks=False)
+
+    if in_place:
+        corr = im
+    else:
+        corr = IntensityMatrix(im.get_time_list(), im.get_mass_list(),
+            corr_im)
+    areas = batch_peak_sum_area(corr, peak_list, max_bound=max_bound)
+    for peak, area in zip(peak_list, areas):
+        peak.set_area(area)
+
+    return peak_list
+
+def __maxima_peaks(maxima_im, rt_list, mass_list, sparse):
+
+    """
+    @summary: Makes peaks from the scans of a matrix of maxima
+
+    @param maxima_im: Intensities at ion maxima (scan by ion)
+    @type maxima_im: numpy.ndarray
+    @param rt_list: Retention times of the scans
+    @type rt_list: ListType
+    @param mass_list: Binned masses of the ions
+    @type mass_list: ListType
+    @param sparse: Whether the peak mass spectra hold only their nonzero
+        intensities
+    @type sparse: BooleanType
+
+    @return: List of Peak objects
+    @rtype: ListType
+    """
+
+    rows, cols = numpy.nonzero(maxima_im)
+
+    return __sparse_maxima_peaks(rows, cols, maxima_im[rows, cols],
+        maxima_im.shape[1], rt_list, mass_list, sparse)
+
+def __sparse_maxima_peaks(rows, cols, values, n_mz, rt_list, mass_list,
+        sparse):
+
+    """
+    @summary: Makes peaks from the scans of a list of maxima
+
+    @param rows: Scan indices of the maxima, in order of scan
+    @type rows: numpy.ndarray
+    @param cols: Ion indices of the maxima, in order within each scan
+    @type cols: numpy.ndarray
+    @param values: Intensities of the maxima
+    @type values: numpy.ndarray
+    @param n_mz: Number of ions
+    @type n_mz: IntType
+    @param rt_list: Retention times of the scans
+    @type rt_list: ListType
+    @param mass_list: Binned masses of the ions
+    @type mass_list: ListType
+    @param sparse: Whether the peak mass spectra hold only their nonzero
+        intensities
+    @type sparse: BooleanType
+
+    @return: List of Peak objects
+    @rtype: ListType
+    """
+
+    peak_list = []
+
+    # only scans with maxima can give peaks
+    scan_rows, starts = numpy.unique(rows, return_index=True)
+    ends = numpy.append(starts[1:], len(rows))
+    for row, begin, end in zip(scan_rows.tolist(), starts.tolist(),
+            ends.tolist()):
+        indices = cols[begin:end]
+        intensities = values[begin:end]
+        if sum(intensities) > 0:
             rt = rt_list[row]
-            ms = MassSpectrum(mass_list, maxima_im[row])
+            if sparse:
+                ms = SparseMassSpectrum(mass_list, indices, intensities)
+            else:
+                mass_spec = numpy.zeros(n_mz)
+                mass_spec[indices] = intensities
+                ms = MassSpectrum(mass_list, mass_spec)
             peak = Peak(rt, ms)
             peak.set_pt_bounds([0,row,0])  # store IM index for convenience
             peak_list.append(peak)
 
     return peak_list
 
-def rel_threshold(pl, percent=2):
+def rel_threshold(pl, percent=2, copy_peaks=True):
 
     """
     @summary: Remove ions with relative intensities less than the given
@@ -91,6 +278,9 @@ def rel_threshold(pl, percent=2):
     @type pl: ListType
     @param percent: Threshold for relative percentage of intensity (Default 2%)
     @type percent: FloatType
+    @param copy_peaks: Whether to threshold copies of the peaks. If False
+        the peaks in 'pl' are thresholded in place (Default True)
+    @type copy_peaks: BooleanType
 
     @return: A new list of Peak objects with threshold ions
     @rtype: ListType
@@ -101,22 +291,26 @@ def rel_threshold(pl, percent=2):
     if not is_number(percent) or percent <= 0:
         error("'percent' must be a number > 0")
 
-    pl_copy = copy.deepcopy(pl)
+    if copy_peaks:
+        pl = copy.deepcopy(pl)
     new_pl = []
-    for p in pl_copy:
-        ms = p.get_mass_spectrum()
+    for p in pl:
+        ms = p.ms
         ia = ms.mass_spec
         # assume max(ia) big so /100 1st
-        cutoff = (max(ia)/100.0)*float(percent)
-        for i in range(len(ia)):
-            if ia[i] < cutoff:
-                ia[i] = 0
+        cutoff = (numpy.max(ia)/100.0)*float(percent)
+        if isinstance(ia, numpy.ndarray):
+            ia[ia < cutoff] = 0
+        else:
+            for i in range(len(ia)):
+                if ia[i] < cutoff:
+                    ia[i] = 0
         ms.mass_spec = ia
         p.set_mass_spectrum(ms)
         new_pl.append(p)
     return new_pl
 
-def num_ions_threshold(pl, n, cutoff):
+def num_ions_threshold(pl, n, cutoff, copy_peaks=True):
 
     """
     @summary: Remove Peaks where there are less than a given number of ion
@@ -128,6 +322,9 @@ def num_ions_threshold(pl, n, cutoff):
     @type n: IntType
     @param cutoff: The minimum intensity threshold
     @type cutoff: FloatType
+    @param copy_peaks: Whether to return copies of the peaks. If False
+        the peaks in 'pl' are returned (Default True)
+    @type copy_peaks: BooleanType
 
     @return: A new list of Peak objects
     @rtype: ListType
@@ -135,17 +332,13 @@ def num_ions_threshold(pl, n, cutoff):
     @author: Andrew Isaac
     """
 
-    pl_copy = copy.deepcopy(pl)
     new_pl = []
-    for p in pl_copy:
-        ms = p.get_mass_spectrum()
-        ia = ms.mass_spec
-        ions = 0
-        for i in range(len(ia)):
-            if ia[i] >= cutoff:
-                ions += 1
+    for p in pl:
+        ions = numpy.count_nonzero(numpy.asarray(p.mass_spec) >= cutoff)
         if ions >= n:
             new_pl.append(p)
+    if copy_peaks:
+        new_pl = copy.deepcopy(new_pl)
     return new_pl
 
 def sum_maxima(im, points=3, scans=1):
@@ -168,16 +361,18 @@ def sum_maxima(im, points=3, scans=1):
     """
 
     maxima_im = get_maxima_matrix(im, points)
-    sums = []
+    row_sums = maxima_im.sum(axis=1)
     numrows = len(maxima_im)
     half = int(scans/2)
-    for row in range(numrows):
-        val = 0
-        for ii in range(scans):
-            if row - half + ii >= 0 and row - half + ii < numrows:
-                val += maxima_im[row - half + ii].sum()
-        sums.append(val)
-    tic = IonChromatogram(numpy.array(sums), im.get_time_list())
+    sums = numpy.zeros(numrows)
+    # add the sums of the rows 'scans' scans around each row, in order
+    for ii in range(scans):
+        shift = ii - half
+        lo = max(0, -shift)
+        hi = min(numrows, numrows - shift)
+        if lo < hi:
+            sums[lo:hi] += row_sums[lo+shift:hi+shift]
+    tic = IonChromatogram(sums, im.get_time_list())
 
     return tic
 
@@ -200,34 +395,79 @@ def get_maxima_indices(ion_intensities, points=3):
     if not is_list(ion_intensities) or not is_number(ion_intensities[0]):
         error("'ion_intensities' must be a List of numbers")
 
-    # find peak inflection points
-    # use a 'points' point window
-    # for a plateau after a rise, need to check if it is the left edge of
-    # a peak
-    peak_point = []
-    edge = -1
+    ia = numpy.asarray(ion_intensities).reshape(-1, 1)
+    rows, cols = __local_maxima(ia, points)
+
+    return numpy.sort(rows).tolist()
+
+def __local_maxima(ia, points):
+
+    """
+    @summary: Find local maxima of all ions at once
+
+        A scan is a maximum of an ion if its intensity is greater than
+        the intensities in the 'points' scan window either side of it.
+        For a plateau after a rise, the plateau is the top of a peak if
+        it is followed by a fall, and its centre is taken as the maximum.
+
+    @param ia: Intensities (scan by ion)
+    @type ia: numpy.ndarray
+    @param points: Peak if maxima over 'points' number of scans
+    @type points: IntType
+
+    @return: Scan and ion indices of the maxima
+    @rtype: TupleType
+    """
+
     points = int(points)
     half = int(points/2)
     points = 2*half+1  # ensure odd number of points
-    for index in range(len(ion_intensities)-points+1):
-        left = ion_intensities[index:index+half]
-        mid = ion_intensities[index+half]
-        right = ion_intensities[index+half+1:index+points]
-        # max in middle
-        if mid > max(left) and mid > max(right):
-            peak_point.append(index+half)
-            edge = -1  # ignore previous rising edge
-        # flat from rise (left of peak?)
-        if mid > max(left) and mid == max(right):
-            edge = index+half  # ignore previous rising edge, update latest
-        # fall from flat
-        if mid == max(left) and mid > max(right):
-            if edge > -1:
-                centre = int((edge+index+half)/2)  # mid point
-                peak_point.append(centre)
-            edge = -1
-
-    return peak_point
+
+    if half < 1:
+        error("'points' must be at least 2")
+
+    # number of window positions, the middle of each is a candidate
+    num_pos = ia.shape[0]-points+1
+    if num_pos < 1:
+        empty = numpy.zeros(0, dtype=int)
+        return empty, empty
+
+    # largest intensity left and right of the middle of each window
+    mid = ia[half:half+num_pos]
+    left = ia[0:num_pos]
+    for ii in range(1, half):
+        left = numpy.maximum(left, ia[ii:ii+num_pos])
+    right = ia[half+1:half+1+num_pos]
+    for ii in range(half+2, points):
+        right = numpy.maximum(right, ia[ii:ii+num_pos])
+
+    # max in middle
+    peak = numpy.logical_and(mid > left, mid > right)
+    # flat from rise (left of peak?)
+    rise = numpy.logical_and(mid > left, mid == right)
+    # fall from flat
+    fall = numpy.logical_and(mid == left, mid > right)
+
+    # a fall ends a plateau peak only if the latest of these events
+    # before it, in the same ion, was a rise to the plateau
+    positions = numpy.arange(num_pos)[:,numpy.newaxis]
+    latest = numpy.where(peak | rise | fall, positions, -1)
+    numpy.maximum.accumulate(latest, axis=0, out=latest)
+
+    fall_pos, fall_ion = numpy.nonzero(fall)
+    edge = latest[numpy.maximum(fall_pos-1, 0), fall_ion]
+    edge[fall_pos == 0] = -1
+    plateau = edge > -1
+    plateau[plateau] = rise[edge[plateau], fall_ion[plateau]]
+
+    peak_pos, peak_ion = numpy.nonzero(peak)
+    # mid point of the plateau
+    centre = (edge[plateau]+fall_pos[plateau])/2
+
+    rows = numpy.concatenate((peak_pos, centre)) + half
+    cols = numpy.concatenate((peak_ion, fall_ion[plateau]))
+
+    return rows, cols
 
 def get_maxima_list(ic, points=3):
 
@@ -309,35 +549,150 @@ def get_maxima_matrix(im, points=3, scans=1):
     numrows, numcols = im.get_size()
     # zeroed matrix, size numrows*numcols
     maxima_im = numpy.zeros((numrows, numcols))
-    raw_im = numpy.array(im.get_matrix_list())
+    # direct access, don't modify
+    raw_im = im.intensity_array
 
-    for col in range(numcols):  # assume all rows have same width
-        # 1st, find maxima
-        maxima = get_maxima_indices(raw_im[:,col], points)
-        # 2nd, fill intensities
-        for row in maxima:
-            maxima_im[row, col] = raw_im[row, col]
+    # find maxima of all ions, and fill intensities
+    rows, cols = __local_maxima(raw_im, points)
+    maxima_im[rows, cols] = raw_im[rows, cols]
 
-    # combine spectra within 'scans' scans.
+    __combine_scans(maxima_im, scans)
+
+    return maxima_im
+
+def __combine_scans(maxima_im, scans):
+
+    """
+    @summary: Combines the maxima of each 'scans' scans into the scan
+        with the largest sum of maxima, in place
+
+    @param maxima_im: Intensities at ion maxima (scan by ion)
+    @type maxima_im: numpy.ndarray
+    @param scans: To compensate for spectra scewing,
+        peaks from 'scans' scans are combined.
+    @type scans: IntType
+    """
+
+    numrows = len(maxima_im)
+
+    # Windows in which only the best scan has any maxima are left as
+    # they are. The rows are merged one window at a time, as each merge
+    # changes the sums that choose the best scan of the next windows;
+    # only rows that are merged are touched as whole arrays
     half = int(scans/2)
+    tics = [ row.sum() for row in maxima_im ]
+    occupied = numpy.any(maxima_im != 0, axis=1).tolist()
     for row in range(numrows):
-        tic = 0
         best = 0
         loc = 0
+        moved = []
         # find best in scans
         for ii in range(scans):
             if row - half + ii >= 0 and row - half + ii < numrows:
-                tic = maxima_im[row - half + ii].sum()
                 # find largest tic of scans
-                if tic > best:
-                    best = tic
+                if tics[row - half + ii] > best:
+                    best = tics[row - half + ii]
                     loc = ii
-        # move and add others to best
         for ii in range(scans):
-            if row - half + ii >= 0 and row - half + ii < numrows and ii != loc:
-                for col in range(numcols):
-                    maxima_im[row - half + loc, col] += \
-                        maxima_im[row - half + ii, col]
-                    maxima_im[row - half + ii, col] = 0
+            if row - half + ii >= 0 and row - half + ii < numrows and \
+               ii != loc and occupied[row - half + ii]:
+                moved.append(row - half + ii)
+        # move and add others to best
+        if len(moved) > 0:
+            target = row - half + loc
+            for ix in moved:
+                maxima_im[target] += maxima_im[ix]
+                maxima_im[ix] = 0
+                tics[ix] = 0
+                occupied[ix] = False
+            tics[target] = maxima_im[target].sum()
+            occupied[target] = bool(numpy.any(maxima_im[target] != 0))
+
+def __combine_sparse_scans(rows, cols, values, numrows, scans):
 
-    return maxima_im
+    """
+    @summary: Combines the maxima of each 'scans' scans into the scan
+        with the largest sum of maxima, as __combine_scans() does for a
+        matrix of maxima
+
+    @param rows: Scan indices of the maxima
+    @type rows: numpy.ndarray
+    @param cols: Ion indices of the maxima
+    @type cols: numpy.ndarray
+    @param values: Intensities of the maxima
+    @type values: numpy.ndarray
+    @param numrows: Number of scans
+    @type numrows: IntType
+    @param scans: To compensate for spectra scewing,
+        peaks from 'scans' scans are combined.
+    @type scans: IntType
+
+    @return: Scan and ion indices, and intensities, of the combined
+        maxima, in order of scan and ion
+    @rtype: TupleType
+    """
+
+    order = numpy.lexsort((cols, rows))
+    rows = rows[order]
+    cols = cols[order]
+    values = values[order]
+
+    half = int(scans/2)
+    if half < 1:
+        return rows, cols, values
+
+    # ion indices and intensities of each scan with maxima
+    maxima = {}
+    tics = {}
+    scan_rows, starts = numpy.unique(rows, return_index=True)
+    ends = numpy.append(starts[1:], len(rows))
+    for row, begin, end in zip(scan_rows.tolist(), starts.tolist(),
+            ends.tolist()):
+        maxima[row] = (cols[begin:end], values[begin:end])
+        tics[row] = values[begin:end].sum()
+
+    # Maxima only move to scans that already have some, so only the
+    # windows around those scans need to be visited, in order
+    windows = set()
+    for row in scan_rows.tolist():
+        windows.update(range(max(row+half-scans+1, 0),
+            min(row+half+1, numrows)))
+
+    for row in sorted(windows):
+        window = range(max(row-half, 0), min(row-half+scans, numrows))
+        # find largest tic of scans
+        best = 0
+        target = None
+        for scan in window:
+            if tics.get(scan, 0) > best:
+                best = tics[scan]
+                target = scan
+        if target == None:
+            continue
+        moved = [ scan for scan in window
+            if scan != target and maxima.has_key(scan) ]
+        # move and add others to best, summing in the same order as
+        # __combine_scans()
+        if len(moved) > 0:
+            parts = [ maxima[scan] for scan in [target] + moved ]
+            ions, inverse = numpy.unique(
+                numpy.concatenate([ part[0] for part in parts ]),
+                return_inverse=True)
+            intensities = numpy.bincount(inverse,
+                weights=numpy.concatenate([ part[1] for part in parts ]))
+            for scan in moved:
+                del maxima[scan]
+                del tics[scan]
+            maxima[target] = (ions, intensities)
+            tics[target] = intensities.sum()
+
+    scan_rows = sorted(maxima.keys())
+    if len(scan_rows) == 0:
+        return rows[:0], cols[:0], values[:0]
+
+    rows = numpy.concatenate([ numpy.repeat(row, len(maxima[row][0]))
+        for row in scan_rows ])
+    cols = numpy.concatenate([ maxima[row][0] for row in scan_rows ])
+    values = numpy.concatenate([ maxima[row][1] for row in scan_rows ])
+
+    return rows, cols, values
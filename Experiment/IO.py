@@ -24,11 +24,28 @@ Functions related to experiment input/output
 
 import string, cPickle
 
+import numpy
+
 from pyms.Utils.Error import error
 from pyms.Experiment.Class import Experiment
-from pyms.Utils.Utils import is_str
-from pyms.Utils.IO import file_lines
-from pyms.GCMS.Class import IntensityMatrix
+from pyms.Utils.Utils import is_str, is_list
+from pyms.Utils.IO import file_lines, write_container, \
+    read_container_header, read_container_rows
+from pyms.Utils.Time import time_str_secs
+from pyms.GCMS.Class import IntensityMatrix, IonChromatogram, \
+    MassSpectrum, SparseMassSpectrum
+from pyms.Peak.Class import Peak
+from pyms.Peak.List.Utils import sele_peaks_by_rt
+
+# the kinds of peak mass spectrum in a batch file
+_NO_SPECTRUM = 0
+_DENSE_SPECTRUM = 1
+_SPARSE_SPECTRUM = 2
+
+# the peak fields stored in a batch file
+_PEAK_FIELDS = ['rt', 'minutes', 'ic_mass', 'area', 'pt_bounds', 'ms_kind',
+    'mass_offsets', 'mass_list', 'spec_offsets', 'spec_indices',
+    'spec_values', 'ion_offsets', 'ion_masses', 'ion_areas']
 
 def load_expr(file_name):
 
@@ -120,3 +137,444 @@ def read_expr_list(file_name):
         exprl.append(expr)
 
     return exprl
+
+def store_expr_batch(file_name, expr_list, im_list=None, compress=True,
+        chunk_rows=256):
+
+    """
+    @summary: Stores a batch of experiments, and optionally their
+        intensity matrices, in a single file
+
+        The file is an array container (see pyms.Utils.IO). For each
+        sample it holds the fields of the peaks as arrays, and the TIC
+        and the intensity matrix in chunks of 'chunk_rows' scans, so
+        that a retention time window of one sample can be read without
+        reading the rest of the file.
+
+    @param file_name: The name of the file
+    @type file_name: StringType
+    @param expr_list: A list of experiment objects
+    @type expr_list: ListType
+    @param im_list: The intensity matrix of each experiment, or None
+    @type im_list: ListType
+    @param compress: Whether to compress the data
+    @type compress: BooleanType
+    @param chunk_rows: Number of scans in a compressed chunk
+    @type chunk_rows: IntType
+
+    @return: none
+    @rtype: NoneType
+    """
+
+    if not is_str(file_name):
+        error("'file_name' not a string")
+    if not is_list(expr_list):
+        error("'expr_list' not a list")
+    if im_list != None and len(im_list) != len(expr_list):
+        error("'im_list' and 'expr_list' differ in length")
+
+    expr_codes = []
+    arrays = []
+    for ii in range(len(expr_list)):
+        expr = expr_list[ii]
+        if not isinstance(expr, Experiment):
+            error("argument not an instance of the class 'Experiment'")
+        expr_code = expr.get_expr_code()
+        if expr_code in expr_codes:
+            error("experiment code '%s' is not unique" % (expr_code))
+        expr_codes.append(expr_code)
+
+        prefix = "%s/" % (ii)
+        peak_arrays = __peak_arrays(expr.get_peak_list())
+        for field in _PEAK_FIELDS:
+            arrays.append((prefix+'peak_'+field, peak_arrays[field]))
+
+        if im_list != None:
+            im = im_list[ii]
+            if not isinstance(im, IntensityMatrix):
+                error("'im_list' must be a list of IntensityMatrix objects")
+            intensity_array = im.intensity_array
+            arrays.append((prefix+'time_list',
+                numpy.asarray(im.get_time_list(), dtype='d')))
+            arrays.append((prefix+'mass_list',
+                numpy.asarray(im.get_mass_list())))
+            arrays.append((prefix+'tic', intensity_array.sum(axis=1)))
+            arrays.append((prefix+'intensity_array', intensity_array))
+
+    attrs = {'kind':'ExperimentBatch', 'expr_codes':expr_codes}
+
+    write_container(file_name, arrays, attrs, compress, chunk_rows)
+
+def read_expr_batch_codes(file_name):
+
+    """
+    @summary: Returns the experiment codes in a batch file
+
+    @param file_name: The name of a file written by store_expr_batch()
+    @type file_name: StringType
+
+    @return: The experiment codes, in the order they were stored
+    @rtype: ListType
+    """
+
+    attrs, entries = __read_batch_header(file_name)
+
+    return [ str(expr_code) for expr_code in attrs['expr_codes'] ]
+
+def load_expr_batch(file_name, expr_codes=None, rt_range=None):
+
+    """
+    @summary: Loads experiments stored with store_expr_batch()
+
+    @param file_name: The name of the file
+    @type file_name: StringType
+    @param expr_codes: Codes of the experiments to load, or None for
+        all experiments
+    @type expr_codes: ListType
+    @param rt_range: If given, only peaks in this retention time range
+        are kept. Two time strings, as for Experiment.sele_rt_range()
+    @type rt_range: ListType
+
+    @return: A list of Experiment instances
+    @rtype: ListType
+    """
+
+    attrs, entries = __read_batch_header(file_name)
+    codes = [ str(expr_code) for expr_code in attrs['expr_codes'] ]
+
+    if expr_codes == None:
+        expr_codes = codes
+
+    exprl = []
+    for expr_code in expr_codes:
+        prefix = __batch_prefix(codes, expr_code)
+        peak_arrays = {}
+        for field in _PEAK_FIELDS:
+            peak_arrays[field] = read_container_rows(file_name,
+                prefix+'peak_'+field, entries=entries)
+        peak_list = __array_peaks(peak_arrays)
+        if rt_range != None:
+            peak_list = sele_peaks_by_rt(peak_list, rt_range)
+        exprl.append(Experiment(expr_code, peak_list))
+
+    return exprl
+
+def load_expr_batch_im(file_name, expr_code, rt_range=None):
+
+    """
+    @summary: Loads the intensity matrix of one experiment stored with
+        store_expr_batch()
+
+        With 'rt_range' only the scans in the retention time range
+        are read.
+
+    @param file_name: The name of the file
+    @type file_name: StringType
+    @param expr_code: The experiment code
+    @type expr_code: StringType
+    @param rt_range: Two time strings, specifying lower and upper
+        retention times, or None for all scans
+    @type rt_range: ListType
+
+    @return: The intensity matrix
+    @rtype: pyms.GCMS.Class.IntensityMatrix
+    """
+
+    attrs, entries = __read_batch_header(file_name)
+    codes = [ str(code) for code in attrs['expr_codes'] ]
+    prefix = __batch_prefix(codes, expr_code)
+
+    if not entries.has_key(prefix+'intensity_array'):
+        error("no intensity matrix stored for '%s'" % (expr_code))
+
+    time_array = read_container_rows(file_name, prefix+'time_list',
+        entries=entries)
+    begin, end = __batch_rows(time_array, rt_range)
+
+    mass_list = read_container_rows(file_name, prefix+'mass_list',
+        entries=entries).tolist()
+    intensity_array = read_container_rows(file_name,
+        prefix+'intensity_array', begin, end, entries)
+
+    return IntensityMatrix(time_array[begin:end].tolist(), mass_list,
+        intensity_array)
+
+def load_expr_batch_tic(file_name, expr_code, rt_range=None):
+
+    """
+    @summary: Loads the TIC of one experiment stored with
+        store_expr_batch()
+
+    @param file_name: The name of the file
+    @type file_name: StringType
+    @param expr_code: The experiment code
+    @type expr_code: StringType
+    @param rt_range: Two time strings, specifying lower and upper
+        retention times, or None for the whole TIC
+    @type rt_range: ListType
+
+    @return: Total ion chromatogram
+    @rtype: pyms.GCMS.Class.IonChromatogram
+    """
+
+    attrs, entries = __read_batch_header(file_name)
+    codes = [ str(code) for code in attrs['expr_codes'] ]
+    prefix = __batch_prefix(codes, expr_code)
+
+    if not entries.has_key(prefix+'tic'):
+        error("no TIC stored for '%s'" % (expr_code))
+
+    time_array = read_container_rows(file_name, prefix+'time_list',
+        entries=entries)
+    begin, end = __batch_rows(time_array, rt_range)
+
+    tic = read_container_rows(file_name, prefix+'tic', begin, end, entries)
+
+    return IonChromatogram(tic, time_array[begin:end].tolist())
+
+def __peak_arrays(peak_list):
+
+    """
+    @summary: Returns the fields of a list of peaks as arrays
+
+        Retention times, areas and ion masses have one value per
+        peak, with NaN for a value that is not set. The mass
+        spectra, and the ion areas, are concatenated and indexed by
+        offset arrays of one more element than the number of peaks.
+        Mass spectra are stored as the indices and values of their
+        nonzero intensities.
+
+    @param peak_list: A list of peaks
+    @type peak_list: ListType
+
+    @return: The arrays, by field name
+    @rtype: DictType
+    """
+
+    n_peaks = len(peak_list)
+    arrays = {}
+    arrays['rt'] = numpy.zeros(n_peaks, dtype='d')
+    arrays['minutes'] = numpy.zeros(n_peaks, dtype='u1')
+    arrays['ic_mass'] = numpy.zeros(n_peaks, dtype='d')
+    arrays['area'] = numpy.zeros(n_peaks, dtype='d')
+    arrays['pt_bounds'] = numpy.zeros((n_peaks, 3), dtype='i8')
+    arrays['ms_kind'] = numpy.zeros(n_peaks, dtype='u1')
+
+    mass_lists = []
+    spec_indices = []
+    spec_values = []
+    ion_masses = []
+    ion_areas = []
+    for ii in range(n_peaks):
+        peak = peak_list[ii]
+        if not isinstance(peak, Peak):
+            error("peak list must contain Peak objects")
+
+        arrays['rt'][ii] = peak.get_rt()
+        arrays['minutes'][ii] = peak.get_minutes()
+        ic_mass = peak.get_ic_mass()
+        if ic_mass == None:
+            ic_mass = numpy.nan
+        arrays['ic_mass'][ii] = ic_mass
+        area = peak.get_area()
+        if area == None:
+            area = numpy.nan
+        arrays['area'][ii] = area
+        pt_bounds = peak.get_pt_bounds()
+        if pt_bounds == None:
+            pt_bounds = [-1, -1, -1]
+        arrays['pt_bounds'][ii] = pt_bounds
+
+        ms = peak.ms
+        if ms == None:
+            mass_list = []
+            indices = numpy.zeros(0, dtype='i')
+            values = numpy.zeros(0, dtype='d')
+        elif isinstance(ms, SparseMassSpectrum):
+            arrays['ms_kind'][ii] = _SPARSE_SPECTRUM
+            mass_list = ms.mass_list
+            indices = ms.indices
+            values = ms.intensities
+        else:
+            arrays['ms_kind'][ii] = _DENSE_SPECTRUM
+            mass_list = ms.mass_list
+            mass_spec = numpy.asarray(ms.mass_spec, dtype='d')
+            indices = numpy.nonzero(mass_spec)[0]
+            values = mass_spec[indices]
+        mass_lists.append(numpy.asarray(mass_list, dtype='d'))
+        spec_indices.append(numpy.asarray(indices, dtype='i4'))
+        spec_values.append(values)
+
+        ions = peak.ion_areas
+        ion_masses.append(numpy.array(ions.keys(), dtype='d'))
+        ion_areas.append(numpy.array(ions.values(), dtype='d'))
+
+    arrays['mass_offsets'], arrays['mass_list'] = __concatenate(mass_lists,
+        'd')
+    arrays['spec_offsets'], arrays['spec_indices'] = \
+        __concatenate(spec_indices, 'i4')
+    arrays['spec_values'] = __concatenate(spec_values, 'd')[1]
+    arrays['ion_offsets'], arrays['ion_masses'] = __concatenate(ion_masses,
+        'd')
+    arrays['ion_areas'] = __concatenate(ion_areas, 'd')[1]
+
+    return arrays
+
+def __array_peaks(arrays):
+
+    """
+    @summary: Returns the list of peaks stored as arrays by
+        __peak_arrays()
+
+        Peaks with the same mass list as the peak before share it.
+
+    @param arrays: The arrays, by field name
+    @type arrays: DictType
+
+    @return: A list of peaks
+    @rtype: ListType
+    """
+
+    mass_offsets = arrays['mass_offsets']
+    spec_offsets = arrays['spec_offsets']
+    ion_offsets = arrays['ion_offsets']
+
+    peak_list = []
+    mass_list = None
+    for ii in range(len(arrays['rt'])):
+        kind = arrays['ms_kind'][ii]
+        ms = None
+        if kind != _NO_SPECTRUM:
+            masses = arrays['mass_list'][mass_offsets[ii]:mass_offsets[ii+1]]
+            if mass_list == None or len(mass_list) != len(masses) or \
+               mass_list != masses.tolist():
+                mass_list = masses.tolist()
+            begin = spec_offsets[ii]
+            end = spec_offsets[ii+1]
+            indices = arrays['spec_indices'][begin:end]
+            values = arrays['spec_values'][begin:end]
+            if kind == _SPARSE_SPECTRUM:
+                ms = SparseMassSpectrum(mass_list, indices, values)
+            else:
+                mass_spec = numpy.zeros(len(mass_list), dtype='d')
+                mass_spec[indices] = values
+                ms = MassSpectrum(mass_list, mass_spec.tolist())
+        elif not numpy.isnan(arrays['ic_mass'][ii]):
+            ms = float(arrays['ic_mass'][ii])
+
+        rt = float(arrays['rt'][ii])
+        minutes = bool(arrays['minutes'][ii])
+        if minutes:
+            rt = rt/60.0
+        peak = Peak(rt, ms, minutes)
+
+        if arrays['pt_bounds'][ii][0] >= 0:
+            peak.set_pt_bounds(arrays['pt_bounds'][ii].tolist())
+        if not numpy.isnan(arrays['area'][ii]):
+            peak.set_area(float(arrays['area'][ii]))
+        begin = ion_offsets[ii]
+        end = ion_offsets[ii+1]
+        peak.set_ion_areas(dict(zip(arrays['ion_masses'][begin:end].tolist(),
+            arrays['ion_areas'][begin:end].tolist())))
+
+        peak_list.append(peak)
+
+    return peak_list
+
+def __concatenate(array_list, dtype):
+
+    """
+    @summary: Concatenates a list of arrays, and returns the offset
+        of each array in the result
+
+    @param array_list: A list of arrays
+    @type array_list: ListType
+    @param dtype: The type of the result
+    @type dtype: StringType
+
+    @return: The offsets, with one more element than the list, and
+        the concatenated arrays
+    @rtype: TupleType
+    """
+
+    offsets = numpy.zeros(len(array_list)+1, dtype='i8')
+    offsets[1:] = numpy.cumsum([ len(array) for array in array_list ])
+
+    if len(array_list) == 0:
+        return offsets, numpy.zeros(0, dtype=dtype)
+
+    return offsets, numpy.concatenate(array_list).astype(dtype)
+
+def __read_batch_header(file_name):
+
+    """
+    @summary: Reads the header of a batch file
+
+    @param file_name: The name of the file
+    @type file_name: StringType
+
+    @return: The attributes and array descriptions
+    @rtype: TupleType
+    """
+
+    if not is_str(file_name):
+        error("'file_name' not a string")
+
+    attrs, entries = read_container_header(file_name)
+    if attrs.get('kind') != 'ExperimentBatch':
+        error("'%s' is not an experiment batch file" % (file_name))
+
+    return attrs, entries
+
+def __batch_prefix(codes, expr_code):
+
+    """
+    @summary: Returns the prefix of the arrays of an experiment
+
+    @param codes: The experiment codes in the batch
+    @type codes: ListType
+    @param expr_code: The experiment code
+    @type expr_code: StringType
+
+    @return: The array name prefix
+    @rtype: StringType
+    """
+
+    if not expr_code in codes:
+        error("no experiment '%s' in the batch" % (expr_code))
+
+    return "%s/" % (codes.index(expr_code))
+
+def __batch_rows(time_array, rt_range):
+
+    """
+    @summary: Returns the range of scans in a retention time range
+
+    @param time_array: Retention times of the scans
+    @type time_array: numpy.ndarray
+    @param rt_range: Two time strings, or None for all scans
+    @type rt_range: ListType
+
+    @return: First scan, and the scan after the last
+    @rtype: TupleType
+    """
+
+    if rt_range == None:
+        return 0, len(time_array)
+
+    if not is_list(rt_range) or len(rt_range) != 2:
+        error("'rt_range' must have exactly two elements")
+
+    rt_lo = time_str_secs(rt_range[0])
+    rt_hi = time_str_secs(rt_range[1])
+
+    if not rt_lo < rt_hi:
+        error("lower retention time limit must be less than upper")
+
+    begin = int(numpy.searchsorted(time_array, rt_lo, side='left'))
+    end = int(numpy.searchsorted(time_array, rt_hi, side='right'))
+
+    if not end > begin:
+        error("no scans in the retention time range")
+
+    return begin, end
@@ -29,9 +29,11 @@ import operator
 
 from pyms.Utils.Error import error
 from pyms.Utils.Utils import is_str, is_int, is_array, is_list, is_number
-from pyms.Utils.IO import open_for_writing, close_for_writing, save_data
+from pyms.Utils.IO import open_for_writing, close_for_writing, save_data, \
+    write_container
 from pyms.Utils.Math import mean, std, median
-from pyms.Utils.Time import time_str_secs
+from pyms.Utils.Time import time_str_secs, nearest_time_index, \
+    nearest_time_indices
 
 class GCMS_data(object):
 
@@ -39,20 +41,45 @@ class GCMS_data(object):
     @summary: Generic object for GC-MS data. Contains raw data
         as a list of scans and times
 
+        The raw data are held in a compact columnar form: one flat
+        array of masses, one flat array of intensities and the
+        number of points in each scan. This is the layout used by
+        the ANDI 'mass_values', 'intensity_values' and 'point_count'
+        variables. Scan objects are created on demand as views of
+        the flat arrays.
+
     @author: Qiao Wang
     @author: Andrew Isaac
     @author: Vladimir Likic
     """
 
-    def __init__(self, time_list, scan_list):
+    def __init__(self, time_list, scan_list=None, mass_values=None,
+        intensity_values=None, point_count=None, tic=None):
 
         """
         @summary: Initialize the GC-MS data
 
+            The data are given either as a list of Scan objects, or
+            as flat mass and intensity arrays together with the
+            number of points in each scan. The flat arrays are not
+            copied, and may be memory maps of a data file. The min
+            and max mass and the TIC are calculated when first
+            needed, so that the points are only read when used.
+
         @param time_list: List of scan retention times
         @type time_list: ListType
         @param scan_list: List of Scan objects
         @type scan_list: ListType
+        @param mass_values: Masses of all scans, one scan after another
+        @type mass_values: numpy.ndarray
+        @param intensity_values: Intensities of all scans, one scan
+            after another
+        @type intensity_values: numpy.ndarray
+        @param point_count: Number of points in each scan
+        @type point_count: numpy.ndarray
+        @param tic: Total intensity of each scan, if known. Otherwise
+            the TIC is calculated from the intensities
+        @type tic: numpy.ndarray
 
         @author: Qiao Wang
         @author: Andrew Isaac
@@ -62,13 +89,63 @@ class GCMS_data(object):
         if not is_list(time_list) or not is_number(time_list[0]):
             error("'time_list' must be a list of numbers")
 
-        if not is_list(scan_list) or not isinstance(scan_list[0], Scan):
-            error("'scan_list' must be a list of Scan objects")
+        if scan_list != None:
+            if not is_list(scan_list) or not isinstance(scan_list[0], Scan):
+                error("'scan_list' must be a list of Scan objects")
+            mass_values, intensity_values, point_count = \
+                _flatten_scans(scan_list)
+        else:
+            if mass_values is None or intensity_values is None or \
+               point_count is None:
+                error("either 'scan_list', or 'mass_values', "
+                    "'intensity_values' and 'point_count' must be given")
+            # arrays are kept as they are, so memory maps are not read
+            if not is_array(mass_values):
+                mass_values = numpy.asarray(mass_values, dtype='d')
+            if not is_array(intensity_values):
+                intensity_values = numpy.asarray(intensity_values, dtype='d')
+            point_count = numpy.asarray(point_count, dtype=int)
+            if len(mass_values) != len(intensity_values):
+                error("'mass_values' and 'intensity_values' differ in length")
+            if point_count.sum() != len(mass_values):
+                error("'point_count' does not match the number of points")
+
+        if len(time_list) != len(point_count):
+            error("number of time points (%d) does not equal the number "
+                "of scans (%d)" % (len(time_list), len(point_count)))
+
+        if tic is not None:
+            tic = numpy.asarray(tic, dtype='d')
+            if len(tic) != len(point_count):
+                error("'tic' is not the same length as 'time_list'")
 
         self.__set_time(time_list)
-        self.__scan_list = scan_list
-        self.__set_min_max_mass()
-        self.__calc_tic()
+        self.__set_points(mass_values, intensity_values, point_count, tic)
+
+    def __setstate__(self, state):
+
+        """
+        @summary: Restores a pickled GCMS_data object
+
+            Objects pickled before the raw data were held in flat
+            arrays store a list of Scan objects. These are converted
+            on loading.
+
+        @param state: The pickled attributes
+        @type state: DictType
+        """
+
+        old_key = '_GCMS_data__scan_list'
+        if state.has_key(old_key) and \
+           not state.has_key('_GCMS_data__mass_values'):
+            scan_list = state.pop(old_key)
+            self.__dict__.update(state)
+            self.__time_array = numpy.array(self.__time_list, dtype='d')
+            mass_values, intensity_values, point_count = \
+                _flatten_scans(scan_list)
+            self.__set_points(mass_values, intensity_values, point_count)
+        else:
+            self.__dict__.update(state)
 
     def __len__(self):
 
@@ -82,7 +159,7 @@ class GCMS_data(object):
         @author: Vladimir Likic
         """
 
-        return len(self.__scan_list)
+        return len(self.__point_count)
 
     def __set_time(self, time_list):
 
@@ -97,25 +174,58 @@ class GCMS_data(object):
 
         # calculate the time step, its spreak, and along the way
         # check that retention times are increasing
-        time_diff_list = []
-
-        for ii in range(len(time_list)-1):
-            t1 = time_list[ii]
-            t2 = time_list[ii+1]
-            if not t2 > t1:
-                error("problem with retention times detected")
-            time_diff = t2 - t1
-            time_diff_list.append(time_diff)
+        time_array = numpy.array(time_list, dtype='d')
+        time_diff = numpy.diff(time_array)
+        if not (time_diff > 0).all():
+            error("problem with retention times detected")
 
+        time_diff_list = time_diff.tolist()
         time_step = mean(time_diff_list)
         time_step_std = std(time_diff_list)
 
         self.__time_list = time_list
+        # sorted times for binary search
+        self.__time_array = time_array
         self.__time_step = time_step
         self.__time_step_std = time_step_std
         self.__min_rt = min(time_list)
         self.__max_rt = max(time_list)
 
+    def __set_points(self, mass_values, intensity_values, point_count,
+        tic=None):
+
+        """
+        @summary: Sets the raw data points. The properties derived
+            from them are reset, and calculated when next needed
+
+        @param mass_values: Masses of all scans
+        @type mass_values: numpy.ndarray
+        @param intensity_values: Intensities of all scans
+        @type intensity_values: numpy.ndarray
+        @param point_count: Number of points in each scan
+        @type point_count: numpy.ndarray
+        @param tic: Total intensity of each scan, or None
+        @type tic: numpy.ndarray
+        """
+
+        self.__mass_values = mass_values
+        self.__intensity_values = intensity_values
+        self.__point_count = point_count
+
+        # offset of the first point of each scan, and the end of the
+        # last scan
+        scan_index = numpy.zeros(len(point_count)+1, dtype=int)
+        numpy.cumsum(point_count, out=scan_index[1:])
+        self.__scan_index = scan_index
+
+        # Scan views, mass range and the TIC are built when first
+        # asked for
+        self.__scan_list = None
+        self.__min_mass = None
+        self.__max_mass = None
+        self.__tic_values = tic
+        self.__tic = None
+
     def __set_min_max_mass(self):
 
         """
@@ -126,17 +236,11 @@ class GCMS_data(object):
         @author: Vladimir Likic
         """
 
-        mini = self.__scan_list[0].get_min_mass()
-        maxi = self.__scan_list[0].get_max_mass()
-        for scan in self.__scan_list:
-            tmp_mini = scan.get_min_mass()
-            tmp_maxi = scan.get_max_mass()
-            if tmp_mini < mini:
-                mini = tmp_mini
-            if tmp_maxi > maxi:
-                maxi = tmp_maxi
-        self.__min_mass = mini
-        self.__max_mass = maxi
+        if len(self.__mass_values) == 0:
+            error("no mass values in the data")
+
+        self.__min_mass = float(self.__mass_values.min())
+        self.__max_mass = float(self.__mass_values.max())
 
     def get_min_mass(self):
 
@@ -151,6 +255,9 @@ class GCMS_data(object):
         @author: Vladimir Likic
         """
 
+        if self.__min_mass == None:
+            self.__set_min_max_mass()
+
         return self.__min_mass
 
     def get_max_mass(self):
@@ -166,6 +273,9 @@ class GCMS_data(object):
         @author: Vladimir Likic
         """
 
+        if self.__max_mass == None:
+            self.__set_min_max_mass()
+
         return self.__max_mass
 
     def get_index_at_time(self, time):
@@ -185,26 +295,22 @@ class GCMS_data(object):
         @author: Vladimir Likic
         """
 
-        if not is_number(time):
-            error("'time' must be a number")
+        return nearest_time_index(self.__time_array, time)
 
-        if (time < self.__min_rt) or (time > self.__max_rt):
-            error("time %.2f is out of bounds (min: %.2f, max: %.2f)" %
-                  (time, self.__min_rt, self.__max_rt))
+    def get_indices_at_times(self, times):
 
-        time_list = self.__time_list
-        time_diff_min = self.__max_rt
-        ix_match = None
-
-        for ix in range(len(time_list)):
+        """
+        @summary: Returns the nearest index corresponding to each of
+            the given times
 
-            time_diff = math.fabs(time-time_list[ix])
+        @param times: Times in seconds
+        @type times: ListType or numpy.ndarray
 
-            if time_diff < time_diff_min:
-                ix_match = ix
-                time_diff_min = time_diff
+        @return: Nearest index corresponding to each time
+        @rtype: numpy.ndarray
+        """
 
-        return ix_match
+        return nearest_time_indices(self.__time_array, times)
 
     def get_time_list(self):
 
@@ -234,12 +340,59 @@ class GCMS_data(object):
         @author: Vladimir Likic
         """
 
-        return copy.deepcopy(self.__scan_list)
+        return copy.deepcopy(self.scan_list)
+
+    def get_scan_at_index(self, ix):
+
+        """
+        @summary: Returns the scan at the given index
+
+            The scan is a view of the raw data, its masses and
+            intensities are not copied.
+
+        @param ix: Scan index
+        @type ix: IntType
+
+        @return: The scan
+        @rtype: pyms.GCMS.Class.Scan
+        """
+
+        if not is_int(ix):
+            error("index not an integer")
+
+        if ix < 0 or ix >= len(self.__point_count):
+            error("index out of range")
+
+        begin = self.__scan_index[ix]
+        end = self.__scan_index[ix+1]
+
+        return Scan(self.__mass_values[begin:end],
+            self.__intensity_values[begin:end])
 
     def __get_scan_list(self):
+        if self.__scan_list == None:
+            self.__scan_list = [ self.get_scan_at_index(ii) \
+                for ii in xrange(len(self.__point_count)) ]
         return self.__scan_list
 
+    def __get_mass_values(self):
+        return self.__mass_values
+
+    def __get_intensity_values(self):
+        return self.__intensity_values
+
+    def __get_scan_index(self):
+        return self.__scan_index
+
+    def __get_point_count(self):
+        return self.__point_count
+
+    # Direct access to the raw data, don't modify
     scan_list = property(__get_scan_list)
+    mass_values = property(__get_mass_values)
+    intensity_values = property(__get_intensity_values)
+    scan_index = property(__get_scan_index)
+    point_count = property(__get_point_count)
 
     def get_tic(self):
 
@@ -252,6 +405,9 @@ class GCMS_data(object):
         @author: Andrew Isaac
         """
 
+        if self.__tic is None:
+            self.__calc_tic()
+
         return self.__tic
 
     def __calc_tic(self):
@@ -266,10 +422,13 @@ class GCMS_data(object):
         @author: Vladimir Likic
         """
 
-        intensities = []
-        for scan in self.__scan_list:
-            intensities.append(sum(scan.get_intensity_list()))
-        ia = numpy.array(intensities)
+        if self.__tic_values is not None:
+            ia = self.__tic_values.copy()
+        else:
+            N = len(self.__point_count)
+            scan_ids = numpy.repeat(numpy.arange(N), self.__point_count)
+            ia = numpy.bincount(scan_ids, weights=self.__intensity_values,
+                minlength=N)
         rt = copy.deepcopy(self.__time_list)
         tic = IonChromatogram(ia, rt)
 
@@ -303,7 +462,7 @@ class GCMS_data(object):
             print "Nothing to do."
             return # exit immediately
 
-        N = len(self.__scan_list)
+        N = len(self.__point_count)
 
         # process 'begin' and 'end'
         if begin == None:
@@ -337,21 +496,24 @@ class GCMS_data(object):
         print "Trimming data to between %d and %d scans" % \
                 (first_scan+1, last_scan+1)
 
-        scan_list_new = []
-        time_list_new = []
-        for ii in range(len(self.__scan_list)):
-            if ii >= first_scan and ii <= last_scan:
-                scan = self.__scan_list[ii]
-                time = self.__time_list[ii]
-                scan_list_new.append(scan)
-                time_list_new.append(time)
-
+        # the scans kept are contiguous in the flat arrays, so only
+        # their points are read and copied
+        begin_point = self.__scan_index[first_scan]
+        end_point = self.__scan_index[last_scan+1]
+
+        mass_values = self.__mass_values[begin_point:end_point].copy()
+        intensity_values = \
+            self.__intensity_values[begin_point:end_point].copy()
+        point_count = self.__point_count[first_scan:last_scan+1].copy()
+        time_list_new = self.__time_list[first_scan:last_scan+1]
+        if self.__tic_values is not None:
+            tic = self.__tic_values[first_scan:last_scan+1].copy()
+        else:
+            tic = None
 
         # update info
-        self.__scan_list = scan_list_new
         self.__set_time(time_list_new)
-        self.__set_min_max_mass()
-        self.__calc_tic()
+        self.__set_points(mass_values, intensity_values, point_count, tic)
 
     def info(self, print_scan_n=False):
 
@@ -370,17 +532,15 @@ class GCMS_data(object):
                 (self.__min_rt/60.0, self.__max_rt/60)
         print " Time step: %.3f s (std=%.3f s)" % ( self.__time_step, \
                 self.__time_step_std )
-        print " Number of scans: %d" % ( len(self.__scan_list) )
-        print " Minimum m/z measured: %.3f" % ( self.__min_mass )
-        print " Maximum m/z measured: %.3f" % ( self.__max_mass )
+        print " Number of scans: %d" % ( len(self.__point_count) )
+        print " Minimum m/z measured: %.3f" % ( self.get_min_mass() )
+        print " Maximum m/z measured: %.3f" % ( self.get_max_mass() )
 
         # calculate median number of m/z values measured per scan
-        n_list = []
-        for ii in range(len(self.__scan_list)):
-            scan = self.__scan_list[ii]
-            n = len(scan)
-            n_list.append(n)
-            if print_scan_n: print n
+        n_list = self.__point_count.tolist()
+        if print_scan_n:
+            for n in n_list:
+                print n
         mz_mean = mean(n_list)
         mz_median = median(n_list)
         print " Mean number of m/z values per scan: %d" % ( mz_mean )
@@ -416,32 +576,52 @@ class GCMS_data(object):
         fp1 = open_for_writing(file_name1)
         fp2 = open_for_writing(file_name2)
 
-        for ii in range(len(self.__scan_list)):
+        scan_index = self.__scan_index
 
-            scan = self.__scan_list[ii]
+        for ii in range(len(self.__point_count)):
 
-            intensity_list = scan.get_intensity_list()
-            mass_list = scan.get_mass_list()
+            begin = scan_index[ii]
+            end = scan_index[ii+1]
 
-            for ii in range(len(intensity_list)):
-                v = intensity_list[ii]
-                if ii == 0:
-                    fp1.write("%.4f" % (v))
-                else:
-                    fp1.write(",%.4f" % (v))
+            intensity_list = self.__intensity_values[begin:end].tolist()
+            mass_list = self.__mass_values[begin:end].tolist()
+
+            fp1.write(",".join([ "%.4f" % (v) for v in intensity_list ]))
             fp1.write("\n")
 
-            for ii in range(len(mass_list)):
-                v = mass_list[ii]
-                if ii == 0:
-                    fp2.write("%.4f" % (v))
-                else:
-                    fp2.write(",%.4f" % (v))
+            fp2.write(",".join([ "%.4f" % (v) for v in mass_list ]))
             fp2.write("\n")
 
         close_for_writing(fp1)
         close_for_writing(fp2)
 
+    def save(self, file_name, compress=False):
+
+        """
+        @summary: Saves the raw data to an array container file
+
+            The data can be loaded again, optionally memory mapped,
+            with pyms.GCMS.Function.load_gcms_data().
+
+        @param file_name: Output file name
+        @type file_name: StringType
+        @param compress: Whether to compress the data. Compressed data
+            cannot be memory mapped
+        @type compress: BooleanType
+        """
+
+        if not is_str(file_name):
+            error("'file_name' must be a string")
+
+        arrays = [('time_list', numpy.asarray(self.__time_list, dtype='d')),
+            ('mass_values', self.__mass_values),
+            ('intensity_values', self.__intensity_values),
+            ('point_count', self.__point_count)]
+        if self.__tic_values is not None:
+            arrays.append(('tic', self.__tic_values))
+
+        write_container(file_name, arrays, {'kind':'GCMS_data'}, compress)
+
     def write_intensities_stream(self, file_name):
 
         """
@@ -461,25 +641,53 @@ class GCMS_data(object):
         if not is_str(file_name):
             error("'file_name' must be a string")
 
-        N = len(self.__scan_list)
-
         print" -> Writing scans to a file"
 
         fp = open_for_writing(file_name)
 
-        for ii in range(len(self.__scan_list)):
-            scan = self.__scan_list[ii]
-            intensities = scan.get_intensity_list()
-            for I in intensities:
-                fp.write("%8.4f\n" % ( I ) )
+        # the flat intensity array holds the scans one after another
+        numpy.savetxt(fp, self.__intensity_values, fmt="%8.4f")
 
         close_for_writing(fp)
 
+def _flatten_scans(scan_list):
+
+    """
+    @summary: Joins the masses and intensities of a list of scans
+        into flat arrays
+
+    @param scan_list: List of Scan objects
+    @type scan_list: ListType
+
+    @return: Flat masses, flat intensities, and the number of points
+        in each scan
+    @rtype: TupleType
+    """
+
+    point_count = numpy.array([ len(scan) for scan in scan_list ], dtype=int)
+
+    if point_count.sum() > 0:
+        mass_values = numpy.concatenate([ numpy.asarray(scan.mass_list,
+            dtype='d') for scan in scan_list ])
+        intensity_values = numpy.concatenate([
+            numpy.asarray(scan.intensity_list, dtype='d') \
+            for scan in scan_list ])
+    else:
+        mass_values = numpy.zeros(0, dtype='d')
+        intensity_values = numpy.zeros(0, dtype='d')
+
+    return mass_values, intensity_values, point_count
+
 class Scan(object):
 
     """
     @summary: Generic object for a single Scan's raw data
 
+        A scan holds either python lists, or numpy arrays which may
+        be views of the raw data in a GCMS_data object. A scan
+        may have no points, in which case its min and max mass
+        are None.
+
     @author: Qiao Wang
     @author: Andrew Isaac
     @author: Vladimir Likic
@@ -501,16 +709,26 @@ class Scan(object):
         @author: Vladimir Likic
         """
 
-        if not is_list(mass_list) or not is_number(mass_list[0]):
+        if not is_list(mass_list) or (not is_array(mass_list) and \
+           len(mass_list) > 0 and not is_number(mass_list[0])):
             error("'mass_list' must be a list of numbers")
-        if not is_list(intensity_list) or \
-           not is_number(intensity_list[0]):
+        if not is_list(intensity_list) or (not is_array(intensity_list) and \
+           len(intensity_list) > 0 and not is_number(intensity_list[0])):
             error("'intensity_list' must be a list of numbers")
+        if len(mass_list) != len(intensity_list):
+            error("'mass_list' and 'intensity_list' differ in length")
 
         self.__mass_list = mass_list
         self.__intensity_list = intensity_list
-        self.__min_mass = min(mass_list)
-        self.__max_mass = max(mass_list)
+        if len(mass_list) == 0:
+            self.__min_mass = None
+            self.__max_mass = None
+        elif is_array(mass_list):
+            self.__min_mass = float(mass_list.min())
+            self.__max_mass = float(mass_list.max())
+        else:
+            self.__min_mass = min(mass_list)
+            self.__max_mass = max(mass_list)
 
     def __len__(self):
 
@@ -537,7 +755,9 @@ class Scan(object):
         @author: Andrew Isaac
         @author: Vladimir Likic
         """
- 
+
+        if is_array(self.__mass_list):
+            return self.__mass_list.tolist()
         return copy.deepcopy(self.__mass_list)
 
     def __get_mass_list(self):
@@ -558,7 +778,9 @@ class Scan(object):
         @author: Andrew Isaac
         @author: Vladimir Likic
         """
-       
+
+        if is_array(self.__intensity_list):
+            return self.__intensity_list.tolist()
         return copy.deepcopy(self.__intensity_list)
 
     def __get_intensity_list(self):
@@ -572,7 +794,7 @@ class Scan(object):
         """
         @summary: Returns the minimum m/z value in the scan
 
-        @return: Minimum m/z
+        @return: Minimum m/z, or None if the scan has no points
         @rtype: Float
 
         @author: Andrew Isaac
@@ -585,7 +807,7 @@ class Scan(object):
         """
         @summary: Returns the maximum m/z value in the scan
 
-        @return: Maximum m/z
+        @return: Maximum m/z, or None if the scan has no points
         @rtype: Float
 
         @author: Andrew Isaac
@@ -612,8 +834,10 @@ class IntensityMatrix(object):
         @param mass_list: Binned mass values
         @type mass_list: ListType
 
-        @param intensity_matrix: Binned intensity values per scan
-        @type intensity_matrix: ListType
+        @param intensity_matrix: Binned intensity values per scan, as
+            a list of lists or a two dimensional numpy array (scan by
+            m/z)
+        @type intensity_matrix: ListType or numpy.ndarray
 
         @author: Andrew Isaac
         """
@@ -633,15 +857,24 @@ class IntensityMatrix(object):
             error("'mass_list' is not the same size as 'intensity_matrix'"
                 " width")
 
+        # The intensities are held in a single contiguous two dimensional
+        # array of floats (scan by m/z). Rows and columns of this array
+        # can be accessed without copying through the 'intensity_array'
+        # property.
+        intensity_array = numpy.ascontiguousarray(intensity_matrix, dtype='d')
+        if intensity_array.ndim != 2:
+            error("'intensity_matrix' must be two dimensional")
+
         self.__time_list = time_list
+        # sorted times for binary search
+        self.__time_array = numpy.array(time_list, dtype='d')
         self.__mass_list = mass_list
-        self.__intensity_matrix = intensity_matrix
+        self.__intensity_array = intensity_array
 
         self.__min_mass = min(mass_list)
         self.__max_mass = max(mass_list)
 
-        # Direct access for speed (DANGEROUS)
-        self.intensity_matrix = self.__intensity_matrix
+        self.__set_mass_axis()
 
         # Try to include parallelism.
         try:
@@ -649,7 +882,7 @@ class IntensityMatrix(object):
             comm = MPI.COMM_WORLD
             num_ranks = comm.Get_size()
             rank = comm.Get_rank()
-            M, N = len(intensity_matrix), len(intensity_matrix[0])
+            M, N = intensity_array.shape
             lrr = (rank*M/num_ranks, (rank + 1)*M/num_ranks)
             lcr = (rank*N/num_ranks, (rank + 1)*N/num_ranks)
             m, n = (lrr[1] - lrr[0], lcr[1] - lcr[0])
@@ -667,6 +900,81 @@ class IntensityMatrix(object):
         except:
             pass
 
+    def __setstate__(self, state):
+
+        """
+        @summary: Restores a pickled IntensityMatrix
+
+            Intensity matrices pickled before the intensities were held
+            in a numpy array store them as a list of lists. These are
+            converted on loading.
+
+        @param state: The pickled attributes
+        @type state: DictType
+        """
+
+        old_key = '_IntensityMatrix__intensity_matrix'
+        if state.has_key(old_key):
+            state['_IntensityMatrix__intensity_array'] = \
+                numpy.ascontiguousarray(state.pop(old_key), dtype='d')
+            if state.has_key('intensity_matrix'):
+                del state['intensity_matrix']
+
+        self.__dict__.update(state)
+        if not state.has_key('_IntensityMatrix__time_array'):
+            self.__time_array = numpy.array(self.__time_list, dtype='d')
+        if not state.has_key('_IntensityMatrix__mass_array'):
+            self.__set_mass_axis()
+
+    def __set_mass_axis(self):
+
+        """
+        @summary: Records the mass axis for nearest mass lookups
+
+            Binned masses are normally evenly spaced (see
+            pyms.GCMS.Function.build_intensity_matrix()). The spacing and
+            first mass of such an axis are recorded, so that the nearest
+            mass can be found arithmetically. Otherwise the masses are
+            searched.
+        """
+
+        mass_array = numpy.array(self.__mass_list, dtype='d')
+
+        self.__mass_array = mass_array
+        self.__mass_origin = None
+        self.__mass_step = None
+        self.__mass_sorted = bool(numpy.all(numpy.diff(mass_array) > 0))
+
+        if self.__mass_sorted and len(mass_array) > 1:
+            step = (mass_array[-1] - mass_array[0])/(len(mass_array) - 1)
+            axis = mass_array[0] + step*numpy.arange(len(mass_array))
+            if numpy.abs(mass_array - axis).max() <= 1.0e-6*step:
+                self.__mass_origin = float(mass_array[0])
+                self.__mass_step = float(step)
+
+    def __get_intensity_array(self):
+        return self.__intensity_array
+
+    # Direct access for speed (DANGEROUS). 'intensity_matrix' is kept
+    # for code written against the list of lists representation, the
+    # array supports the same mat[scan][ii] indexing.
+    intensity_array = property(__get_intensity_array)
+    intensity_matrix = property(__get_intensity_array)
+
+    def get_intensity_array(self):
+
+        """
+        @summary: Returns the intensity matrix as a numpy array
+
+            The array is not copied, so changes made to it are
+            reflected in the intensity matrix.
+
+        @return: Intensity values (scan by m/z)
+        @rtype: numpy.ndarray
+        """
+
+        return self.__intensity_array
+
     def get_local_size(self):
         """
         @summary: Gets the local size of intensity matrix.
@@ -698,8 +1006,7 @@ class IntensityMatrix(object):
         @author: Vladimir Likic
         """
 
-        n_scan = len(self.__intensity_matrix)
-        n_mz = len(self.__intensity_matrix[0])
+        n_scan, n_mz = self.__intensity_array.shape
 
         return n_scan, n_mz
 
@@ -723,7 +1030,7 @@ class IntensityMatrix(object):
 
         else:
             # Iterate over global indices.
-            n_scan = len(self.__intensity_matrix)
+            n_scan = self.__intensity_array.shape[0]
             for i in xrange(0, n_scan):
                 yield i
 
@@ -747,7 +1054,7 @@ class IntensityMatrix(object):
 
         else:
             # Iterate over global indices.
-            n_mz = len(self.__intensity_matrix[0])
+            n_mz = self.__intensity_array.shape[1]
             for i in xrange(0, n_mz):
                 yield i
 
@@ -777,20 +1084,10 @@ class IntensityMatrix(object):
         ia = ic.get_intensity_array()
 
         # check if the dimension is ok
-        if len(ia) != len(self.__intensity_matrix):
+        if len(ia) != self.__intensity_array.shape[0]:
             error("ion chromatogram incompatible with the intensity matrix")
-        else:
-           N = len(ia)
-
-        # Convert 'ia' to a list. By convention, the attribute
-        # __intensity_matrix of the class IntensityMatrix is a list
-        # of lists. This makes pickling instances of IntensityMatrix
-        # practically possible, since pickling numpy.array objects
-        # produces ten times larger files compared to pickling python
-        #lists.
-        ial = ia.tolist()
-        for i in range(N):
-            self.__intensity_matrix[i][ix] = ial[i]
+
+        self.__intensity_array[:,ix] = ia
 
     def get_ic_at_index(self, ix):
 
@@ -812,13 +1109,10 @@ class IntensityMatrix(object):
         if not is_int(ix):
             error("index not an integer")
         try:
-            ia = []
-            for i in range(len(self.__intensity_matrix)):
-                ia.append(self.__intensity_matrix[i][ix])
+            ic_ia = self.__intensity_array[:,ix].copy()
         except IndexError:
             error("index out of bounds.")
 
-        ic_ia = numpy.array(ia)
         mass = self.get_mass_at_index(ix)
         rt = copy.deepcopy(self.__time_list)
 
@@ -909,10 +1203,10 @@ class IntensityMatrix(object):
         if not is_int(ix):
             error("index not an integer")
 
-        if ix < 0 or ix >= len(self.__intensity_matrix):
+        if ix < 0 or ix >= self.__intensity_array.shape[0]:
             error("index out of range")
 
-        return copy.deepcopy(self.__intensity_matrix[ix])
+        return self.__intensity_array[ix].tolist()
 
     def get_min_mass(self):
 
@@ -978,13 +1272,72 @@ class IntensityMatrix(object):
         @author: Andrew Isaac
         """
 
-        best = self.__max_mass
-        ix = 0
-        for ii in range(len(self.__mass_list)):
-            tmp = abs(self.__mass_list[ii] - mass)
-            if tmp < best:
-                best = tmp
-                ix = ii
+        mass_array = self.__mass_array
+        n = len(mass_array)
+
+        if self.__mass_step is not None:
+            # position on the regular mass axis
+            ix = int(round((mass - self.__mass_origin)/self.__mass_step))
+            ix = min(max(ix, 0), n-1)
+        elif self.__mass_sorted:
+            ix = min(int(numpy.searchsorted(mass_array, mass)), n-1)
+        else:
+            ix = int(numpy.argmin(numpy.abs(mass_array - mass)))
+
+        # settle on the nearest neighbour, the lower index on ties
+        while ix > 0 and abs(mass_array[ix-1] - mass) <= \
+                abs(mass_array[ix] - mass):
+            ix = ix - 1
+        while ix < n-1 and abs(mass_array[ix+1] - mass) < \
+                abs(mass_array[ix] - mass):
+            ix = ix + 1
+
+        # as in a search seeded with the largest mass as the best
+        # distance, no mass that near gives the first index
+        if not abs(mass_array[ix] - mass) < self.__max_mass:
+            ix = 0
+
+        return ix
+
+    def get_indices_of_masses(self, masses):
+
+        """
+        @summary: Returns the indices of the masses nearest to each of
+            the given masses
+
+        @param masses: Masses to lookup in list of masses
+        @type masses: ListType or numpy.ndarray
+
+        @return: Index of mass closest to each given mass
+        @rtype: numpy.ndarray
+        """
+
+        masses = numpy.asarray(masses, dtype='d')
+        mass_array = self.__mass_array
+        n = len(mass_array)
+
+        if self.__mass_step is not None:
+            ix = numpy.round((masses - self.__mass_origin)/self.__mass_step)
+            ix = numpy.clip(ix, 0, n-1).astype(int)
+        elif self.__mass_sorted:
+            ix = numpy.minimum(numpy.searchsorted(mass_array, masses), n-1)
+        else:
+            ix = numpy.abs(mass_array[numpy.newaxis,:] - \
+                masses[:,numpy.newaxis]).argmin(axis=1)
+
+        # settle on the nearest neighbour, the lower index on ties
+        lower = numpy.maximum(ix-1, 0)
+        lower_nearer = numpy.abs(mass_array[lower] - masses) <= \
+            numpy.abs(mass_array[ix] - masses)
+        ix = numpy.where(lower_nearer, lower, ix)
+        upper = numpy.minimum(ix+1, n-1)
+        upper_nearer = numpy.abs(mass_array[upper] - masses) < \
+            numpy.abs(mass_array[ix] - masses)
+        ix = numpy.where(upper_nearer, upper, ix)
+
+        ix[numpy.logical_not(numpy.abs(mass_array[ix] - masses) < \
+            self.__max_mass)] = 0
+
         return ix
 
     def get_matrix_list(self):
@@ -999,7 +1352,7 @@ class IntensityMatrix(object):
         @author: Andrew Isaac
         """
 
-        return copy.deepcopy(self.__intensity_matrix)
+        return self.__intensity_array.tolist()
 
     def get_time_list(self):
 
@@ -1030,26 +1383,22 @@ class IntensityMatrix(object):
         @author: Vladimir Likic
         """
 
-        if not is_number(time):
-            error("'time' must be a number")
+        return nearest_time_index(self.__time_array, time)
 
-        if time < min(self.__time_list) or time > max(self.__time_list):
-            error("time %.2f is out of bounds (min: %.2f, max: %.2f)" %
-                  (time, self.__min_rt, self.__max_rt))
+    def get_indices_at_times(self, times):
 
-        time_list = self.__time_list
-        time_diff_min = max(self.__time_list)
-        ix_match = None
-
-        for ix in range(len(time_list)):
+        """
+        @summary: Returns the nearest index corresponding to each of
+            the given times
 
-            time_diff = math.fabs(time-time_list[ix])
+        @param times: Times in seconds
+        @type times: ListType or numpy.ndarray
 
-            if time_diff < time_diff_min:
-                ix_match = ix
-                time_diff_min = time_diff
+        @return: Nearest index corresponding to each time
+        @rtype: numpy.ndarray
+        """
 
-        return ix_match
+        return nearest_time_indices(self.__time_array, times)
 
     def crop_mass(self, mass_min, mass_max):
 
@@ -1089,17 +1438,15 @@ class IntensityMatrix(object):
                  ii_list.append(ii)
 
         # update intensity matrix
-        im = self.__intensity_matrix
-        for spec_jj in range(len(im)):
-            new_spec = []
-            for ii in ii_list:
-                new_spec.append(im[spec_jj][ii])
-            im[spec_jj] = new_spec
+        self.__intensity_array = \
+            self.__intensity_array.take(ii_list, axis=1)
 
         self.__mass_list = new_mass_list
         self.__min_mass = min(new_mass_list)
         self.__max_mass = max(new_mass_list)
 
+        self.__set_mass_axis()
+
     def null_mass(self, mass):
 
         """
@@ -1119,9 +1466,7 @@ class IntensityMatrix(object):
 
         ii = self.get_index_of_mass(mass)
 
-        im = self.__intensity_matrix
-        for spec_jj in range(len(im)):
-            im[spec_jj][ii] = 0
+        self.__intensity_array[:,ii] = 0
 
     def reduce_mass_spectra(self, N=5):
 
@@ -1135,27 +1480,43 @@ class IntensityMatrix(object):
         @author: Vladimir Likic
         """
 
-        # loop over all mass spectral scans
-        for ii in range(len(self.__intensity_matrix)):
+        im = self.__intensity_array
+
+        # indices of the top N intensities in each scan. A stable sort
+        # on negated intensities keeps the lower index first for ties
+        top_indices = numpy.argsort(-im, axis=1, kind='mergesort')[:,:N]
+
+        # retain only the top N intensities
+        im_new = numpy.zeros(im.shape, dtype='d')
+        rows = numpy.arange(im.shape[0])[:,numpy.newaxis]
+        im_new[rows, top_indices] = im[rows, top_indices]
+
+        self.__intensity_array = im_new
+
+    def save(self, file_name, compress=False):
+
+        """
+        @summary: Saves the intensity matrix to an array container file
 
-            # get the next mass spectrum as list of intensities
-            intensity_list = self.__intensity_matrix[ii]
-            n = len(intensity_list)
+            The matrix can be loaded again, optionally memory mapped,
+            with pyms.GCMS.Function.load_intensity_matrix().
 
-            # get the indices of top N intensities
-            top_indices = range(n)
-            top_indices.sort(key=lambda i: intensity_list[i], reverse=True)
-            top_indices = top_indices[:N]
+        @param file_name: Output file name
+        @type file_name: StringType
+        @param compress: Whether to compress the intensities.
+            Compressed matrices cannot be memory mapped
+        @type compress: BooleanType
+        """
 
-            # initiate new mass spectrum, and retain only top N intensities
-            intensity_list_new = []
+        if not is_str(file_name):
+            error("'file_name' must be a string")
 
-            for jj in range(n):
-                intensity_list_new.append(0.0)
-                if jj in top_indices:
-                    intensity_list_new[jj] = intensity_list[jj]
+        arrays = [('time_list', numpy.asarray(self.__time_list, dtype='d')),
+            ('mass_list', numpy.asarray(self.__mass_list)),
+            ('intensity_array', self.__intensity_array)]
 
-            self.__intensity_matrix[ii] = intensity_list_new
+        write_container(file_name, arrays, {'kind':'IntensityMatrix'},
+            compress)
 
     def export_ascii(self, root_name, format='dat'):
 
@@ -1193,7 +1554,7 @@ class IntensityMatrix(object):
             error("unkown format '%s'. Only 'dat' or 'csv' supported" % format)
 
         # export 2D matrix of intensities
-        vals = self.__intensity_matrix
+        vals = self.__intensity_array
         save_data(root_name+'.im'+extension, vals, sep=separator)
 
         # export 1D vector of m/z's, corresponding to rows of
@@ -1226,7 +1587,7 @@ class IntensityMatrix(object):
 
         mass_list = self.__mass_list
         time_list = self.__time_list
-        vals = self.__intensity_matrix
+        vals = self.__intensity_array
 
         fp = open_for_writing(file_name)
 
@@ -1351,9 +1712,9 @@ class IntensityMatrix(object):
 
         self.__mass_list = mass_list
         self.__time_list = time_list
-        self.__intensity_matrix = data
-        # Direct access for speed (DANGEROUS)
-        self.intensity_matrix = self.__intensity_matrix
+        self.__time_array = numpy.array(time_list, dtype='d')
+        self.__intensity_array = numpy.array(data, dtype='d')
+        self.__set_mass_axis()
 
 ## get_ms_at_time()
 
@@ -1402,11 +1763,27 @@ class IonChromatogram(object):
 
         self.__ia = ia
         self.__time_list = time_list
+        # sorted times for binary search
+        self.__time_array = numpy.array(time_list, dtype='d')
         self.__mass = mass
         self.__time_step = self.__calc_time_step(time_list)
         self.__min_rt = min(time_list)
         self.__max_rt = max(time_list)
 
+    def __setstate__(self, state):
+
+        """
+        @summary: Restores a pickled IonChromatogram, adding the
+            sorted times to objects pickled without them
+
+        @param state: The pickled attributes
+        @type state: DictType
+        """
+
+        self.__dict__.update(state)
+        if not state.has_key('_IonChromatogram__time_array'):
+            self.__time_array = numpy.array(self.__time_list, dtype='d')
+
     def __len__(self):
 
         """
@@ -1581,27 +1958,22 @@ class IonChromatogram(object):
         @author: Vladimir Likic
         """
 
-        if not is_number(time):
-            error("'time' must be a number")
+        return nearest_time_index(self.__time_array, time)
 
-        if time < self.__min_rt or time > self.__max_rt:
-            error("time %.2f is out of bounds (min: %.2f, max: %.2f)" %
-                  (time, self.__min_rt, self.__max_rt))
-
-        time_list = self.__time_list
-        time_diff_min = self.__max_rt
-        ix_match = None
-
-        for ix in range(len(time_list)):
+    def get_indices_at_times(self, times):
 
+        """
+        @summary: Returns the nearest index corresponding to each of
+            the given times
 
-            time_diff = math.fabs(time-time_list[ix])
+        @param times: Times in seconds
+        @type times: ListType or numpy.ndarray
 
-            if time_diff < time_diff_min:
-                ix_match = ix
-                time_diff_min = time_diff
+        @return: Nearest index corresponding to each time
+        @rtype: numpy.ndarray
+        """
 
-        return ix_match
+        return nearest_time_indices(self.__time_array, times)
 
     def is_tic(self):
 
@@ -1725,3 +2097,58 @@ class MassSpectrum(object):
 
         return len(self.mass_list)
 
+
+class SparseMassSpectrum(MassSpectrum):
+
+    """
+    @summary: Models a binned mass spectrum that holds only its nonzero
+        intensities
+
+        The mass list is kept whole, and may be shared with other
+        spectra. The intensities are held as the indices of the nonzero
+        bins and their values. The 'mass_spec' attribute gives the full
+        list of intensities as a numpy array, and may be assigned to.
+
+        Each read of 'mass_spec' builds a new array, so changing its
+        elements does not change the spectrum. Changed intensities must
+        be assigned back to 'mass_spec'.
+    """
+
+    def __init__(self, mass_list, indices, intensities):
+
+        """
+        @summary: Initialise the SparseMassSpectrum
+
+        @param mass_list: List of binned masses
+        @type mass_list: ListType
+        @param indices: Indices in 'mass_list' of the nonzero intensities
+        @type indices: ListType or numpy.ndarray
+        @param intensities: The nonzero intensities
+        @type intensities: ListType or numpy.ndarray
+        """
+
+        if not is_list(mass_list) or not is_number(mass_list[0]):
+            error("'mass_list' must be a list of numbers")
+        if not len(indices) == len(intensities):
+            error("'indices' is not the same size as 'intensities'")
+
+        indices = numpy.array(indices, dtype='i')
+        if len(indices) > 0 and \
+           (indices.min() < 0 or indices.max() >= len(mass_list)):
+            error("'indices' out of range of 'mass_list'")
+
+        self.mass_list = mass_list
+        self.indices = indices
+        self.intensities = numpy.array(intensities, dtype='d')
+
+    def __get_mass_spec(self):
+        mass_spec = numpy.zeros(len(self.mass_list), dtype='d')
+        mass_spec[self.indices] = self.intensities
+        return mass_spec
+
+    def __set_mass_spec(self, intensity_list):
+        intensity_array = numpy.asarray(intensity_list, dtype='d')
+        self.indices = numpy.nonzero(intensity_array)[0].astype('i')
+        self.intensities = intensity_array[self.indices]
+
+    mass_spec = property(__get_mass_spec, __set_mass_spec)
@@ -23,12 +23,17 @@ Provides conversion and information functions for GC-MS data objects
  #############################################################################
 
 import math, sys
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import numpy
 
 from pyms.Utils.Error import error
 from pyms.Utils.Utils import is_number, is_str, is_array, is_list, is_int
 from pyms.GCMS.Class import GCMS_data, IntensityMatrix, IonChromatogram
 from pyms.Utils.Time import time_str_secs
 from pyms.Utils.Math import rmsd
+from pyms.Utils.IO import read_container
 
 # If psyco is installed, use it to speed up running time
 try:
@@ -76,7 +81,8 @@ def build_intensity_matrix(data, bin_interval=1, bin_left=0.5, bin_right=0.5):
 
     return __fill_bins(data, min_mass, max_mass, bin_interval, bin_left, bin_right)
 
-def build_intensity_matrix_i(data, bin_left=0.3, bin_right=0.7):
+def build_intensity_matrix_i(data, bin_left=0.3, bin_right=0.7,
+    min_mass=None, max_mass=None):
 
     """
     @summary: Sets the full intensity matrix with integer bins
@@ -90,6 +96,14 @@ def build_intensity_matrix_i(data, bin_left=0.3, bin_right=0.7):
     @param bin_right: right bin boundary offset (default 0.7)
     @type bin_right: FloatType
 
+    @param min_mass: minimum mass value. If None, the minimum mass of
+        the data
+    @type min_mass: IntType or FloatType
+
+    @param max_mass: maximum mass value. If None, the maximum mass of
+        the data
+    @type max_mass: IntType or FloatType
+
     @return: Binned IntensityMatrix object
     @rtype: pyms.GCMS.Class.IntensityMatrix
 
@@ -105,8 +119,14 @@ def build_intensity_matrix_i(data, bin_left=0.3, bin_right=0.7):
     if not is_number(bin_right):
         error("'bin_right' must be a number.")
 
-    min_mass = data.get_min_mass()
-    max_mass = data.get_max_mass()
+    if min_mass == None:
+        min_mass = data.get_min_mass()
+    elif not is_number(min_mass):
+        error("'min_mass' must be a number")
+    if max_mass == None:
+        max_mass = data.get_max_mass()
+    elif not is_number(max_mass):
+        error("'max_mass' must be a number")
 
     # Calculate integer min mass based on right boundary
     bin_right = abs(bin_right)
@@ -114,41 +134,42 @@ def build_intensity_matrix_i(data, bin_left=0.3, bin_right=0.7):
 
     return __fill_bins(data, min_mass, max_mass, 1, bin_left, bin_right)
 
-def __fill_bins(data, min_mass, max_mass, bin_interval, bin_left, bin_right):
+def build_intensity_matrix_stream(scan_iter, min_mass, max_mass,
+    bin_interval=1, bin_left=0.5, bin_right=0.5):
 
     """
-    @summary: Fills the intensity values for all bins
-
-    @param data: Raw GCMS data
-    @type data: pyms.GCMS.Class.GCMS_data
-    @param min_mass: minimum mass value
+    @summary: Sets the intensity matrix with flexible bins from a
+        stream of scans
+
+        Each scan is binned as soon as it is received, so only the
+        binned intensities are held in memory. Bins are assigned as
+        in build_intensity_matrix(). Points outside the mass range
+        are discarded.
+
+    @param scan_iter: Scans as (retention time, masses, intensities),
+        for example from a reader generator
+    @type scan_iter: An iterable of TupleType
+    @param min_mass: Centre of the first bin
     @type min_mass: IntType or FloatType
-    @param max_mass: maximum mass value
+    @param max_mass: Largest mass to be binned
     @type max_mass: IntType or FloatType
-    @param bin_interval: interval between bin centres
+    @param bin_interval: interval between bin centres (default 1)
     @type bin_interval: IntType or FloatType
-    @param bin_left: left bin boundary offset
+    @param bin_left: left bin boundary offset (default 0.5)
     @type bin_left: FloatType
-    @param bin_right: right bin boundary offset
+    @param bin_right: right bin boundary offset (default 0.5)
     @type bin_right: FloatType
 
     @return: Binned IntensityMatrix object
     @rtype: pyms.GCMS.Class.IntensityMatrix
-
-    @author: Qiao Wang
-    @author: Andrew Isaac
-    @author: Moshe Olshansky
-    @author: Vladimir Likic
     """
 
-    if not isinstance(data, GCMS_data):
-        error("data must be an GCMS_data object")
     if not is_number(min_mass):
         error("'min_mass' must be a number")
     if not is_number(max_mass):
         error("'max_mass' must be a number")
-    if not is_number(bin_interval):
-        error("'bin_interval' must be a number")
+    if bin_interval <= 0:
+        error("The bin interval must be larger than zero.")
     if not is_number(bin_left):
         error("'bin_left' must be a number.")
     if not is_number(bin_right):
@@ -168,26 +189,24 @@ def __fill_bins(data, min_mass, max_mass, bin_interval, bin_left, bin_right):
     # initialise masses to bin centres
     mass_list = [i * bin_interval + min_mass for i in xrange(num_bins)]
 
-    # Modified binning loops. I've replaced the deepcopy getting routines with
-    # the alias properties. This way we can avoid performing the copies when
-    # it is clear that we do not intend on modifying the contents of the arrays
-    # here.
-    #           - Luke Hodkinson, 18/05/2010
+    time_list = []
+    rows = []
+    for time, masses, intensities in scan_iter:
+        masses = numpy.asarray(masses, dtype='d')
+        intensities = numpy.asarray(intensities, dtype='d')
+        offsets = (masses + bl - min_mass)/bin_interval
+        bin_ids = offsets.astype(int)
+        keep = numpy.logical_and(offsets >= 0, bin_ids < num_bins)
+        rows.append(numpy.bincount(bin_ids[keep], weights=intensities[keep],
+            minlength=num_bins))
+        time_list.append(time)
 
-    # fill the bins
-    intensity_matrix = []
-    for scan in data.scan_list: # use the alias, not the copy (Luke)
-        intensity_list = [0.0] * num_bins
-        masses = scan.mass_list # use the alias, not the copy (Luke)
-        intensities = scan.intensity_list # use the alias, not the copy (Luke)
-        for ii in xrange(len(masses)):
-            mm = int((masses[ii] + bl - min_mass)/bin_interval)
-            intensity_list[mm] += intensities[ii]
-        intensity_matrix.append(intensity_list)
+    if len(rows) == 0:
+        error("no scans to bin")
 
-    return IntensityMatrix(data.get_time_list(), mass_list, intensity_matrix)
+    return IntensityMatrix(time_list, mass_list, numpy.array(rows))
 
-def __fill_bins_old(data, min_mass, max_mass, bin_interval, bin_left, bin_right):
+def __fill_bins(data, min_mass, max_mass, bin_interval, bin_left, bin_right):
 
     """
     @summary: Fills the intensity values for all bins
@@ -210,9 +229,13 @@ def __fill_bins_old(data, min_mass, max_mass, bin_interval, bin_left, bin_right)
 
     @author: Qiao Wang
     @author: Andrew Isaac
+    @author: Moshe Olshansky
     @author: Vladimir Likic
     """
 
+    # The bin assignment and accumulation are done for all scans in a
+    # single pass over flat arrays of masses and intensities.
+
     if not isinstance(data, GCMS_data):
         error("data must be an GCMS_data object")
     if not is_number(min_mass):
@@ -225,6 +248,8 @@ def __fill_bins_old(data, min_mass, max_mass, bin_interval, bin_left, bin_right)
         error("'bin_left' must be a number.")
     if not is_number(bin_right):
         error("'bin_right' must be a number.")
+    if not (abs(bin_left+bin_right-bin_interval) < 1.0e-6*bin_interval):
+        error("there should be no gaps or overlap.")
 
     bin_left = abs(bin_left)
     bin_right = abs(bin_right)
@@ -238,20 +263,73 @@ def __fill_bins_old(data, min_mass, max_mass, bin_interval, bin_left, bin_right)
     # initialise masses to bin centres
     mass_list = [i * bin_interval + min_mass for i in xrange(num_bins)]
 
-    # fill the bins
-    intensity_matrix = []
-    for scan in data.get_scan_list():
-        intensity_list = [0.0] * num_bins
-        masses = scan.get_mass_list()
-        intensities = scan.get_intensity_list()
-        for mm in xrange(num_bins):
-            for ii in xrange(len(scan)):
-                if masses[ii] >= mass_list[mm]-bin_left and \
-                masses[ii] < mass_list[mm]+bin_right:
-                    intensity_list[mm] += intensities[ii]
-        intensity_matrix.append(intensity_list)
-
-    return IntensityMatrix(data.get_time_list(), mass_list, intensity_matrix)
+    # use the flat arrays of the raw data, not copies unless they
+    # are stored in another precision
+    masses = numpy.asarray(data.mass_values, dtype='d')
+    intensities = numpy.asarray(data.intensity_values, dtype='d')
+    num_scans = len(data)
+    scan_ids = numpy.repeat(numpy.arange(num_scans), data.point_count)
+
+    # bin index of each point, truncated as int() does
+    bin_ids = ((masses + bl - min_mass)/bin_interval).astype(int)
+    if len(bin_ids) > 0 and (bin_ids.min() < 0 or bin_ids.max() >= num_bins):
+        error("mass values outside the range of the bins")
+
+    # fill the bins. bincount() accumulates in the order of the points,
+    # as the loop over the scans would
+    intensity_array = numpy.bincount(scan_ids*num_bins + bin_ids,
+        weights=intensities, minlength=num_scans*num_bins)
+    intensity_array = intensity_array.reshape((num_scans, num_bins))
+
+    return IntensityMatrix(data.get_time_list(), mass_list, intensity_array)
+
+def load_intensity_matrix(file_name, mmap=False):
+
+    """
+    @summary: Loads an intensity matrix saved with IntensityMatrix.save()
+
+    @param file_name: Name of the file
+    @type file_name: StringType
+    @param mmap: If True, the intensities are memory mapped rather
+        than read. Changes to the matrix are not written to the file
+    @type mmap: BooleanType
+
+    @return: The intensity matrix
+    @rtype: pyms.GCMS.Class.IntensityMatrix
+    """
+
+    attrs, arrays = read_container(file_name, mmap=mmap)
+
+    if attrs.get('kind') != 'IntensityMatrix':
+        error("'%s' does not hold an intensity matrix" % (file_name))
+
+    return IntensityMatrix(arrays['time_list'].tolist(),
+        arrays['mass_list'].tolist(), arrays['intensity_array'])
+
+def load_gcms_data(file_name, mmap=False):
+
+    """
+    @summary: Loads raw data saved with GCMS_data.save()
+
+    @param file_name: Name of the file
+    @type file_name: StringType
+    @param mmap: If True, the masses and intensities are memory mapped
+        rather than read, and are only read when used
+    @type mmap: BooleanType
+
+    @return: The raw data
+    @rtype: pyms.GCMS.Class.GCMS_data
+    """
+
+    attrs, arrays = read_container(file_name, mmap=mmap)
+
+    if attrs.get('kind') != 'GCMS_data':
+        error("'%s' does not hold GC-MS data" % (file_name))
+
+    return GCMS_data(arrays['time_list'].tolist(),
+        mass_values=arrays['mass_values'],
+        intensity_values=arrays['intensity_values'],
+        point_count=arrays['point_count'], tic=arrays.get('tic'))
 
 def diff(data1, data2):
 
@@ -409,3 +487,93 @@ def ic_window_points(ic, window_sele, half_window=False):
 
     return points
 
+def map_ic_columns(im, ia_filter, args=(), processes=None):
+
+    """
+    @summary: Applies a filter to each ion chromatogram of an intensity
+        matrix, returning a new matrix
+
+        Ion chromatograms can be filtered in parallel by a pool of
+        processes. The matrix is then held in shared memory, and each
+        process filters a share of the columns. Each column is filtered
+        the same way as in serial, so the result is identical.
+
+    @param im: The input IntensityMatrix
+    @type im: pyms.GCMS.Class.IntensityMatrix
+    @param ia_filter: A function taking the intensity array of an ion
+        chromatogram, followed by 'args', and returning the filtered
+        intensity array
+    @type ia_filter: FunctionType
+    @param args: Further arguments to 'ia_filter'
+    @type args: TupleType
+    @param processes: The number of processes. If None, the columns are
+        filtered serially
+    @type processes: IntType
+
+    @return: The filtered IntensityMatrix
+    @rtype: pyms.GCMS.Class.IntensityMatrix
+    """
+
+    if not isinstance(im, IntensityMatrix):
+        error("'im' must be an IntensityMatrix object")
+    if processes != None and (not is_int(processes) or processes < 1):
+        error("'processes' must be a positive integer")
+
+    ia = im.intensity_array
+    n_scan, n_mz = ia.shape
+
+    if processes == None or processes == 1 or n_mz < 2:
+        ia_out = numpy.empty((n_scan, n_mz), dtype='d')
+        for ii in range(n_mz):
+            ia_out[:,ii] = ia_filter(ia[:,ii], *args)
+    else:
+        shared_in = RawArray('d', n_scan*n_mz)
+        shared_out = RawArray('d', n_scan*n_mz)
+        numpy.frombuffer(shared_in, dtype='d')[:] = ia.ravel()
+
+        # a few column ranges per process, to even out the work
+        num_chunks = min(n_mz, 4*processes)
+        bounds = numpy.linspace(0, n_mz, num_chunks+1).astype(int).tolist()
+        chunks = zip(bounds[:-1], bounds[1:])
+
+        pool = multiprocessing.Pool(processes, __init_column_worker,
+            (shared_in, shared_out, (n_scan, n_mz), ia_filter, args))
+        try:
+            pool.map(__filter_columns, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+        ia_out = numpy.frombuffer(shared_out, dtype='d').reshape(n_scan, n_mz)
+
+    return IntensityMatrix(im.get_time_list(), im.get_mass_list(), ia_out)
+
+# the shared matrices and filter of a column worker process
+__column_worker = {}
+
+def __init_column_worker(shared_in, shared_out, shape, ia_filter, args):
+
+    """
+    @summary: Sets up a process of map_ic_columns()
+    """
+
+    __column_worker['in'] = numpy.frombuffer(shared_in,
+        dtype='d').reshape(shape)
+    __column_worker['out'] = numpy.frombuffer(shared_out,
+        dtype='d').reshape(shape)
+    __column_worker['filter'] = ia_filter
+    __column_worker['args'] = args
+
+def __filter_columns(bounds):
+
+    """
+    @summary: Filters a range of columns in a process of map_ic_columns()
+    """
+
+    ia_in = __column_worker['in']
+    ia_out = __column_worker['out']
+    ia_filter = __column_worker['filter']
+    args = __column_worker['args']
+
+    for ii in range(bounds[0], bounds[1]):
+        ia_out[:,ii] = ia_filter(ia_in[:,ii], *args)
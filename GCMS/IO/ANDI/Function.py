@@ -22,7 +22,7 @@ Functions for reading manufacturer specific ANDI-MS data files
  #                                                                           #
  #############################################################################
 
-import math, copy
+import math, copy, warnings
 
 import numpy
 
@@ -33,26 +33,42 @@ from pyms.Utils.Utils import is_str, is_int, is_float, is_number, is_list
 from pyms.Utils.Time import time_str_secs
 from pycdf import *
 
-def ANDI_reader(file_name):
+def ANDI_reader(file_name, lazy=False):
 
     """
     @summary: A reader for ANDI-MS NetCDF files, returns
         a GC-MS data object
 
+        Scans are split using the 'scan_index' and 'point_count'
+        variables of the file. Files without them are split where
+        the mass values decrease.
+
+        If 'lazy' is True the mass and intensity values are memory
+        mapped rather than read, and the TIC is taken from the
+        'total_intensity' variable. Points are then only read from
+        the file when they are used, so that for example trimming
+        the data to a retention time window reads only the scans
+        in the window.
+
     @param file_name: The name of the ANDI-MS file
     @type file_name: StringType
+    @param lazy: Memory map the data instead of reading it
+    @type lazy: BooleanType
 
     @author: Qiao Wang
     @author: Andrew Isaac
     @author: Vladimir Likic
     """
 
-    ## TODO: use 'point_count' and allow for zero len scans
+    if lazy:
+        return _ANDI_reader_lazy(file_name)
 
     # the keys used to retrieve certain data from the NetCDF file
     __MASS_STRING = "mass_values"
     __INTENSITY_STRING = "intensity_values"
     __TIME_STRING = "scan_acquisition_time"
+    __SCAN_INDEX = "scan_index"
+    __POINT_COUNT = "point_count"
 
     if not is_str(file_name):
         error("'file_name' must be a string")
@@ -63,50 +79,189 @@ def ANDI_reader(file_name):
 
     print " -> Reading netCDF file '%s'" % (file_name)
 
-    scan_list = []
-    mass = file.var(__MASS_STRING)
-    intensity = file.var(__INTENSITY_STRING)
-    mass_values = mass.get().tolist()
-    mass_list = []
-    mass_previous = mass_values[0]
-    mass_list.append(mass_previous)
-    intensity_values = intensity.get().tolist()
-    intensity_list = []
-    intensity_previous = intensity_values[0]
-    intensity_list.append(intensity_previous)
+    mass_values = numpy.asarray(file.var(__MASS_STRING).get(), dtype='d')
+    intensity_values = numpy.asarray(file.var(__INTENSITY_STRING).get(),
+        dtype='d')
     if not len(mass_values) == len(intensity_values):
         error("length of mass_list is not equal to length of intensity_list !")
-    for i in range(len(mass_values) - 1):
-        # assume masses in ascending order until new scan
-        if mass_previous <= mass_values[i + 1]:
-            #print mass_values[i+1]
-            mass_list.append(mass_values[i + 1])
-            mass_previous = mass_values[i + 1]
-            intensity_list.append(intensity_values[i + 1])
-            intensity_previous = intensity_values[i + 1]
-        # new scan
-        else:
-            scan_list.append(Scan(mass_list, intensity_list))
-            #print "Added scan"
-            mass_previous = mass_values[i + 1]
-            intensity_previous = intensity_values[i + 1]
-            mass_list = []
-            intensity_list = []
-            mass_list.append(mass_previous)
-            intensity_list.append(intensity_previous)
-    # store final scan
-    scan_list.append(Scan(mass_list, intensity_list))
-    time = file.var(__TIME_STRING)
-    time_list = time.get().tolist()
+
+    time_list = file.var(__TIME_STRING).get().tolist()
+
+    variables = file.variables()
+    if variables.has_key(__POINT_COUNT):
+        point_count = file.var(__POINT_COUNT).get()
+    else:
+        point_count = None
+    if variables.has_key(__SCAN_INDEX):
+        scan_index = file.var(__SCAN_INDEX).get()
+    else:
+        scan_index = None
+
+    file.close()
+
+    mass_values, intensity_values, point_count = _split_scans(mass_values,
+        intensity_values, scan_index, point_count)
 
     # sanity check
-    if not len(time_list) == len(scan_list):
-        error("number of time points (%d) does not equal the number of scans (%d)"%(len(time_list), len(scan_list)))
+    if not len(time_list) == len(point_count):
+        error("number of time points (%d) does not equal the number of scans (%d)"%(len(time_list), len(point_count)))
 
-    data = GCMS_data(time_list, scan_list)
+    data = GCMS_data(time_list, mass_values=mass_values,
+        intensity_values=intensity_values, point_count=point_count)
 
     return data
 
+def _ANDI_reader_lazy(file_name):
+
+    """
+    @summary: A reader for ANDI-MS NetCDF files which memory maps
+        the mass and intensity values, returns a GC-MS data object
+
+        This requires scipy. The memory map is kept open for as
+        long as the returned data object refers to it.
+
+    @param file_name: The name of the ANDI-MS file
+    @type file_name: StringType
+
+    @return: GC-MS data backed by the file
+    @rtype: pyms.GCMS.Class.GCMS_data
+    """
+
+    # the keys used to retrieve certain data from the NetCDF file
+    __MASS_STRING = "mass_values"
+    __INTENSITY_STRING = "intensity_values"
+    __TIME_STRING = "scan_acquisition_time"
+    __SCAN_INDEX = "scan_index"
+    __POINT_COUNT = "point_count"
+    __TOTAL_INTENSITY = "total_intensity"
+
+    try:
+        from scipy.io import netcdf
+    except ImportError:
+        error("lazy reading of ANDI-MS files requires scipy")
+
+    if not is_str(file_name):
+        error("'file_name' must be a string")
+    try:
+        file = netcdf.netcdf_file(file_name, 'r', mmap=True)
+    except (IOError, TypeError, ValueError):
+        error("Cannot open file '%s'" % file_name)
+
+    print " -> Memory mapping netCDF file '%s'" % (file_name)
+
+    variables = file.variables
+
+    # views of the memory map, nothing is read yet
+    mass_values = variables[__MASS_STRING].data
+    intensity_values = variables[__INTENSITY_STRING].data
+    if not len(mass_values) == len(intensity_values):
+        error("length of mass_list is not equal to length of intensity_list !")
+
+    # per scan variables are small, and are read
+    time_list = variables[__TIME_STRING].data.tolist()
+    if variables.has_key(__POINT_COUNT):
+        point_count = numpy.array(variables[__POINT_COUNT].data)
+    else:
+        point_count = None
+    if variables.has_key(__SCAN_INDEX):
+        scan_index = numpy.array(variables[__SCAN_INDEX].data)
+    else:
+        scan_index = None
+    if variables.has_key(__TOTAL_INTENSITY):
+        tic = numpy.array(variables[__TOTAL_INTENSITY].data, dtype='d')
+    else:
+        tic = None
+
+    # The file can be closed while the mapped arrays are in use, the
+    # memory map stays open until the arrays are freed. scipy warns
+    # about this, which is expected here.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        file.close()
+
+    mass_values, intensity_values, point_count = _split_scans(mass_values,
+        intensity_values, scan_index, point_count)
+
+    # sanity check
+    if not len(time_list) == len(point_count):
+        error("number of time points (%d) does not equal the number of scans (%d)"%(len(time_list), len(point_count)))
+    if tic is not None and len(tic) != len(point_count):
+        tic = None
+
+    data = GCMS_data(time_list, mass_values=mass_values,
+        intensity_values=intensity_values, point_count=point_count, tic=tic)
+
+    return data
+
+def _split_scans(mass_values, intensity_values, scan_index=None,
+    point_count=None):
+
+    """
+    @summary: Finds the points of each scan in the flat ANDI arrays
+
+    @param mass_values: Masses of all scans
+    @type mass_values: numpy.ndarray
+    @param intensity_values: Intensities of all scans
+    @type intensity_values: numpy.ndarray
+    @param scan_index: Offset of the first point of each scan, or None
+    @type scan_index: numpy.ndarray
+    @param point_count: Number of points in each scan, or None
+    @type point_count: numpy.ndarray
+
+    @return: The masses and intensities with the scans stored one
+        after another, and the number of points in each scan
+    @rtype: TupleType
+    """
+
+    num_points = len(mass_values)
+
+    if point_count is None:
+        if scan_index is None:
+            # no scan information, assume masses are in ascending
+            # order until new scan
+            breaks = numpy.nonzero(numpy.diff(mass_values) < 0)[0] + 1
+            scan_index = numpy.concatenate(([0], breaks))
+        scan_index = numpy.asarray(scan_index, dtype=int)
+        point_count = numpy.diff(numpy.concatenate((scan_index,
+            [num_points])))
+    else:
+        point_count = numpy.asarray(point_count, dtype=int)
+
+    if len(point_count) == 0:
+        error("no scans found")
+    if (point_count < 0).any():
+        error("negative number of points in a scan")
+
+    # offsets of scans stored one after another
+    offsets = numpy.zeros(len(point_count), dtype=int)
+    numpy.cumsum(point_count[:-1], out=offsets[1:])
+    end = offsets[-1] + point_count[-1]
+
+    if scan_index is None:
+        scan_index = offsets
+    else:
+        scan_index = numpy.asarray(scan_index, dtype=int)
+        if len(scan_index) != len(point_count):
+            error("'scan_index' and 'point_count' differ in length")
+
+    if (scan_index + point_count > num_points).any() or \
+       (scan_index < 0).any():
+        error("scan extends beyond the mass and intensity values")
+
+    if (scan_index == offsets).all():
+        # the usual case, a slice of the arrays
+        if end < num_points:
+            mass_values = mass_values[:end]
+            intensity_values = intensity_values[:end]
+    else:
+        # gather the points of each scan
+        ii = numpy.arange(end) + numpy.repeat(scan_index - offsets,
+            point_count)
+        mass_values = mass_values[ii]
+        intensity_values = intensity_values[ii]
+
+    return mass_values, intensity_values, point_count
+
 def ANDI_writer(file_name, im):
 
     """
@@ -259,21 +414,15 @@ def ANDI_writer(file_name, im):
     time_list = im.get_time_list()
 
     # direct access, don't modify
-    intensity_matrix = im.intensity_matrix
+    intensity_array = im.intensity_array
 
     # compress by ignoring zero intensities
     # included for consistency with imported netCDF format
-    mass_values = []
-    intensity_values = []
-    point_count_values = []
-    for row in xrange(len(intensity_matrix)):
-        pc = 0  # point count
-        for col in xrange(len(intensity_matrix[0])):  # all rows same len
-            if (intensity_matrix[row][col] > 0):
-                mass_values.append(mass_list[col])
-                intensity_values.append(intensity_matrix[row][col])
-                pc += 1
-        point_count_values.append(pc)
+    rows, cols = numpy.nonzero(intensity_array > 0)
+    mass_values = numpy.asarray(mass_list)[cols].tolist()
+    intensity_values = intensity_array[rows, cols].tolist()
+    point_count_values = numpy.bincount(rows,
+        minlength=intensity_array.shape[0]).tolist()
 
     # sanity checks
     if not len(time_list) == len(point_count_values):
@@ -23,7 +23,7 @@ Functions for I/O of data in JCAMP-DX format
  #############################################################################
 
 from pyms.GCMS.Class import GCMS_data
-from pyms.GCMS.Class import Scan
+from pyms.GCMS.Function import build_intensity_matrix_stream
 from pyms.Utils.IO import file_lines
 from pyms.Utils.Utils import is_str
 from pyms.Utils.Error import error
@@ -45,14 +45,88 @@ def JCAMP_reader(file_name):
         error("'file_name' not a string")
 
     print " -> Reading JCAMP file '%s'" % (file_name)
-    lines_list = open(file_name,'r')
-    data = []
+
+    time_list = []
+    mass_arrays = []
+    intensity_arrays = []
+
+    for time, mass, intensity in JCAMP_iter_scans(file_name):
+        time_list.append(time)
+        mass_arrays.append(mass)
+        intensity_arrays.append(intensity)
+
+    point_count = [ len(mass) for mass in mass_arrays ]
+
+    data = GCMS_data(time_list, mass_values=numpy.concatenate(mass_arrays),
+        intensity_values=numpy.concatenate(intensity_arrays),
+        point_count=point_count)
+
+    return data
+
+def JCAMP_reader_im(file_name, min_mass, max_mass, bin_interval=1,
+    bin_left=0.5, bin_right=0.5):
+
+    """
+    @summary: Reads a JCAMP DX file straight into a binned intensity
+        matrix
+
+        Scans are binned as they are read, so the raw scans are never
+        all held in memory. As the mass range is not known before
+        the file is read, it must be given. Points outside the range
+        are discarded.
+
+    @param file_name: The name of the JCAMP DX file
+    @type file_name: StringType
+    @param min_mass: Centre of the first bin
+    @type min_mass: IntType or FloatType
+    @param max_mass: Largest mass to be binned
+    @type max_mass: IntType or FloatType
+    @param bin_interval: interval between bin centres (default 1)
+    @type bin_interval: IntType or FloatType
+    @param bin_left: left bin boundary offset (default 0.5)
+    @type bin_left: FloatType
+    @param bin_right: right bin boundary offset (default 0.5)
+    @type bin_right: FloatType
+
+    @return: Binned IntensityMatrix object
+    @rtype: pyms.GCMS.Class.IntensityMatrix
+    """
+
+    if not is_str(file_name):
+        error("'file_name' not a string")
+
+    print " -> Reading JCAMP file '%s'" % (file_name)
+
+    return build_intensity_matrix_stream(JCAMP_iter_scans(file_name),
+        min_mass, max_mass, bin_interval, bin_left, bin_right)
+
+def JCAMP_iter_scans(file_name):
+
+    """
+    @summary: Reads a JCAMP DX file one scan at a time
+
+        This is a generator. The XY data of each page are collected
+        and converted to numbers in one go, and the scan is yielded
+        before the next page is read.
+
+    @param file_name: The name of the JCAMP DX file
+    @type file_name: StringType
+
+    @return: Retention time, masses and intensities of each scan
+    @rtype: TupleType
+    """
+
+    if not is_str(file_name):
+        error("'file_name' not a string")
+
+    fp = open(file_name,'r')
+    data_lines = []
     page_idx = 0
     xydata_idx = 0
     time_list = []
-    scan_list = []
+    scan_count = 0
 
-    for line in lines_list:
+    for line in fp:
         if not len(line.strip()) == 0:
             prefix = line.find('#')
             # key word or information
@@ -67,48 +141,54 @@ def JCAMP_reader(file_name):
             # data
             elif prefix == -1:
                 if page_idx > 1 or xydata_idx > 1:
-                    if len(data) % 2 == 1:
-                        error("data not in pair !")
-                    mass = []
-                    intensity = []
-                    for i in range(len(data) / 2):
-                        mass.append(data[i * 2])
-                        intensity.append(data[i * 2 + 1])
-                    if not len(mass) == len(intensity):
-                        error("len(mass) is not equal to len(intensity)")
-                    scan_list.append(Scan(mass, intensity))
-                    data = []
-                    data_sub = line.strip().split(',')
-                    for item in data_sub:
-                        if not len(item.strip()) == 0:
-                            data.append(float(item.strip()))
+                    # first data of the next page, submit the scan
+                    if scan_count >= len(time_list):
+                        error("number of time points does not equal the "
+                            "number of scans")
+                    mass, intensity = __parse_xy(data_lines)
+                    yield time_list[scan_count], mass, intensity
+                    scan_count = scan_count + 1
+                    data_lines = []
                     if page_idx > 1:
                         page_idx = 1
                     if xydata_idx > 1:
                         xydata_idx = 1
-                else:
-                    data_sub = line.strip().split(',')
-                    for item in data_sub:
-                        if not len(item.strip()) == 0:
-                            data.append(float(item.strip()))
+                data_lines.append(line)
+
+    fp.close()
 
-    if len(data) % 2 == 1:
-        error("data not in pair !")
     # get last scan
-    mass = []
-    intensity = []
-    for i in range(len(data) / 2):
-        mass.append(data[i * 2])
-        intensity.append(data[i * 2 + 1])
-
-    if not len(mass) == len(intensity):
-        error("len(mass) is not equal to len(intensity)")
-    scan_list.append(Scan(mass, intensity))
-
-    # sanity check
-    if not len(time_list) == len(scan_list):
+    if not scan_count == len(time_list) - 1:
         error("number of time points does not equal the number of scans")
+    mass, intensity = __parse_xy(data_lines)
+    yield time_list[scan_count], mass, intensity
 
-    data = GCMS_data(time_list, scan_list)
+def __parse_xy(data_lines):
 
-    return data
+    """
+    @summary: Converts the XY data lines of a page to arrays of masses
+        and intensities
+
+    @param data_lines: Comma separated mass, intensity pairs
+    @type data_lines: ListType
+
+    @return: Masses and intensities
+    @rtype: TupleType
+    """
+
+    text = "".join(data_lines).replace(',', ' ')
+
+    # every token must be a number, unlike numpy.fromstring() which
+    # stops quietly at the first one that is not
+    try:
+        data = numpy.array(text.split(), dtype='d')
+    except ValueError:
+        error("XY data contains values that are not numbers")
+
+    if len(data) % 2 == 1:
+        error("data not in pair !")
+
+    # pairs are (mass, intensity)
+    data = data.reshape((-1, 2))
+
+    return data[:,0].copy(), data[:,1].copy()
@@ -1,5 +1,5 @@
 """
-Functions for reading manufacturer specific ANDI-MS data files
+Functions for reading mzML data files
 """
 
  #############################################################################
@@ -22,61 +22,528 @@ Functions for reading manufacturer specific ANDI-MS data files
  #                                                                           #
  #############################################################################
 
-import pymzml
+import base64, re, zlib
+from xml.etree import cElementTree as ElementTree
 
 import numpy
 
 from pyms.GCMS.Class import GCMS_data
-from pyms.GCMS.Class import Scan
-from pyms.Utils.Utils import is_str
+from pyms.Utils.Utils import is_str, is_number, is_list
 from pyms.Utils.Error import error, stop
+from pyms.Utils.Time import time_str_secs
 
+# controlled vocabulary accessions used by the reader
+_SCAN_START_TIME = "MS:1000016"
+_MZ_ARRAY = "MS:1000514"
+_INTENSITY_ARRAY = "MS:1000515"
+_ZLIB_COMPRESSION = "MS:1000574"
+_DTYPES = {"MS:1000521":'<f4', "MS:1000523":'<f8', "MS:1000519":'<i4',
+    "MS:1000522":'<i8'}
+_UNIT_SECOND = "UO:0000010"
 
-def mzML_reader(file_name):
+# bytes read at a time when looking for a spectrum in the file
+_CHUNK_SIZE = 65536
+
+# the parameter group list, if any, comes before the run
+_GROUP_LIST_END = re.compile(r'</referenceableParamGroupList\s*>')
+_RUN_START = re.compile(r'<run[\s>]')
+
+def mzML_reader(file_name, time_window=None):
 
     """
     @summary: A reader for mzML files, returns
         a GC-MS data object
 
+        The binary data arrays are decoded directly into numpy
+        arrays. Spectra without a scan start time are ignored.
+
+        If 'time_window' is given only the spectra in the window are
+        read. For indexed mzML files the index is used to find the
+        window without parsing the rest of the file.
+
     @param file_name: The name of the mzML file
     @type file_name: StringType
+    @param time_window: First and last retention time to read, each
+        a time in seconds or a time string such as "10m"
+    @type time_window: ListType
 
     @author: Sean O'Callaghan
     """
 
     if not is_str(file_name):
         error("'file_name' must be a string")
+    if time_window != None:
+        if not is_list(time_window) or len(time_window) != 2:
+            error("'time_window' must be a list of two times")
+        time_window = [ __time_secs(time) for time in time_window ]
     try:
-        mzml_file = pymzml.run.Reader(file_name)
-    except:
+        fp = open(file_name, 'rb')
+    except IOError:
         error("Cannot open file '%s'" % file_name)
 
     print " -> Reading mzML file '%s'" % (file_name)
 
-    scan_list = []
-    time_list = []
+    groups = __param_groups(fp)
 
-    for spectrum in mzml_file:
-        mass_list = []
-        intensity_list = []
+    offsets = None
+    if time_window != None:
+        offsets = __spectrum_offsets(fp)
 
-        for mz,i in spectrum.peaks:
-            mass_list.append(mz)
-            intensity_list.append(i)
+    if offsets != None:
+        spectra = __read_indexed_window(fp, offsets, time_window, groups)
+    else:
+        spectra = __iter_spectra(fp, time_window, groups)
 
-        #scan_list.append(Scan(mass_list, intensity_list))
-        for element in spectrum.xmlTree:
-            # For some reason there are spectra with no time value, 
-            # Ignore these????????????
-            if element.get('accession') == "MS:1000016": #time value
-                # We need time in seconds not minutes
-                time_list.append(60*float(element.get('value')))
-                scan_list.append(Scan(mass_list, intensity_list))
+    time_list = []
+    mass_arrays = []
+    intensity_arrays = []
+    for time, mass, intensity in spectra:
+        time_list.append(time)
+        mass_arrays.append(mass)
+        intensity_arrays.append(intensity)
+
+    fp.close()
 
     print "time:", len(time_list)
-    print "scan:", len(scan_list)
+    print "scan:", len(mass_arrays)
 
-    data = GCMS_data(time_list, scan_list)
+    if len(time_list) == 0:
+        error("no spectra with a retention time found")
+
+    point_count = [ len(mass) for mass in mass_arrays ]
+
+    data = GCMS_data(time_list, mass_values=numpy.concatenate(mass_arrays),
+        intensity_values=numpy.concatenate(intensity_arrays),
+        point_count=point_count)
 
     return data
 
+def __time_secs(time):
+
+    """
+    @summary: Converts a time, in seconds or as a time string, to
+        seconds
+
+    @param time: Time in seconds, or a time string
+    @type time: FloatType or StringType
+
+    @return: Time in seconds
+    @rtype: FloatType
+    """
+
+    if is_str(time):
+        return time_str_secs(time)
+    elif is_number(time):
+        return float(time)
+    else:
+        error("time must be a number or a time string")
+
+def __param_groups(fp):
+
+    """
+    @summary: Reads the referenceable parameter groups of an mzML
+        file
+
+        Only the start of the file is read, the group list comes
+        before the run.
+
+    @param fp: The open mzML file
+    @type fp: FileType
+
+    @return: The cvParam elements of each group, by group id
+    @rtype: DictType
+    """
+
+    fp.seek(0)
+    text = ""
+    end = None
+    while end == None:
+        chunk = fp.read(_CHUNK_SIZE)
+        # search across the chunk boundary
+        start = max(len(text) - 40, 0)
+        text = text + chunk
+        end = _GROUP_LIST_END.search(text, start)
+        if len(chunk) == 0 or _RUN_START.search(text, start) != None:
+            break
+    fp.seek(0)
+
+    groups = {}
+    if end == None:
+        return groups
+
+    begin = text.rfind('<referenceableParamGroupList', 0, end.start())
+    group_list = ElementTree.fromstring(text[begin:end.end()])
+    for group in group_list:
+        if __local_name(group.tag) == 'referenceableParamGroup':
+            groups[group.get('id')] = [ param for param in group
+                if __local_name(param.tag) == 'cvParam' ]
+
+    return groups
+
+def __iter_spectra(fp, time_window=None, groups={}):
+
+    """
+    @summary: Parses an mzML file from the start, one spectrum at a
+        time
+
+        This is a generator. Spectra are cleared once decoded, so
+        memory use does not grow with the size of the file.
+
+    @param fp: The open mzML file
+    @type fp: FileType
+    @param time_window: First and last retention time in seconds, or
+        None for all spectra
+    @type time_window: ListType
+    @param groups: The cvParam elements of each parameter group
+    @type groups: DictType
+
+    @return: Retention time, masses and intensities of each spectrum
+    @rtype: TupleType
+    """
+
+    context = ElementTree.iterparse(fp, events=('start', 'end'))
+    parent = None
+
+    for event, elem in context:
+        name = __local_name(elem.tag)
+        if event == 'start':
+            if name == 'spectrumList' or name == 'chromatogramList':
+                parent = elem
+            continue
+        if name == 'spectrum':
+            spectrum = __decode_spectrum(elem, groups)
+            # free the decoded spectrum
+            if parent != None:
+                parent.clear()
+            else:
+                elem.clear()
+            if spectrum == None:
+                continue
+            time = spectrum[0]
+            if time_window != None:
+                if time < time_window[0]:
+                    continue
+                if time > time_window[1]:
+                    break
+            yield spectrum
+        elif name == 'chromatogram' and parent != None:
+            parent.clear()
+
+def __read_indexed_window(fp, offsets, time_window, groups):
+
+    """
+    @summary: Reads the spectra in a time window from an indexed
+        mzML file
+
+        The first spectrum in the window is found by a binary search
+        over the spectrum offsets, reading only the spectra visited.
+        Spectra are assumed to be in order of retention time.
+
+    @param fp: The open mzML file
+    @type fp: FileType
+    @param offsets: File offset of each spectrum
+    @type offsets: ListType
+    @param time_window: First and last retention time in seconds
+    @type time_window: ListType
+    @param groups: The cvParam elements of each parameter group
+    @type groups: DictType
+
+    @return: Retention time, masses and intensities of each spectrum
+        in the window
+    @rtype: ListType
+    """
+
+    # first spectrum with a time at or after the window start
+    lo = 0
+    hi = len(offsets)
+    while lo < hi:
+        mid = (lo + hi)/2
+        time = __time_at(fp, offsets, mid, groups)
+        if time == None or time < time_window[0]:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    spectra = []
+    for ii in xrange(lo, len(offsets)):
+        spectrum = __decode_spectrum(__spectrum_at(fp, offsets[ii]), groups)
+        if spectrum == None:
+            continue
+        if spectrum[0] > time_window[1]:
+            break
+        if spectrum[0] >= time_window[0]:
+            spectra.append(spectrum)
+
+    return spectra
+
+def __time_at(fp, offsets, ii, groups):
+
+    """
+    @summary: Returns the retention time of a spectrum, looking at
+        the following spectra if it has none
+
+    @param fp: The open mzML file
+    @type fp: FileType
+    @param offsets: File offset of each spectrum
+    @type offsets: ListType
+    @param ii: Index of the spectrum
+    @type ii: IntType
+    @param groups: The cvParam elements of each parameter group
+    @type groups: DictType
+
+    @return: Retention time in seconds, or None
+    @rtype: FloatType
+    """
+
+    for jj in xrange(ii, len(offsets)):
+        time = __spectrum_time(__spectrum_at(fp, offsets[jj]), groups)
+        if time != None:
+            return time
+
+    return None
+
+def __spectrum_offsets(fp):
+
+    """
+    @summary: Reads the spectrum offsets of an indexed mzML file
+
+    @param fp: The open mzML file
+    @type fp: FileType
+
+    @return: File offset of each spectrum, or None if the file is
+        not indexed
+    @rtype: ListType
+    """
+
+    # the offset of the index is given at the end of the file
+    fp.seek(0, 2)
+    size = fp.tell()
+    fp.seek(max(size - 4096, 0))
+    tail = fp.read()
+    match = re.search(r'<indexListOffset>\s*(\d+)\s*</indexListOffset>',
+        tail)
+    if match == None:
+        fp.seek(0)
+        return None
+
+    fp.seek(int(match.group(1)))
+    index_list = fp.read()
+    fp.seek(0)
+
+    match = re.search(r'<index\s+name="spectrum"\s*>(.*?)</index>',
+        index_list, re.S)
+    if match == None:
+        return None
+
+    offsets = re.findall(r'<offset[^>]*>\s*(\d+)\s*</offset>', match.group(1))
+
+    return [ int(offset) for offset in offsets ]
+
+def __spectrum_at(fp, offset):
+
+    """
+    @summary: Reads and parses a single spectrum element
+
+    @param fp: The open mzML file
+    @type fp: FileType
+    @param offset: File offset of the spectrum element
+    @type offset: IntType
+
+    @return: The spectrum element
+    @rtype: xml.etree.ElementTree.Element
+    """
+
+    fp.seek(offset)
+    text = ""
+    end = -1
+    while end < 0:
+        chunk = fp.read(_CHUNK_SIZE)
+        if len(chunk) == 0:
+            error("incomplete spectrum at offset %d" % (offset))
+        # search across the chunk boundary
+        start = max(len(text) - 16, 0)
+        text = text + chunk
+        end = text.find("</spectrum>", start)
+
+    return ElementTree.fromstring(text[:end+len("</spectrum>")])
+
+def __local_name(tag):
+
+    """
+    @summary: Returns a tag name without its namespace
+
+    @param tag: Element tag
+    @type tag: StringType
+
+    @return: Tag name
+    @rtype: StringType
+    """
+
+    return tag.rsplit('}', 1)[-1]
+
+def __child(elem, name):
+
+    """
+    @summary: Returns the first child element with the given name
+
+    @param elem: Parent element
+    @type elem: xml.etree.ElementTree.Element
+    @param name: Tag name, without namespace
+    @type name: StringType
+
+    @return: The child element, or None
+    @rtype: xml.etree.ElementTree.Element
+    """
+
+    for child in elem:
+        if __local_name(child.tag) == name:
+            return child
+
+    return None
+
+def __cv_params(elem, groups):
+
+    """
+    @summary: Returns the cvParam elements of an element, including
+        those of the parameter groups it refers to
+
+    @param elem: The element
+    @type elem: xml.etree.ElementTree.Element
+    @param groups: The cvParam elements of each parameter group
+    @type groups: DictType
+
+    @return: The cvParam elements
+    @rtype: ListType
+    """
+
+    params = []
+    for child in elem:
+        name = __local_name(child.tag)
+        if name == 'cvParam':
+            params.append(child)
+        elif name == 'referenceableParamGroupRef':
+            ref = child.get('ref')
+            if not groups.has_key(ref):
+                error("unknown parameter group '%s'" % (ref))
+            params.extend(groups[ref])
+
+    return params
+
+def __spectrum_time(spectrum, groups={}):
+
+    """
+    @summary: Returns the scan start time of a spectrum in seconds
+
+        Times are in minutes unless the unit is given as seconds.
+
+    @param spectrum: The spectrum element
+    @type spectrum: xml.etree.ElementTree.Element
+    @param groups: The cvParam elements of each parameter group
+    @type groups: DictType
+
+    @return: Retention time in seconds, or None
+    @rtype: FloatType
+    """
+
+    scan_list = __child(spectrum, 'scanList')
+    if scan_list == None:
+        return None
+    scan = __child(scan_list, 'scan')
+    if scan == None:
+        return None
+
+    for param in __cv_params(scan, groups):
+        if param.get('accession') == _SCAN_START_TIME:
+            time = float(param.get('value'))
+            if param.get('unitAccession') == _UNIT_SECOND:
+                return time
+            else:
+                # We need time in seconds not minutes
+                return 60*time
+
+    return None
+
+def __decode_spectrum(spectrum, groups={}):
+
+    """
+    @summary: Decodes the retention time, masses and intensities of a
+        spectrum
+
+    @param spectrum: The spectrum element
+    @type spectrum: xml.etree.ElementTree.Element
+    @param groups: The cvParam elements of each parameter group
+    @type groups: DictType
+
+    @return: Retention time, masses and intensities, or None if the
+        spectrum has no retention time
+    @rtype: TupleType
+    """
+
+    time = __spectrum_time(spectrum, groups)
+    if time == None:
+        return None
+
+    mass = None
+    intensity = None
+
+    array_list = __child(spectrum, 'binaryDataArrayList')
+    if array_list != None:
+        for array in array_list:
+            kind = None
+            dtype = '<f8'
+            compressed = False
+            binary = __child(array, 'binary')
+            if binary != None:
+                binary = binary.text
+            # array type, precision and compression may be given
+            # inline or in a referenced parameter group
+            for param in __cv_params(array, groups):
+                accession = param.get('accession')
+                if accession == _MZ_ARRAY or \
+                   accession == _INTENSITY_ARRAY:
+                    kind = accession
+                elif _DTYPES.has_key(accession):
+                    dtype = _DTYPES[accession]
+                elif accession == _ZLIB_COMPRESSION:
+                    compressed = True
+            if kind == None:
+                continue
+            values = __decode_array(binary, dtype, compressed)
+            if kind == _MZ_ARRAY:
+                mass = values
+            else:
+                intensity = values
+
+    if mass is None:
+        mass = numpy.zeros(0, dtype='d')
+    if intensity is None:
+        intensity = numpy.zeros(0, dtype='d')
+    if len(mass) != len(intensity):
+        error("m/z and intensity arrays differ in length")
+
+    return time, mass, intensity
+
+def __decode_array(binary, dtype, compressed):
+
+    """
+    @summary: Decodes a base64 encoded binary data array
+
+    @param binary: The base64 text
+    @type binary: StringType
+    @param dtype: Little endian numpy type of the values
+    @type dtype: StringType
+    @param compressed: Whether the data are zlib compressed
+    @type compressed: BooleanType
+
+    @return: The values
+    @rtype: numpy.ndarray
+    """
+
+    if binary == None or len(binary.strip()) == 0:
+        return numpy.zeros(0, dtype='d')
+
+    data = base64.b64decode(binary)
+    if compressed:
+        data = zlib.decompress(data)
+
+    return numpy.frombuffer(data, dtype=dtype).astype('d')
@@ -138,15 +138,23 @@ def missing_peak_finder(sample, filename, points=13, null_ions=[73, 147],\
     print "Sample:", sample.get_name(), "File:", filename
     
     if filetype == 'cdf':
-        data = ANDI_reader(filename)
+        # memory mapped, only the scans kept below are read
+        data = ANDI_reader(filename, lazy=True)
     elif filetype == 'mzml':
         data = mzML_reader(filename)
     else:
         print "file type not valid"
+
+    # trimming can narrow the mass range, which must stay that of the
+    # whole run for cropping and the ion chromatograms
+    min_mass = data.get_min_mass()
+    max_mass = data.get_max_mass()
+
+    trim_to_missing_peaks(data, sample, rt_window, points)
     
 
     # build integer intensity matrix
-    im = build_intensity_matrix_i(data)
+    im = build_intensity_matrix_i(data, min_mass=min_mass, max_mass=max_mass)
 
     for null_ion in null_ions:
         im.null_mass(null_ion)
@@ -225,6 +233,57 @@ def missing_peak_finder(sample, filename, points=13, null_ions=[73, 147],\
             print "Missing peak at rt = ", mp_rt
             mp.set_ci_area('na')
 
+def trim_to_missing_peaks(data, sample, rt_window=1, points=13,
+                              struct_time=90.0):
+    """
+    @summary: Trims raw data to the retention time range of the missing
+              peaks of a sample
+
+              A margin is kept either side of the missing peaks, wide
+              enough that smoothing and the top-hat baseline correction
+              give the same values around the peaks as for the whole
+              run.
+
+    @param data: The raw data
+    @type data: pyms.GCMS.Class.GCMS_data
+
+    @param sample: The sample object containing missing peaks
+    @type sample: pyms.MissingPeak.Class.Sample
+
+    @param rt_window: Window in seconds around average RT to look for \
+                      missing peak
+    @type rt_window: floatType
+
+    @param points: Number of points in the smoothing window
+    @type points: intType
+
+    @param struct_time: Size of the top-hat structuring element in
+                        seconds
+    @type struct_time: floatType
+    """
+
+    rt_list = [float(mp.get_rt()) for mp in sample.get_missing_peaks()]
+    if len(rt_list) == 0:
+        return
+
+    time_array = numpy.array(data.get_time_list())
+    n_scan = len(time_array)
+    time_step = (time_array[-1] - time_array[0])/(n_scan - 1)
+
+    # the top-hat opening looks one element either side, and each of
+    # the two smoothing passes half a window
+    margin = rt_window + 2*struct_time + 2*points*time_step
+
+    first = numpy.searchsorted(time_array, min(rt_list) - margin)
+    last = numpy.searchsorted(time_array, max(rt_list) + margin,
+                              side='right') - 1
+    first = max(int(first), 0)
+    last = min(int(last), n_scan - 1)
+
+    if last > first and (first > 0 or last < n_scan - 1):
+        # trim() takes the first scan number, and the last scan index
+        data.trim(first + 1, last)
+
 def transposed(lists):
    """
    @summary: transposes a list of lists
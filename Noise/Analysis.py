@@ -24,13 +24,18 @@ Noise analysis functions
 
 import random, math
 
+import numpy
+
 from pyms.Utils.Error import error
+from pyms.Utils.Utils import is_int
+from pyms.GCMS.Class import IntensityMatrix
 from pyms.GCMS.Function import is_ionchromatogram
 from pyms.Utils.Time import window_sele_points
-from pyms.Utils.Math import MAD
 
 _DEFAULT_WINDOW = 256
 _DEFAULT_N_WINDOWS = 1024
+# intensities gathered at a time when estimating noise from windows
+_BATCH_POINTS = 1 << 22
 
 def window_analyzer(ic, window=_DEFAULT_WINDOW, n_windows=_DEFAULT_N_WINDOWS, rand_seed=None ):
 
@@ -72,24 +77,143 @@ def window_analyzer(ic, window=_DEFAULT_WINDOW, n_windows=_DEFAULT_N_WINDOWS, ra
 
     maxi = ia.size - window_pts
     noise_level = math.fabs(ia.max()-ia.min())
-    best_window_pos = None
-    seen_positions = []
-
-    cntr = 0
 
-    while cntr < n_windows:
+    # only process each window once, however often it is picked
+    seen_positions = set()
+    for cntr in range(n_windows):
         # generator.randrange(): last point not included in range
-        try_pos = generator.randrange(0, maxi+1)
-        # only process the window if not analyzed previously
-        if try_pos not in seen_positions:
-            end_slice = try_pos + window_pts
-            slice = ia[try_pos:end_slice]
-            crnt_mad = MAD(slice)
-            if crnt_mad < noise_level:
-                noise_level = crnt_mad
-                best_window_pos = try_pos
-        cntr = cntr + 1
-        seen_positions.append(try_pos)
+        seen_positions.add(generator.randrange(0, maxi+1))
+
+    positions = numpy.array(sorted(seen_positions), dtype=int)
+    crnt_mad = __min_window_mad(ia, positions, window_pts)
+    if crnt_mad < noise_level:
+        noise_level = crnt_mad
+
+    return noise_level
+
+def rolling_mad_noise(ic, window=_DEFAULT_WINDOW, step=1):
+
+    """
+    @summary: An estimator of the signal noise based on the median
+        absolute deviation (MAD) in every window position
+
+        As window_analyzer(), but instead of randomly placed windows,
+        windows are placed every 'step' points along the whole ion
+        chromatogram. The noise estimate is given by the minimum MAD.
+
+    @param ic: An IonChromatogram object
+    @type ic: pyms.IO.Class.IonCromatogram
+    @param window: Window width selection
+    @type window: IntType or StringType
+    @param step: The number of points between windows
+    @type step: IntType
+
+    @return: The noise estimate
+    @rtype: FloatType
+    """
+
+    if not is_ionchromatogram(ic):
+        error("argument must be an IonChromatogram object")
+
+    ia = ic.get_intensity_array()
+    window_pts = window_sele_points(ic, window)
+
+    noise_level = math.fabs(ia.max()-ia.min())
+    crnt_mad = __min_window_mad(ia, __window_positions(ia, window_pts, step),
+        window_pts)
+    if crnt_mad < noise_level:
+        noise_level = crnt_mad
 
     return noise_level
 
+def rolling_mad_noise_im(im, window=_DEFAULT_WINDOW, step=1):
+
+    """
+    @summary: Estimates the signal noise of every ion chromatogram of an
+        intensity matrix at once
+
+        The noise of each ion chromatogram is estimated as by
+        rolling_mad_noise().
+
+    @param im: An IntensityMatrix object
+    @type im: pyms.GCMS.Class.IntensityMatrix
+    @param window: Window width selection
+    @type window: IntType or StringType
+    @param step: The number of points between windows
+    @type step: IntType
+
+    @return: The noise estimate of each ion chromatogram, in the order
+        of the mass list
+    @rtype: numpy.ndarray
+    """
+
+    if not isinstance(im, IntensityMatrix):
+        error("argument must be an IntensityMatrix object")
+
+    ia = im.intensity_array
+    window_pts = window_sele_points(im.get_ic_at_index(0), window)
+
+    noise_level = numpy.fabs(ia.max(axis=0)-ia.min(axis=0))
+    crnt_mad = __min_window_mad(ia, __window_positions(ia, window_pts, step),
+        window_pts)
+
+    return numpy.minimum(noise_level, crnt_mad)
+
+def __window_positions(ia, window_pts, step):
+
+    """
+    @summary: Returns the start of every 'step'-th window of the
+        intensities
+    """
+
+    if not is_int(step) or step < 1:
+        error("'step' must be a positive integer")
+
+    maxi = len(ia) - window_pts
+    if maxi < 0:
+        error("window is wider than the ion chromatogram")
+
+    return numpy.arange(0, maxi+1, step)
+
+def __min_window_mad(ia, positions, window_pts):
+
+    """
+    @summary: Returns the minimum median absolute deviation over windows
+        of the intensities
+
+        The values are those of pyms.Utils.Math.MAD(). Windows are
+        gathered into arrays a batch at a time, and their medians found
+        together. A two dimensional array (scan by m/z) gives the
+        minimum for each column.
+
+    @param ia: Intensity array
+    @type ia: numpy.ndarray
+    @param positions: The start of each window
+    @type positions: numpy.ndarray
+    @param window_pts: The window width in points
+    @type window_pts: IntType
+
+    @return: The minimum median absolute deviation
+    @rtype: FloatType or numpy.ndarray
+    """
+
+    ia = numpy.asarray(ia, dtype='d')
+    width = ia[0].size
+    offsets = numpy.arange(window_pts)
+
+    # bound the size of each batch of windows
+    batch = max(1, _BATCH_POINTS/(window_pts*width))
+
+    min_mad = None
+    for ii in range(0, len(positions), batch):
+        windows = ia[positions[ii:ii+batch,numpy.newaxis] + offsets]
+        m = numpy.median(windows, axis=1)
+        mad = numpy.median(numpy.fabs(windows - m[:,numpy.newaxis]),
+            axis=1)/0.6745
+        mad = mad.min(axis=0)
+        if min_mad is None:
+            min_mad = mad
+        else:
+            min_mad = numpy.minimum(min_mad, mad)
+
+    return min_mad
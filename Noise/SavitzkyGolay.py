@@ -22,17 +22,23 @@ Savitzky-Golay noise filter
  #                                                                           #
  #############################################################################
 
-import numpy
+import math
 import copy
 
-from pyms.GCMS.Function import is_ionchromatogram, ic_window_points
+import numpy
+from scipy import ndimage
+
+from pyms.Utils.Error import error
+from pyms.GCMS.Class import IntensityMatrix
+from pyms.GCMS.Function import is_ionchromatogram, ic_window_points, \
+    map_ic_columns
 from pyms.Utils.Utils import is_int
 
 __DEFAULT_WINDOW = 7
 __DEFAULT_POLYNOMIAL_DEGREE = 2
 
 def savitzky_golay(ic, window=__DEFAULT_WINDOW, \
-        degree=__DEFAULT_POLYNOMIAL_DEGREE):
+        degree=__DEFAULT_POLYNOMIAL_DEGREE, deriv=0, fit_ends=False):
 
     """
     @summary: Applies Savitzky-Golay filter on ion chromatogram
@@ -47,6 +53,14 @@ def savitzky_golay(ic, window=__DEFAULT_WINDOW, \
     @param degree: degree of the fitting polynomial for the Savitzky-Golay
         filter
     @type degree: IntType
+    @param deriv: The order of the derivative to return. 0 smooths the
+        ion chromatogram, 1 gives its smoothed first derivative (per
+        second), and so on
+    @type deriv: IntType
+    @param fit_ends: Whether the ends are taken from the polynomial
+        fitted to the first and last full window, see
+        savitzky_golay_ia()
+    @type fit_ends: BooleanType
 
     @return: Smoothed ion chromatogram
     @rtype: pyms.GCMS.Class.IonChromatogram
@@ -58,9 +72,6 @@ def savitzky_golay(ic, window=__DEFAULT_WINDOW, \
     if not is_ionchromatogram(ic):
         error("'ic' not an IonChromatogram object")
 
-    if not is_int(degree):
-        error("'degree' not an integer")
-
     ia = ic.get_intensity_array()
 
     wing_length = ic_window_points(ic, window, half_window=True)
@@ -69,8 +80,9 @@ def savitzky_golay(ic, window=__DEFAULT_WINDOW, \
     #print "      Window width (points): %d" % ( 2*wing_length+1 )
     #print "      Polynomial degree: %d" % ( degree )
 
-    coeff = __calc_coeff(wing_length, degree)
-    ia_denoise = __smooth(ia, coeff)
+    ia_denoise = savitzky_golay_ia(ia, wing_length, degree, deriv, fit_ends)
+    if deriv > 0:
+        ia_denoise = ia_denoise/ic.get_time_step()**deriv
 
     ic_denoise = copy.deepcopy(ic)
     ic_denoise.set_intensity_array(ia_denoise)
@@ -78,13 +90,14 @@ def savitzky_golay(ic, window=__DEFAULT_WINDOW, \
     return ic_denoise
 
 def savitzky_golay_im(im, window=__DEFAULT_WINDOW, \
-        degree=__DEFAULT_POLYNOMIAL_DEGREE):
+        degree=__DEFAULT_POLYNOMIAL_DEGREE, deriv=0, fit_ends=False,
+        processes=None):
     """
     @summary: Applies Savitzky-Golay filter on Intensity
               Matrix
-              
-              Simply wraps around the Savitzky Golay 
-              function above
+
+              All ion chromatograms are filtered by the same call of
+              savitzky_golay_ia(), or shared between processes
 
     @param im: The input IntensityMatrix
     @type im: pyms.GCMS.Class.IntensityMatrix
@@ -94,6 +107,16 @@ def savitzky_golay_im(im, window=__DEFAULT_WINDOW, \
     @param degree: degree of the fitting polynomial for the Savitzky-Golay
         filter
     @type degree: IntType
+    @param deriv: The order of the derivative to return (per second),
+        see savitzky_golay()
+    @type deriv: IntType
+    @param fit_ends: Whether the ends are taken from the polynomial
+        fitted to the first and last full window, see
+        savitzky_golay_ia()
+    @type fit_ends: BooleanType
+    @param processes: The number of processes to filter the ion
+        chromatograms in parallel. If None, they are filtered serially
+    @type processes: IntType
 
     @return: Smoothed IntensityMatrix
     @rtype: pyms.GCMS.Class.IntensityMatrix
@@ -101,18 +124,135 @@ def savitzky_golay_im(im, window=__DEFAULT_WINDOW, \
     @author: Sean O'Callaghan
     @author: Vladimir Likic
     """
-    
-    n_scan, n_mz = im.get_size()
-    
-    im_smooth = copy.deepcopy(im)
-    
-    for ii in range(n_mz):
-        ic = im_smooth.get_ic_at_index(ii)
-        ic_smooth = savitzky_golay(ic, window, degree)
-        im_smooth.set_ic_at_index(ii, ic_smooth)
-        
+
+    ic = im.get_ic_at_index(0)
+    wing_length = ic_window_points(ic, window, half_window=True)
+
+    if processes == None:
+        ia = savitzky_golay_ia(im.intensity_array, wing_length, degree,
+            deriv, fit_ends)
+        im_smooth = IntensityMatrix(im.get_time_list(), im.get_mass_list(),
+            ia)
+    else:
+        im_smooth = map_ic_columns(im, savitzky_golay_ia,
+            (wing_length, degree, deriv, fit_ends), processes)
+
+    if deriv > 0:
+        im_smooth.intensity_array[:] /= ic.get_time_step()**deriv
+
     return im_smooth
 
+def savitzky_golay_ia(ia, wing_length, degree=__DEFAULT_POLYNOMIAL_DEGREE,
+        deriv=0, fit_ends=False):
+
+    """
+    @summary: Applies Savitzky-Golay filter on an intensity array
+
+        A two dimensional array (scan by m/z) is filtered along the
+        time axis, as a block of ion chromatograms.
+
+        By default the array is taken to be zero beyond its ends, which
+        pulls the first and last 'wing_length' points towards zero. With
+        'fit_ends' these points are instead taken from the polynomial
+        fitted to the first or last full window. This keeps the ends of
+        a chromatogram that starts or finishes above zero, for example
+        on a solvent tail or a rising baseline, and gives usable
+        derivatives at the ends.
+
+    @param ia: The input intensity array
+    @type ia: numpy.ndarray
+    @param wing_length: Half width of the filter window, in points. The
+        window is 2*wing_length+1 points wide
+    @type wing_length: IntType
+    @param degree: degree of the fitting polynomial for the Savitzky-Golay
+        filter
+    @type degree: IntType
+    @param deriv: The order of the derivative to return, per point.
+        Derivatives are those of the fitted polynomial, so they are
+        smoothed as the intensities are
+    @type deriv: IntType
+    @param fit_ends: Whether the ends are taken from the polynomial
+        fitted to the first and last full window
+    @type fit_ends: BooleanType
+
+    @return: Smoothed intensity array
+    @rtype: numpy.ndarray
+    """
+
+    if not is_int(degree):
+        error("'degree' not an integer")
+    if not is_int(deriv) or deriv < 0 or deriv > degree:
+        error("'deriv' must be an integer between 0 and 'degree'")
+    if degree >= 2*wing_length+1:
+        error("'degree' must be less than the window width")
+    if fit_ends and len(ia) < 2*wing_length+1:
+        error("window is wider than the intensity array")
+
+    coeff, left, right = __filter_weights(wing_length, degree, deriv)
+
+    ia = numpy.asarray(ia, dtype='d')
+    ia_denoise = ndimage.correlate1d(ia, coeff, axis=0, mode='constant')
+
+    if fit_ends:
+        # summed point by point so that each ion chromatogram is
+        # filtered the same whether alone or in a block
+        shape = (wing_length,) + (1,)*(ia.ndim-1)
+        head = ia[:2*wing_length+1]
+        tail = ia[len(ia)-2*wing_length-1:]
+        ia_denoise[:wing_length] = 0
+        ia_denoise[len(ia)-wing_length:] = 0
+        for ii in range(2*wing_length+1):
+            ia_denoise[:wing_length] += left[:,ii].reshape(shape)*head[ii]
+            ia_denoise[len(ia)-wing_length:] += \
+                right[:,ii].reshape(shape)*tail[ii]
+
+    return ia_denoise
+
+# filter weights by window, degree and derivative
+__weights_cache = {}
+
+def __filter_weights(wing_length, degree, deriv):
+
+    """
+    @summary: Returns the Savitzky-Golay filter weights for the middle
+        and for the ends of an array
+
+    @param wing_length: Half width of the filter window, in points
+    @type wing_length: IntType
+    @param degree: The degree of fitting polynomial
+    @type degree: IntType
+    @param deriv: The order of the derivative
+    @type deriv: IntType
+
+    @return: The weights for the middle of the window, and the weights
+        for each of the first and last 'wing_length' points of the
+        window
+    @rtype: TupleType
+    """
+
+    key = (wing_length, degree, deriv)
+
+    if not __weights_cache.has_key(key):
+
+        scale = math.factorial(deriv)
+        coeff = __calc_coeff(wing_length, degree, deriv)*scale
+
+        # least squares fit of the polynomial coefficients to a window
+        t = numpy.arange(-wing_length, wing_length+1, dtype='d')
+        powers = numpy.arange(degree+1)
+        fit = numpy.linalg.pinv(t[:,numpy.newaxis]**powers)
+
+        # derivative of the polynomial at each point of the window
+        factors = numpy.array([ math.factorial(m)/math.factorial(m-deriv)
+            if m >= deriv else 0 for m in powers ], dtype='d')
+        exponents = numpy.maximum(powers-deriv, 0)
+        weights = numpy.dot(factors*t[:,numpy.newaxis]**exponents, fit)
+
+        __weights_cache[key] = (coeff, weights[:wing_length],
+            weights[wing_length+1:])
+
+    return __weights_cache[key]
+
 def __calc_coeff(num_points, pol_degree, diff_order=0):
 
     """
@@ -129,7 +269,9 @@ def __calc_coeff(num_points, pol_degree, diff_order=0):
     @param diff_order: The degree of implicit differentiation.  0 means
         that filter results in smoothing of function, 1 means that filter
         results in smoothing the first derivative of function, and so on.
-        Always use 0
+        The coefficients are those of the term of this degree of the
+        fitted polynomial, so the derivative is diff_order! times the
+        filtered value
 
     @return: Filter coefficients
     @rtype: numpy.ndarray
@@ -191,18 +333,3 @@ def __resub(D, rhs):
         x2[l] = sum/D[l,l]
 
     return x2
-
-def __smooth(signal, coeff):
-
-    """
-    @summary: Applies coefficients calculated by __calc_coeff()
-    to signal
-
-    @author: Uwe Schmitt
-    @copyright: Uwe Schmitt
-    """
-
-    N = numpy.size(coeff-1)/2
-    res = numpy.convolve(signal, coeff)
-    return res[N:-N]
-
@@ -23,10 +23,14 @@ Moving window noise filter
  #############################################################################
 
 import copy
+import bisect
+
 import numpy
 
-from pyms.GCMS.Function import is_ionchromatogram, ic_window_points
-from pyms.Utils.Math import median
+from pyms.Utils.Error import error
+from pyms.GCMS.Class import IntensityMatrix
+from pyms.GCMS.Function import is_ionchromatogram, ic_window_points, \
+    map_ic_columns
 
 __DEFAULT_WINDOW = 3
 
@@ -59,21 +63,20 @@ def window_smooth(ic, window=__DEFAULT_WINDOW, median=False):
 
     wing_length = ic_window_points(ic, window, half_window=True)
 
-    if median:
-        ia_denoise = __median_window(ia, wing_length)
-    else:
-        ia_denoise = __mean_window(ia, wing_length)
+    ia_denoise = window_smooth_ia(ia, wing_length, median)
 
     ic_denoise = copy.deepcopy(ic)
     ic_denoise.set_intensity_array(ia_denoise)
 
     return ic_denoise
 
-def window_smooth_im(im, window=__DEFAULT_WINDOW, median=False):
+def window_smooth_im(im, window=__DEFAULT_WINDOW, median=False,
+        processes=None):
     """
     @summary: Applies window smoothing on Intensity Matrix
 
-              Simply wraps around the window smooth function above
+              All ion chromatograms are smoothed by the same call of
+              window_smooth_ia(), or shared between processes
 
     @param im: The input Intensity Matrix
     @type im: pyms.GCMS.Class.IntensityMatrix
@@ -83,6 +86,9 @@ def window_smooth_im(im, window=__DEFAULT_WINDOW, median=False):
     @param median: An indicator whether the mean or median window smoothing
         to be used
     @type median: Booleantype
+    @param processes: The number of processes to smooth the ion
+        chromatograms in parallel. If None, they are smoothed serially
+    @type processes: IntType
 
     @return: Smoothed Intensity Matrix
     @rtype: pyms.GCMS.Class.IntensityMatrix
@@ -90,23 +96,53 @@ def window_smooth_im(im, window=__DEFAULT_WINDOW, median=False):
     @author: Sean O'Callaghan
     @author: Vladimir Likic
     """
-    
-    n_scan, n_mz = im.get_size()
-    
-    im_smooth = copy.deepcopy(im)
-    
-    for ii in range(n_mz):
-        ic = im_smooth.get_ic_at_index(ii)
-        ic_smooth = window_smooth(ic, window, median)
-        im_smooth.set_ic_at_index(ii, ic_smooth)
-        
-    return im_smooth
+
+    wing_length = ic_window_points(im.get_ic_at_index(0), window,
+        half_window=True)
+
+    if processes == None:
+        ia = window_smooth_ia(im.intensity_array, wing_length, median)
+        return IntensityMatrix(im.get_time_list(), im.get_mass_list(), ia)
+    else:
+        return map_ic_columns(im, window_smooth_ia, (wing_length, median),
+            processes)
+
+def window_smooth_ia(ia, wing_length, median=False):
+
+    """
+    @summary: Applies window smoothing on an array of intensities
+
+        A two dimensional array (scan by m/z) is smoothed along the
+        time axis, as a block of ion chromatograms.
+
+    @param ia: Intensity array
+    @type ia: numpy.ndarray
+    @param wing_length: An integer value representing the number of
+        points on either side of a point in the ion chromatogram
+    @type wing_length: IntType
+    @param median: An indicator whether the mean or median window smoothing
+        to be used
+    @type median: Booleantype
+
+    @return: Smoothed intensity array
+    @rtype: numpy.ndarray
+    """
+
+    if median:
+        return __median_window(ia, wing_length)
+    else:
+        return __mean_window(ia, wing_length)
 
 def __mean_window(ia, wing_length):
 
     """
     @summary: Applies mean-window averaging on the array of intensities.
 
+        The window is truncated at the ends of the array. Window sums are
+        differences of the cumulative sum, so the cost does not depend
+        on the window width. A two dimensional array (scan by m/z) is
+        averaged along the time axis.
+
     @param ia: Intensity array
     @type ia: nympy.core.ndarray
     @param wing_length: An integer value representing the number of
@@ -121,18 +157,18 @@ def __mean_window(ia, wing_length):
 
 #print " -> Window smoothing (mean): the wing is %d point(s)" % (wing_length)
 
-    ia_denoise = numpy.repeat([0], ia.size)
+    ia = numpy.asarray(ia, dtype='d')
+    n = len(ia)
+
+    cum_sum = numpy.zeros((n+1,) + ia.shape[1:], dtype='d')
+    numpy.cumsum(ia, axis=0, out=cum_sum[1:])
 
-    index = 0
-    end = ia.size - 1
+    index = numpy.arange(n)
+    left = numpy.maximum(index - wing_length, 0)
+    right = numpy.minimum(index + wing_length + 1, n)
+    count = (right - left).astype('d').reshape((n,) + (1,)*(ia.ndim-1))
 
-    while index <= end:
-        left = index - wing_length
-        right = index + wing_length + 1
-        if left < 0: left = 0
-        slice = ia[left:right]
-        ia_denoise[index] = slice.mean()
-        index = index + 1
+    ia_denoise = (cum_sum[right] - cum_sum[left])/count
 
     return ia_denoise
 
@@ -141,6 +177,15 @@ def __median_window(ia, wing_length):
     """
     @summary: Applies median-window averaging on the array of intensities.
 
+        The window is truncated at the ends of the array. The window
+        is kept sorted as it slides, so each point costs a binary search
+        rather than a sort. Inserting into and deleting from the sorted
+        list still shift up to the window length of items, so filtering
+        n points is O(n*w) for a window of w points. The shifts are a
+        memory move, which for windows of up to several thousand points
+        is faster than a heap based running median. A two dimensional
+        array (scan by m/z) is filtered column by column.
+
     @param ia: Intensity array
     @type ia: nympy.core.ndarray
     @param wing_length: An integer value representing the number of
@@ -155,18 +200,31 @@ def __median_window(ia, wing_length):
 
 #print " -> Window smoothing (median): the wing is %d point(s)" % (wing_length)
 
-    ia_denoise = numpy.repeat([0], ia.size)
-
-    index = 0
-    end = ia.size - 1
-
-    while index <= end:
-        left = index - wing_length
-        right = index + wing_length + 1
-        if left < 0: left = 0
-        slice = ia[left:right]
-        ia_denoise[index] = median(slice)
-        index = index + 1
+    ia = numpy.asarray(ia, dtype='d')
+
+    if ia.ndim > 1:
+        ia_denoise = numpy.empty(ia.shape, dtype='d')
+        for ii in range(ia.shape[1]):
+            ia_denoise[:,ii] = __median_window(ia[:,ii], wing_length)
+        return ia_denoise
+
+    values = ia.tolist()
+    n = len(values)
+    ia_denoise = numpy.zeros(n, dtype='d')
+
+    window = sorted(values[:wing_length])
+    for index in range(n):
+        # slide the window: add the point entering on the right, and
+        # remove the one leaving on the left
+        if index + wing_length < n:
+            bisect.insort(window, values[index + wing_length])
+        if index - wing_length - 1 >= 0:
+            del window[bisect.bisect_left(window,
+                values[index - wing_length - 1])]
+        N = len(window)
+        if (N % 2) == 0:
+            ia_denoise[index] = (window[N/2 - 1] + window[N/2])/2.0
+        else:
+            ia_denoise[index] = window[N/2]
 
     return ia_denoise
-
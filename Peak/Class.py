@@ -30,7 +30,7 @@ from pyms.Utils.Error import error
 from pyms.Utils.Utils import is_int, is_number, is_list, is_boolean, is_str
 from pyms.Utils.IO import open_for_writing, close_for_writing
 
-class Peak:
+class Peak(object):
 
     """
     @summary: Models a signal peak
@@ -79,20 +79,12 @@ class Peak:
                 self.__ic_mass = None
                 self.make_UID()
 
-                # TEST: to test if this speeds things up
-                self.mass_spec = ms.mass_spec
-                self.ms = ms
-
             else:
                 # single ion chromatogram properties
                 self.__ic_mass = ms
                 self.__mass_spectrum = None
                 self.make_UID()
 
-                # TEST: to test if this speeds things up
-                self.mass_spec = None
-
-
         self.__pt_bounds = None
         self.__area = None
         self.__ion_areas = {}
@@ -100,6 +92,24 @@ class Peak:
         # TEST: to test if this speeds things up
         self.rt = self.__rt
 
+    def __setstate__(self, state):
+
+        """
+        @summary: Restores a pickled Peak
+
+            Peaks pickled before 'ms' and 'mass_spec' were read from
+            the peak mass spectrum store them as attributes, which
+            may be stale. These are dropped on loading.
+
+        @param state: The pickled attributes
+        @type state: DictType
+        """
+
+        state = state.copy()
+        state.pop('ms', None)
+        state.pop('mass_spec', None)
+        self.__dict__.update(state)
+
     def make_UID(self):
 
         """
@@ -342,9 +352,6 @@ class Peak:
         self.__mass_spectrum = None
         self.make_UID()
 
-        # TEST: to test if this speeds things up
-        self.mass_spec = None
-
     def set_mass_spectrum(self, ms):
 
         """
@@ -366,9 +373,6 @@ class Peak:
         self.__ic_mass = None
         self.make_UID()
 
-        # TEST: to test if this speeds things up
-        self.mass_spec = ms.mass_spec
-
     def get_rt(self):
 
         """
@@ -380,6 +384,18 @@ class Peak:
 
         return self.__rt
 
+    def get_minutes(self):
+
+        """
+        @summary: Return the retention time units flag
+
+        @return: True if the peak was created with the retention time
+            in minutes
+        @rtype: BooleanType
+        """
+
+        return self.__minutes
+
     def get_ic_mass(self):
 
         """
@@ -402,6 +418,24 @@ class Peak:
 
         return copy.deepcopy(self.__mass_spectrum)
 
+    def __get_ms(self):
+        return self.__mass_spectrum
+
+    def __get_mass_spec(self):
+        if self.__mass_spectrum == None:
+            return None
+        return self.__mass_spectrum.mass_spec
+
+    def __get_ion_areas(self):
+        return self.__ion_areas
+
+    # Direct access for speed (DANGEROUS). 'ms' is the peak's own mass
+    # spectrum, not a copy; 'mass_spec' its intensities; 'ion_areas'
+    # its own, possibly empty, dictionary of ion areas
+    ms = property(__get_ms)
+    mass_spec = property(__get_mass_spec)
+    ion_areas = property(__get_ion_areas)
+
 ## TODO: What is this?
     def find_mass_spectrum(self, data, from_bounds=False):
 
@@ -442,9 +476,6 @@ class Peak:
         self.__ic_mass = None
         self.make_UID()
 
-        # TEST: to test if this speeds things up
-        self.mass_spec = self.__mass_spectrum.mass_spec
-
     def crop_mass(self, mass_min, mass_max):
 
         """
@@ -496,9 +527,6 @@ class Peak:
         # update UID
         self.make_UID()
 
-        # TEST: to test if this speeds things up
-        self.mass_spec = self.__mass_spectrum.mass_spec
-
     def null_mass(self, mass):
 
         """
@@ -530,10 +558,10 @@ class Peak:
                 best = tmp
                 ix = ii
 
-        self.__mass_spectrum.mass_spec[ix] = 0
+        # assigned back, as spectra may hold their intensities sparsely
+        mass_spec = self.__mass_spectrum.mass_spec
+        mass_spec[ix] = 0
+        self.__mass_spectrum.mass_spec = mass_spec
 
         # update UID
         self.make_UID()
-
-        # TEST: to test if this speeds things up
-        self.mass_spec = self.__mass_spectrum.mass_spec
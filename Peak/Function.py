@@ -25,11 +25,11 @@ Functions related to Peak modification
 import numpy
 import copy
 
-#from pyms.Utils.Error import error
+from pyms.Utils.Error import error
 from pyms.Peak.Class import Peak
 from pyms.Utils.Utils import is_str, is_list
 from pyms.Utils.Math import median
-from pyms.GCMS.Class import MassSpectrum
+from pyms.GCMS.Class import MassSpectrum, SparseMassSpectrum
 
 # If psyco is installed, use it to speed up running time
 try:
@@ -38,6 +38,11 @@ try:
 except:
     pass
 
+# scans first searched either side of the apex by batch_ion_areas()
+_AREA_SPAN = 32
+# ion peaks searched together by batch_ion_areas()
+_AREA_BATCH = 4096
+
 def peak_sum_area(im, peak, single_ion=False, max_bound=0):
 
     """
@@ -60,33 +65,70 @@ def peak_sum_area(im, peak, single_ion=False, max_bound=0):
     @author: Sean O'Callaghan
     """
 
-    sum_area = 0
-    # Use internal values (not copy)
-    #mat = im.get_matrix_list()
-    mat = im.intensity_matrix
-    ms = peak.get_mass_spectrum()
-    rt = peak.get_rt()
-    apex = im.get_index_at_time(rt)
+    return batch_peak_sum_area(im, [peak], single_ion, max_bound)[0]
 
-    # get peak masses with non-zero intensity
-    mass_ii = [ ii for ii in xrange(len(ms.mass_list)) \
-        if ms.mass_spec[ii] > 0 ]
+def batch_peak_sum_area(im, peak_list, single_ion=False, max_bound=0):
 
-    area_dict = {}
-    # get stats on boundaries
-    for ii in mass_ii:
-        # get ion chromatogram as list
-        ia = [ mat[scan][ii] for scan in xrange(len(mat)) ]
-        area, left, right, l_share, r_share = ion_area(ia, apex, max_bound)
-        # need actual mass for single ion areas
-        actual_mass = ms.mass_list[ii]
-        area_dict[actual_mass] = area
-        sum_area += area
+    """
+    @Summary: Calculate the sum of the raw ion areas based on
+        detected boundaries, for each peak of a list
 
-    if single_ion == True:
-        return sum_area, area_dict
-    else:
-        return sum_area
+        The areas are those of peak_sum_area(), but the areas of all
+        ions of all peaks are found together by batch_ion_areas().
+
+    @param im: The originating IntensityMatrix object
+    @type im: pyms.GCMS.Class.IntensityMatrix
+    @param peak_list: A list of Peak objects
+    @type peak_list: ListType
+    @param single_ion: whether single ion areas should be returned
+    @type singe_ion: BooleanType
+    @param max_bound: Optional value to limit size of detected bound
+    @type max_bound: IntType
+
+    @return: For each peak, the sum of peak apex ions in detected
+        bounds, or if 'single_ion' is True, the sum and a dictionary of
+        the area of each ion
+    @rtype: ListType
+    """
+
+    if not is_list(peak_list):
+        error("'peak_list' must be a list")
+
+    if len(peak_list) == 0:
+        return []
+
+    apexes = im.get_indices_at_times([ peak.get_rt() for peak in peak_list ])
+
+    # peak masses with non-zero intensity
+    ion_lists = []
+    for peak in peak_list:
+        ms = peak.ms
+        if isinstance(ms, SparseMassSpectrum):
+            ion_lists.append(ms.indices[ms.intensities > 0])
+        else:
+            ion_lists.append(numpy.nonzero(numpy.asarray(ms.mass_spec) > 0)[0])
+
+    counts = [ len(ions) for ions in ion_lists ]
+    areas = batch_ion_areas(im, numpy.repeat(apexes, counts),
+        numpy.concatenate(ion_lists), max_bound)[0].tolist()
+
+    result = []
+    begin = 0
+    for peak, ions in zip(peak_list, ion_lists):
+        sum_area = 0
+        area_dict = {}
+        mass_list = peak.ms.mass_list
+        for ii, area in zip(ions.tolist(), areas[begin:begin+len(ions)]):
+            # need actual mass for single ion areas
+            area_dict[mass_list[ii]] = area
+            sum_area += area
+        begin += len(ions)
+        if single_ion == True:
+            result.append((sum_area, area_dict))
+        else:
+            result.append(sum_area)
+
+    return result
 
 def peak_top_ion_areas(im, peak, n_top_ions = 5, max_bound=0):
     """
@@ -276,6 +318,143 @@ def half_area(ia, max_bound=0, tol=0.5):
 
     return area, index, shared
 
+def batch_ion_areas(im, apexes, ion_indices, max_bound=0, tol=0.5):
+
+    """
+    @Summary: Find bounds and areas of many ion peaks at once
+
+        For each pair of apex and ion, the result is that of ion_area()
+        on the ion chromatogram. The outward walks of half_area() are
+        done for all pairs together on arrays of the intensities next
+        to each apex; pairs whose bounds lie further out are walked
+        again over a wider span.
+
+    @param im: The originating IntensityMatrix object
+    @type im: pyms.GCMS.Class.IntensityMatrix
+    @param apexes: Scan index of each peak apex
+    @type apexes: ListType or numpy.ndarray
+    @param ion_indices: Mass index of each ion
+    @type ion_indices: ListType or numpy.ndarray
+    @param max_bound: Optional value to limit size of detected bound
+    @type max_bound: IntType
+    @param tol: Percentage tolerance of added area to current area.
+    @type tol: FloatType
+
+    @return: Areas, left and right boundary offsets, shared left, shared
+        right, as arrays
+    @rtype: TupleType
+    """
+
+    mat = im.intensity_array
+    apexes = numpy.asarray(apexes, dtype=int)
+    ion_indices = numpy.asarray(ion_indices, dtype=int)
+
+    if apexes.shape != ion_indices.shape:
+        error("'apexes' and 'ion_indices' differ in length")
+
+    n_scan = mat.shape[0]
+
+    # Left area, searched from the apex down to the first scan
+    l_area, left, l_share = __half_areas(mat, apexes, ion_indices, -1,
+        apexes+1, max_bound, tol)
+
+    # Right area
+    r_area, right, r_share = __half_areas(mat, apexes, ion_indices, 1,
+        n_scan-apexes, max_bound, tol)
+    r_area -= mat[apexes, ion_indices]  # counted apex twice
+
+    return l_area+r_area, left, right, l_share, r_share
+
+def __half_areas(mat, apexes, ion_indices, direction, length, max_bound,
+        tol):
+
+    """
+    @Summary: Find bounds of many ion peaks on one side of the apex, as
+        half_area()
+
+    @param mat: Intensities (scan by m/z)
+    @type mat: numpy.ndarray
+    @param apexes: Scan index of each peak apex
+    @type apexes: numpy.ndarray
+    @param ion_indices: Mass index of each ion
+    @type ion_indices: numpy.ndarray
+    @param direction: 1 to search to later scans, -1 to earlier scans
+    @type direction: IntType
+    @param length: Number of scans from the apex (inclusive) to the end
+        of the ion chromatogram in 'direction'
+    @type length: numpy.ndarray
+    @param max_bound: Optional value to limit size of detected bound
+    @type max_bound: IntType
+    @param tol: Percentage tolerance of added area to current area.
+    @type tol: FloatType
+
+    @return: Half peak areas, boundary offsets, shared (True if shared
+        ion)
+    @rtype: TupleType
+    """
+
+    tol = tol/200.0  # halve and convert from percent
+
+    # Default number of points to sum new area across, for smoothing
+    wide = 3
+
+    if max_bound < 1:
+        limit = length
+    else:
+        limit = numpy.minimum(max_bound+1, length)
+
+    num = len(apexes)
+    area = numpy.zeros(num, dtype='d')
+    index = numpy.zeros(num, dtype=int)
+    shared = numpy.zeros(num, dtype=bool)
+    pending = numpy.ones(num, dtype=bool)
+
+    # The state after j steps of the walk is the area over points
+    # 0..j, the edge (average of points j..j+wide-1) and the previous
+    # edge. The walk stops at the first j where the edge is below
+    # tolerance, the edge is not decreasing, or the limit is reached.
+    todo = numpy.arange(num)
+    span = _AREA_SPAN
+    while len(todo) > 0:
+        for ii in range(0, len(todo), _AREA_BATCH):
+            batch = todo[ii:ii+_AREA_BATCH]
+            offsets = numpy.arange(span+wide-1)
+            scans = apexes[batch,numpy.newaxis] + direction*offsets
+            inside = offsets < length[batch,numpy.newaxis]
+            ia = mat[numpy.where(inside, scans, 0),
+                ion_indices[batch,numpy.newaxis]]
+            ia[~inside] = 0  # sums past the end are bounds safe
+
+            cum_area = numpy.cumsum(ia[:,:span], axis=1)
+            edge = ia[:,0:span].copy()
+            for kk in range(1, wide):
+                edge += ia[:,kk:kk+span]
+            edge /= wide
+            old_edge = numpy.empty(edge.shape, dtype='d')
+            old_edge[:,0] = 2 * edge[:,0]  # bigger than expected edge
+            old_edge[:,1:] = edge[:,:-1]
+
+            walking = (edge > cum_area * tol) & (edge < old_edge) & \
+                (offsets[numpy.newaxis,1:span+1] < \
+                limit[batch,numpy.newaxis])
+            stopped = ~walking
+            found = stopped.any(axis=1)
+            rows = numpy.nonzero(found)[0]
+            stop = stopped[rows].argmax(axis=1)
+
+            done = batch[rows]
+            area[done] = cum_area[rows, stop]
+            index[done] = stop
+            shared[done] = edge[rows, stop] >= old_edge[rows, stop]
+
+            pending[done] = False
+
+        # walk the rest again, further out
+        todo = todo[pending[todo]]
+        span = 2*span
+
+    return area, index, shared
+
 def median_bounds(im, peak, shared=True):
 
     """
@@ -295,7 +474,6 @@ def median_bounds(im, peak, shared=True):
     @author: Andrew Isaac
     """
 
-    mat = im.get_matrix_list()
     ms = peak.get_mass_spectrum()
     rt = peak.get_rt()
     apex = im.get_index_at_time(rt)
@@ -309,16 +487,10 @@ def median_bounds(im, peak, shared=True):
         if ms.mass_spec[ii] > 0 ]
 
     # get stats on boundaries
-    left_list = []
-    right_list = []
-    for ii in mass_ii:
-        # get ion chromatogram as list
-        ia = [ mat[scan][ii] for scan in xrange(len(mat)) ]
-        area, left, right, l_share, r_share = ion_area(ia, apex)
-        if shared or not l_share:
-            left_list.append(left)
-        if shared or not r_share:
-            right_list.append(right)
+    area, left, right, l_share, r_share = batch_ion_areas(im,
+        [apex]*len(mass_ii), mass_ii)
+    left_list = left[numpy.logical_or(shared, ~l_share)].tolist()
+    right_list = right[numpy.logical_or(shared, ~r_share)].tolist()
 
     # return medians
     # NB if shared=True, lists maybe empty
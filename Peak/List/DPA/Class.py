@@ -22,11 +22,12 @@ Classes for peak alignment by dynamic programming
  #                                                                           #
  #############################################################################
 
-import copy
+import copy, math
 
-import numpy, Pycluster
+import numpy
 
 from pyms.Utils.Error import error, stop
+from pyms.Utils.Utils import is_int
 from pyms.Utils.IO import dump_object
 from pyms.Experiment.Class import Experiment
 from pyms.GCMS.Class import MassSpectrum
@@ -34,7 +35,6 @@ from pyms.Peak.Class import Peak
 from pyms.Peak.List.Function import composite_peak
 
 import Function
-import Function_new
 
 # If psyco is installed, use it to speed up running time
 try:
@@ -647,7 +647,7 @@ class PairwiseAlignment(object):
     @author: Vladimir Likic
     """
 
-    def __init__(self, algts, D, gap):
+    def __init__(self, algts, D, gap, processes=None, mpi=False):
 
         """
         @param algts: A list of alignments
@@ -656,6 +656,12 @@ class PairwiseAlignment(object):
         @type D: FloatType
         @param gap: Gap parameter for pairwise alignments
         @type gap: FloatType
+        @param processes: The number of processes calculating pairwise
+            alignments. If None, they are calculated serially
+        @type processes: IntType
+        @param mpi: Whether to share pairwise alignments among MPI ranks,
+            if mpi4py is available
+        @type mpi: BooleanType
 
         @author: Woon Wai Keen
         @author: Vladimir Likic
@@ -664,21 +670,32 @@ class PairwiseAlignment(object):
         self.D = D
         self.gap = gap
 
-        self.sim_matrix = self._sim_matrix(algts, D, gap)
+        self.sim_matrix = self._sim_matrix(algts, D, gap, processes, mpi)
         self.dist_matrix = self._dist_matrix(self.sim_matrix)
         self.tree = self._guide_tree(self.dist_matrix)
 
-    def _sim_matrix(self, algts, D, gap):
+    def _sim_matrix(self, algts, D, gap, processes=None, mpi=False):
 
         """
         @summary: Calculates the similarity matrix for the set of alignments
 
+            Pairwise alignments can be calculated by a pool of processes
+            and, with MPI, shared among ranks. Each rank then calculates
+            every num_ranks-th pair, and the ranks exchange the results.
+            The matrix is the same whichever way it is calculated.
+
         @param algts: A list of alignments
         @type algts: ListType
         @param D: Retention time tolerance parameter for pairwise alignments
         @type D: FloatType
         @param gap: Gap parameter for pairwise alignments
         @type gap: FloatType
+        @param processes: The number of processes calculating pairwise
+            alignments. If None, they are calculated serially
+        @type processes: IntType
+        @param mpi: Whether to share pairwise alignments among MPI ranks,
+            if mpi4py is available
+        @type mpi: BooleanType
 
         @author: Woon Wai Keen
         @author: Vladimir Likic
@@ -686,22 +703,73 @@ class PairwiseAlignment(object):
 
         n = len(algts)
 
-        total_n = n * (n - 1) / 2
-
         print " Calculating pairwise alignments for %d alignments (D=%.2f, gap=%.2f)" % \
                 (n, D, gap)
 
         sim_matrix = numpy.zeros((n,n), dtype='f')
 
-        for i in range(n - 1):
-            for j in range(i + 1, n):
-                ma = Function_new.align(algts[i], algts[j], D, gap)
-                sim_matrix[i,j] = sim_matrix[j,i] = ma.similarity
-                total_n = total_n - 1
-                print " -> %d pairs remaining" % total_n
+        pairs = [ (i, j) for i in range(n - 1) for j in range(i + 1, n) ]
+        stacks = [ Function.stack_alignment(algt) for algt in algts ]
+
+        scores = self._pair_scores(stacks, pairs, D, gap, processes, mpi)
+        for (i, j), score in zip(pairs, scores):
+            sim_matrix[i,j] = sim_matrix[j,i] = score
 
         return sim_matrix
 
+    def _pair_scores(self, stacks, pairs, D, gap, processes=None, mpi=False):
+
+        """
+        @summary: Calculates the similarity scores of pairs of alignments
+
+            With MPI, each rank calculates every num_ranks-th pair, and
+            the ranks exchange the results. The scores are the same
+            whichever way they are calculated.
+
+        @param stacks: Alignments stacked by Function.stack_alignment()
+        @type stacks: ListType
+        @param pairs: Pairs of indices into 'stacks'
+        @type pairs: ListType
+        @param D: Retention time tolerance parameter for pairwise alignments
+        @type D: FloatType
+        @param gap: Gap parameter for pairwise alignments
+        @type gap: FloatType
+        @param processes: The number of processes calculating pairwise
+            alignments. If None, they are calculated serially
+        @type processes: IntType
+        @param mpi: Whether to share pairwise alignments among MPI ranks,
+            if mpi4py is available
+        @type mpi: BooleanType
+
+        @return: The similarity score of each pair
+        @rtype: ListType
+        """
+
+        comm = None
+        if mpi:
+            # If we can't import mpi4py then continue without it.
+            try:
+                from mpi4py import MPI
+                comm = MPI.COMM_WORLD
+            except ImportError:
+                pass
+
+        if comm == None or comm.Get_size() == 1:
+            return Function.pair_similarities(stacks, pairs, D, gap,
+                processes)
+
+        num_ranks = comm.Get_size()
+        rank = comm.Get_rank()
+        local_scores = Function.pair_similarities(stacks,
+            pairs[rank::num_ranks], D, gap, processes)
+        rank_scores = comm.allgather(local_scores)
+
+        scores = [ None for _ in pairs ]
+        for ii in range(num_ranks):
+            scores[ii::num_ranks] = rank_scores[ii]
+
+        return scores
+
     def _dist_matrix(self, sim_matrix):
 
         """
@@ -731,8 +799,9 @@ class PairwiseAlignment(object):
 
         @param dist_matrix: The distance matrix
         @type dist_matrix: numpy.ndarray
-        @return: Pycluster similarity tree
-        @rtype: Pycluster.cluster.Tree
+        @return: Pycluster similarity tree, or the list of nodes built
+            by Function.average_linkage() if Pycluster is not installed
+        @rtype: Pycluster.cluster.Tree or ListType
 
         @author: Woon Wai Keen
         @author: Vladimir Likic
@@ -741,8 +810,207 @@ class PairwiseAlignment(object):
         n = len(dist_matrix)
 
         print " -> Clustering %d pairwise alignments." % (n*(n-1)),
-        tree = Pycluster.treecluster(distancematrix=dist_matrix, method='a')
+        try:
+            import Pycluster
+            tree = Pycluster.treecluster(distancematrix=dist_matrix,
+                method='a')
+        # Without Pycluster, cluster the same way with average_linkage()
+        except ImportError:
+            similarities = {}
+            for i in range(n - 1):
+                for j in range(i + 1, n):
+                    similarities[(i, j)] = -float(dist_matrix[i,j])
+            tree = Function.average_linkage(n, similarities)
         print "Done"
 
         return tree
 
+class SparsePairwiseAlignment(PairwiseAlignment):
+
+    """
+    @summary: Models pairwise alignment of alignments, for a guide tree
+        built from some of the pairwise alignments
+
+        Each alignment is aligned to a few seed alignments, and to the
+        alignments most like it in their similarities to the seeds. The
+        guide tree is built by average linkage over the pairs aligned.
+        With the default number of seeds and neighbours, about
+        2*n*log2(n) pairwise alignments are made instead of n*(n-1)/2.
+
+        The similarities of the aligned pairs are held in 'sim_graph',
+        keyed by pairs of alignment indices.
+    """
+
+    def __init__(self, algts, D, gap, seeds=None, neighbours=None,
+        processes=None, mpi=False):
+
+        """
+        @param algts: A list of alignments
+        @type algts: ListType
+        @param D: Retention time tolerance parameter for pairwise alignments
+        @type D: FloatType
+        @param gap: Gap parameter for pairwise alignments
+        @type gap: FloatType
+        @param seeds: The number of seed alignments. If None, the base 2
+            logarithm of the number of alignments, rounded up
+        @type seeds: IntType
+        @param neighbours: The number of nearest alignments each
+            alignment is aligned to. If None, the same as 'seeds'
+        @type neighbours: IntType
+        @param processes: The number of processes calculating pairwise
+            alignments. If None, they are calculated serially
+        @type processes: IntType
+        @param mpi: Whether to share pairwise alignments among MPI ranks,
+            if mpi4py is available
+        @type mpi: BooleanType
+        """
+
+        n = len(algts)
+
+        if seeds == None:
+            seeds = max(1, int(math.ceil(math.log(max(n, 2), 2))))
+        if neighbours == None:
+            neighbours = seeds
+        if not is_int(seeds) or seeds < 1:
+            error("'seeds' must be a positive integer")
+        if not is_int(neighbours) or neighbours < 0:
+            error("'neighbours' must be a non-negative integer")
+
+        self.algts = algts
+        self.D = D
+        self.gap = gap
+
+        self.sim_graph = self._sim_graph(algts, D, gap, seeds, neighbours,
+            processes, mpi)
+        self.tree = self._sparse_guide_tree(n, self.sim_graph)
+
+    def _sim_graph(self, algts, D, gap, seeds, neighbours, processes=None,
+        mpi=False):
+
+        """
+        @summary: Calculates the similarities of the pairs of alignments
+            used for the guide tree
+
+            Seeds are chosen one at a time, each being the alignment
+            least like the seeds chosen before it. The similarities of
+            an alignment to the seeds make its profile, and each
+            alignment is also aligned to the alignments with the nearest
+            profiles.
+
+        @param algts: A list of alignments
+        @type algts: ListType
+        @param D: Retention time tolerance parameter for pairwise alignments
+        @type D: FloatType
+        @param gap: Gap parameter for pairwise alignments
+        @type gap: FloatType
+        @param seeds: The number of seed alignments
+        @type seeds: IntType
+        @param neighbours: The number of nearest alignments each
+            alignment is aligned to
+        @type neighbours: IntType
+        @param processes: The number of processes calculating pairwise
+            alignments. If None, they are calculated serially
+        @type processes: IntType
+        @param mpi: Whether to share pairwise alignments among MPI ranks,
+            if mpi4py is available
+        @type mpi: BooleanType
+
+        @return: Similarity scores, keyed by pairs of alignment indices
+        @rtype: DictType
+        """
+
+        n = len(algts)
+        stacks = [ Function.stack_alignment(algt) for algt in algts ]
+
+        # with enough seeds and neighbours, align all pairs
+        if seeds + neighbours >= n - 1:
+            pairs = [ (i, j) for i in range(n - 1) for j in range(i + 1, n) ]
+            print " Calculating pairwise alignments for %d alignments (D=%.2f, gap=%.2f)" % \
+                (n, D, gap)
+            scores = self._pair_scores(stacks, pairs, D, gap, processes, mpi)
+            return dict(zip(pairs, scores))
+
+        print " Calculating alignments to %d seeds for %d alignments (D=%.2f, gap=%.2f)" % \
+            (seeds, n, D, gap)
+
+        sim_graph = {}
+        profiles = numpy.zeros((n, seeds), dtype='d')
+        nearest = numpy.zeros(n, dtype='d') - numpy.inf
+        seed = 0
+
+        for k in range(seeds):
+            # the seed is aligned to itself to complete its profile
+            pairs = [ (seed, i) for i in range(n) ]
+            scores = self._pair_scores(stacks, pairs, D, gap, processes, mpi)
+            profiles[:,k] = scores
+            for i in range(n):
+                if i != seed:
+                    sim_graph[(min(seed, i), max(seed, i))] = scores[i]
+
+            # the next seed is least like all the seeds so far
+            nearest = numpy.maximum(nearest, profiles[:,k])
+            nearest[seed] = numpy.inf
+            seed = int(numpy.argmin(nearest))
+
+        print " Calculating alignments to %d neighbours for %d alignments" % \
+            (neighbours, n)
+
+        pairs = set()
+        for i in range(n):
+            dist = numpy.sum((profiles - profiles[i])**2, axis=1)
+            dist[i] = numpy.inf
+            for j in numpy.argsort(dist, kind='mergesort')[:neighbours]:
+                pair = (min(i, j), max(i, j))
+                if not sim_graph.has_key(pair):
+                    pairs.add(pair)
+
+        pairs = sorted(pairs)
+        scores = self._pair_scores(stacks, pairs, D, gap, processes, mpi)
+        sim_graph.update(zip(pairs, scores))
+
+        return sim_graph
+
+    def _sparse_guide_tree(self, n, sim_graph):
+
+        """
+        @summary: Builds a guide tree from the similarities of some pairs
+            of alignments
+
+        @param n: The number of alignments
+        @type n: IntType
+        @param sim_graph: Similarity scores, keyed by pairs of alignment
+            indices
+        @type sim_graph: DictType
+
+        @return: The nodes of the guide tree
+        @rtype: ListType
+        """
+
+        print " -> Clustering %d pairwise alignments." % (len(sim_graph)),
+        tree = Function.average_linkage(n, sim_graph)
+        print "Done"
+
+        return tree
+
+class GuideNode(object):
+
+    """
+    @summary: Models a node of a guide tree, joining two items or nodes
+
+        Items and nodes are numbered as in Pycluster trees.
+    """
+
+    def __init__(self, left, right, distance):
+
+        """
+        @param left: The first item or node joined
+        @type left: IntType
+        @param right: The second item or node joined
+        @type right: IntType
+        @param distance: The distance between the two
+        @type distance: FloatType
+        """
+
+        self.left = left
+        self.right = right
+        self.distance = distance
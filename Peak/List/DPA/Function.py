@@ -23,12 +23,16 @@ Functions for peak alignment by dynamic programming
  #############################################################################
 
 import copy
+import heapq
+import multiprocessing
+import Queue
+import traceback
 import numpy
 #from math import sqrt, log
 import math
 
 from pyms.Utils.Error import error, stop
-from pyms.Utils.Utils import is_list
+from pyms.Utils.Utils import is_list, is_int
 from pyms.Utils.DP import dp
 from pyms.Experiment.Class import Experiment
 
@@ -42,19 +46,45 @@ try:
 except:
     pass
 
-def align_with_tree(T, min_peaks=1):
+# peak pairs scored together by stacked_score_matrix()
+_SCORE_BATCH = 1 << 20
+
+# seconds between checks for an interrupt while waiting for a guide
+# tree node to be aligned
+_POLL_SECONDS = 1.0
+
+def align_with_tree(T, min_peaks=1, processes=None):
 
     """
     @summary: Aligns a list of alignments using the supplied guide tree
 
+        Nodes of the tree whose children are aligned can be aligned at
+        the same time by a pool of processes. Each process finds the
+        alignment path of a node, and the alignments are merged by the
+        calling process. The result is the same as when aligning the
+        nodes one at a time.
+
+        The alignments of a node's children are dropped once the node is
+        aligned. The input alignments are not copied, so the final
+        alignment holds the peaks of the input alignments.
+
     @param T: The pairwise alignment object
     @type: pyms.Peak.List.DPA.Class.PairwiseAlignment
+    @param min_peaks: Minimum number of peaks required for an alignment
+        position to be kept in the final alignment
+    @type min_peaks: IntType
+    @param processes: The number of processes. If None, the nodes are
+        aligned one at a time
+    @type processes: IntType
     @return: The final alignment consisting of aligned input alignments
     @rtype: pyms.Peak.List.DPA.Class.Alignment
     @author: Woon Wai Keen
     @author: Vladimir Likic
     """
 
+    if processes != None and (not is_int(processes) or processes < 1):
+        error("'processes' must be a positive integer")
+
     print " Aligning %d items with guide tree (D=%.2f, gap=%.2f)" % \
             (len(T.algts), T.D, T.gap)
 
@@ -66,20 +96,27 @@ def align_with_tree(T, min_peaks=1):
     #   is one less than the number of items.
 
     # extend As to length 2n to hold the n items, n-1 nodes, and 1 root
-    As = copy.deepcopy(T.algts) + [ None for _ in range(len(T.algts)) ]
-
-    # align the alignments into positions -1, ... ,-(n-1)
-    total = len(T.tree)
-    index = 0
-
-    for node in T.tree:
-        index = index - 1
-        As[index] = align(As[node.left], As[node.right], T.D, T.gap)
-        total = total - 1
-        print " -> %d item(s) remaining" % total
-
-    # the final alignment is in the root. Filter min peaks and return
-    final_algt =  As[index]
+    As = list(T.algts) + [ None for _ in range(len(T.algts)) ]
+
+    if len(T.tree) == 0:
+        # a single item, copied so that filtering leaves it unchanged
+        final_algt = copy.copy(As[0])
+    elif processes == None or processes == 1 or len(T.tree) == 1:
+        # align the alignments into positions -1, ... ,-(n-1)
+        total = len(T.tree)
+        index = 0
+
+        for node in T.tree:
+            index = index - 1
+            As[index] = align(As[node.left], As[node.right], T.D, T.gap)
+            As[node.left] = As[node.right] = None
+            total = total - 1
+            print " -> %d item(s) remaining" % total
+
+        # the final alignment is in the root
+        final_algt =  As[index]
+    else:
+        final_algt = __align_tree_nodes(T, As, processes)
 
     # useful for within state alignment only
     if min_peaks > 1:
@@ -87,6 +124,203 @@ def align_with_tree(T, min_peaks=1):
 
     return final_algt
 
+def __align_tree_nodes(T, As, processes):
+
+    """
+    @summary: Aligns the nodes of a guide tree with a pool of processes,
+        as soon as their children are aligned
+
+    @param T: The pairwise alignment object
+    @type: pyms.Peak.List.DPA.Class.PairwiseAlignment
+    @param As: The input alignments, followed by space for the nodes
+    @type As: ListType
+    @param processes: The number of processes
+    @type processes: IntType
+
+    @return: The alignment of the root node
+    @rtype: pyms.Peak.List.DPA.Class.Alignment
+    """
+
+    nodes = list(T.tree)
+    total = len(nodes)
+
+    # the number of children of each node still to be aligned
+    waiting = []
+    for node in nodes:
+        waiting.append(len([ c for c in (node.left, node.right) if c < 0 ]))
+
+    parent = {}
+    for k in range(len(nodes)):
+        parent[nodes[k].left] = parent[nodes[k].right] = k
+
+    finished = Queue.Queue()
+    stacks = {}
+
+    pool = multiprocessing.Pool(processes)
+
+    def submit(k):
+        for child in (nodes[k].left, nodes[k].right):
+            if not stacks.has_key(child):
+                stacks[child] = stack_alignment(As[child])
+        pool.apply_async(__node_trace, (k, stacks[nodes[k].left],
+            stacks[nodes[k].right], T.D, T.gap), callback=finished.put)
+
+    # the pool is terminated, not waited for, if the alignment fails or
+    # is interrupted
+    failed = True
+    try:
+        for k in range(len(nodes)):
+            if waiting[k] == 0:
+                submit(k)
+
+        while total > 0:
+            # a get() without a timeout cannot be interrupted
+            try:
+                k, result = finished.get(True, _POLL_SECONDS)
+            except Queue.Empty:
+                continue
+            if result == None:
+                error("alignment of guide tree node %d failed" % (-k-1))
+            trace, similarity = result
+
+            left = nodes[k].left
+            right = nodes[k].right
+            ma = merge_alignments(As[left], As[right], trace)
+            ma.similarity = similarity
+            As[-k-1] = ma
+
+            # the children are no longer needed
+            As[left] = As[right] = None
+            stacks.pop(left)
+            stacks.pop(right)
+
+            total = total - 1
+            print " -> %d item(s) remaining" % total
+
+            if parent.has_key(-k-1):
+                up = parent[-k-1]
+                waiting[up] = waiting[up] - 1
+                if waiting[up] == 0:
+                    submit(up)
+        failed = False
+    finally:
+        if failed:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+    return As[-len(nodes)]
+
+def __node_trace(k, s1, s2, D, gap):
+
+    """
+    @summary: Finds the alignment path of a guide tree node in a
+        process of align_with_tree()
+
+    @return: The node, and its alignment path and similarity score, or
+        None if these could not be found
+    @rtype: TupleType
+    """
+
+    # the result must get back for the node to count as aligned
+    try:
+        return k, __stacked_trace(s1, s2, D, gap)
+    except (Exception, SystemExit):
+        traceback.print_exc()
+        return k, None
+
+def average_linkage(n, similarities):
+
+    """
+    @summary: Builds a guide tree by average linkage clustering of
+        alignments with known pairwise similarities
+
+        Not every pair of alignments needs a known similarity. The
+        clusters joined first are those with the highest average
+        similarity over the known pairs between them, which for all
+        pairs is the usual average linkage (UPGMA). Clusters without
+        any known pairs between them are joined last.
+
+        The tree is numbered as by Pycluster: items are 0, ..., n-1, and
+        the i-th node of the tree is -(i+1).
+
+    @param n: The number of alignments
+    @type n: IntType
+    @param similarities: Similarity scores, keyed by pairs of alignment
+        indices
+    @type similarities: DictType
+
+    @return: The nodes of the guide tree, in the order they are joined
+    @rtype: ListType
+    """
+
+    if not is_int(n) or n < 1:
+        error("'n' must be a positive integer")
+
+    # the total similarity and number of known pairs between clusters
+    links = dict([ (ii, {}) for ii in range(n) ])
+    heap = []
+
+    for (i, j), sim in similarities.items():
+        if i == j or not (0 <= i < n and 0 <= j < n):
+            error("similarity given for an invalid pair (%d, %d)" % (i, j))
+        if links[i].has_key(j):
+            continue
+        links[i][j] = links[j][i] = (float(sim), 1)
+        heap.append((-float(sim), min(i, j), max(i, j)))
+
+    heapq.heapify(heap)
+
+    # node distances are measured from the highest similarity
+    if len(heap) > 0:
+        sim_max = -min(heap)[0]
+    else:
+        sim_max = 0.0
+
+    tree = []
+
+    while len(tree) < n - 1:
+        if len(heap) > 0:
+            neg_avg, a, b = heapq.heappop(heap)
+            # one of the clusters has since been joined
+            if not (links.has_key(a) and links.has_key(b)):
+                continue
+            distance = sim_max + neg_avg
+        else:
+            # no known pairs left, join the two largest cluster numbers
+            a, b = sorted(links.keys())[-2:]
+            distance = None
+
+        node = Class.GuideNode(a, b, distance)
+        tree.append(node)
+        new = -len(tree)
+
+        links_a = links.pop(a)
+        links_b = links.pop(b)
+        links_a.pop(b, None)
+        links_b.pop(a, None)
+
+        new_links = {}
+        for c in set(links_a.keys()) | set(links_b.keys()):
+            sum_a, count_a = links_a.get(c, (0.0, 0))
+            sum_b, count_b = links_b.get(c, (0.0, 0))
+            link = (sum_a + sum_b, count_a + count_b)
+            links[c].pop(a, None)
+            links[c].pop(b, None)
+            links[c][new] = new_links[c] = link
+            heapq.heappush(heap, (-link[0]/link[1], min(c, new), max(c, new)))
+
+        links[new] = new_links
+
+    # unknown distances are taken as the largest distance in the tree
+    known = [ node.distance for node in tree if node.distance != None ]
+    for node in tree:
+        if node.distance == None:
+            node.distance = max(known + [0.0])
+
+    return tree
+
 def exprl2alignment(exprl):
 
     """
@@ -138,7 +372,7 @@ def align(a1, a2, D, gap):
     M = score_matrix(a1, a2, D)
 
     # run dynamic programming
-    result = dp(M, gap)
+    result = __score_dp(M, gap)
 
     # make composite alignment from the results
     ma = merge_alignments(a1, a2, result['trace'])
@@ -148,6 +382,142 @@ def align(a1, a2, D, gap):
 
     return ma
 
+def stacked_similarity(s1, s2, D, gap):
+
+    """
+    @summary: Calculates the similarity score of two stacked alignments
+
+        The score is the same as the similarity of the alignment made
+        by align(), without merging the alignments.
+
+    @param s1: The first alignment, stacked by stack_alignment()
+    @type s1: DictType
+    @param s2: The second alignment, stacked by stack_alignment()
+    @type s2: DictType
+    @param D: Retention time tolerance
+    @type D: FloatType
+    @param gap: Gap penalty
+    @type gap: FloatType
+
+    @return: Similarity score (i.e. more similar => higher score)
+    @rtype: FloatType
+    """
+
+    return __stacked_trace(s1, s2, D, gap)[1]
+
+def pair_similarities(stacks, pairs, D, gap, processes=None):
+
+    """
+    @summary: Calculates the similarity scores of pairs of stacked
+        alignments
+
+        Pairs can be scored in parallel by a pool of processes, which
+        share the stacked alignments. The scores are returned in the
+        order of the pairs whatever the number of processes.
+
+    @param stacks: Alignments stacked by stack_alignment()
+    @type stacks: ListType
+    @param pairs: Pairs of indices into 'stacks'
+    @type pairs: ListType
+    @param D: Retention time tolerance
+    @type D: FloatType
+    @param gap: Gap penalty
+    @type gap: FloatType
+    @param processes: The number of processes. If None, the pairs are
+        scored serially
+    @type processes: IntType
+
+    @return: The similarity score of each pair
+    @rtype: ListType
+    """
+
+    if processes != None and (not is_int(processes) or processes < 1):
+        error("'processes' must be a positive integer")
+
+    total_n = len(pairs)
+    scores = []
+
+    if processes == None or processes == 1 or len(pairs) < 2:
+        for i, j in pairs:
+            scores.append(stacked_similarity(stacks[i], stacks[j], D, gap))
+            total_n = total_n - 1
+            print " -> %d pairs remaining" % total_n
+    else:
+        # a few chunks of pairs per process, to even out the work
+        num_chunks = min(len(pairs), 4*processes)
+        bounds = numpy.linspace(0, len(pairs), num_chunks+1).astype(int)
+        chunks = [ pairs[bounds[ii]:bounds[ii+1]] for ii in range(num_chunks) ]
+
+        pool = multiprocessing.Pool(processes, __init_pair_worker,
+            (stacks, D, gap))
+        try:
+            for chunk_scores in pool.imap(__score_pairs, chunks):
+                scores.extend(chunk_scores)
+                total_n = total_n - len(chunk_scores)
+                print " -> %d pairs remaining" % total_n
+        finally:
+            pool.close()
+            pool.join()
+
+    return scores
+
+# the stacked alignments and parameters of a pair worker process
+__pair_worker = {}
+
+def __init_pair_worker(stacks, D, gap):
+
+    """
+    @summary: Sets up a process of pair_similarities()
+    """
+
+    __pair_worker['stacks'] = stacks
+    __pair_worker['D'] = D
+    __pair_worker['gap'] = gap
+
+def __score_pairs(pairs):
+
+    """
+    @summary: Scores a chunk of pairs in a process of pair_similarities()
+    """
+
+    stacks = __pair_worker['stacks']
+    D = __pair_worker['D']
+    gap = __pair_worker['gap']
+
+    return [ stacked_similarity(stacks[i], stacks[j], D, gap)
+        for i, j in pairs ]
+
+def __stacked_trace(s1, s2, D, gap):
+
+    """
+    @summary: Finds the alignment path and similarity score of two
+        stacked alignments
+
+    @return: The DP traceback and the similarity score
+    @rtype: TupleType
+    """
+
+    M = stacked_score_matrix(s1, s2, D)
+    result = __score_dp(M, gap)
+
+    return result['trace'], alignment_similarity(result['trace'], M, gap)
+
+def __score_dp(M, gap):
+
+    """
+    @summary: Runs dynamic programming on the score matrix of two
+        alignments
+
+        Matching positions with the worst score costs more than two
+        gaps when gap < 0.5, so only the positions within retention
+        time range then need to be considered for matches.
+    """
+
+    if gap < 0.5:
+        return dp(M, gap, score_band(M))
+    else:
+        return dp(M, gap)
+
 def merge_alignments(A1, A2, traces):
 
     """
@@ -255,6 +625,86 @@ def alignment_similarity(traces, score_matrix, gap):
 
     return similarity
 
+def stack_alignment(a):
+
+    """
+    @summary: Stacks the peaks of an alignment into arrays for scoring
+
+        Peaks are taken position by position, skipping gaps, so the
+        peaks of each position occupy consecutive rows.
+
+    @param a: The alignment
+    @type a: pyms.Peak.List.Class.Alignment
+
+    @return: A dictionary with the peak mass spectra ('spec'), the
+        sums of their squared intensities ('sumsq'), the peak retention
+        times ('rt'), and the first row ('starts') and the number of
+        peaks ('counts') of each alignment position
+    @rtype: DictType
+    """
+
+    spectra = []
+    rts = []
+    counts = numpy.zeros(len(a.peakalgt), dtype=int)
+
+    for ii in range(len(a.peakalgt)):
+        for peak in a.peakalgt[ii]:
+            if peak is not None:
+                spectra.append(peak.mass_spec)
+                rts.append(peak.rt)
+                counts[ii] = counts[ii] + 1
+
+    if len(spectra) == 0:
+        spec = numpy.zeros((0, 0), dtype='d')
+    else:
+        try:
+            spec = numpy.array(spectra, dtype='d')
+        except(ValueError):
+            spec = None
+        if spec is None or spec.ndim != 2:
+            error("Mass Spectra are of different length\n\n" +
+                  " Use IntensityMatrix.crop_mass() to set\n" +
+                  " same length for all Mass Spectra")
+
+    stack = {}
+    stack['spec'] = spec
+    stack['sumsq'] = numpy.sum(spec**2, axis=1)
+    stack['rt'] = numpy.array(rts, dtype='d')
+    stack['starts'] = numpy.cumsum(counts) - counts
+    stack['counts'] = counts
+
+    return stack
+
+def score_band(M):
+
+    """
+    @summary: Finds the positions of the second alignment each position
+        of the first alignment can match
+
+        These are the positions scoring better than 1.0, the worst
+        score, which is given to positions out of retention time range.
+
+    @param M: The score matrix of the two alignments
+    @type M: numpy.ndarray
+
+    @return: The first and last column of each row of the score matrix
+        scoring better than 1.0 (the number of columns and -1 for rows
+        without such a column)
+    @rtype: TupleType
+    """
+
+    inside = M < 1.0
+    cols = M.shape[1]
+
+    first = numpy.argmax(inside, axis=1)
+    last = cols - 1 - numpy.argmax(inside[:, ::-1], axis=1)
+
+    none = numpy.logical_not(numpy.any(inside, axis=1))
+    first[none] = cols
+    last[none] = -1
+
+    return first, last
+
 def score_matrix(a1, a2, D):
 
     """
@@ -267,27 +717,86 @@ def score_matrix(a1, a2, D):
     @param D: Retention time tolerance
     @type D: FloatType
 
-    @return: Aligned alignments
-    @rtype: pyms.Peak.List.Class.Alignment
+    @return: The score matrix, with the position similarity of each
+        pair of alignment positions
+    @rtype: numpy.ndarray
 
     @author: Qiao Wang
     @author: Andrew Isaac
     """
 
-    score_matrix = numpy.zeros((len(a1.peakalgt), len(a2.peakalgt)))
-    row = 0
-    col = 0
-    sim_score = 0
+    return stacked_score_matrix(stack_alignment(a1), stack_alignment(a2), D)
+
+def stacked_score_matrix(s1, s2, D):
+
+    """
+    @summary: Calculates the score matrix between two stacked alignments
+
+        Gives the same scores as position_similarity() for each pair
+        of positions, computing the scores of all peak pairs at once
+        for a block of positions of the first alignment.
+
+    @param s1: The first alignment, stacked by stack_alignment()
+    @type s1: DictType
+    @param s2: The second alignment, stacked by stack_alignment()
+    @type s2: DictType
+    @param D: Retention time tolerance
+    @type D: FloatType
+
+    @return: The score matrix
+    @rtype: numpy.ndarray
+    """
+
+    # positions without peaks score 1.0, the worst score
+    M = numpy.ones((len(s1['counts']), len(s2['counts'])))
+
+    if len(s1['rt']) == 0 or len(s2['rt']) == 0:
+        return M
+
+    if s1['spec'].shape[1] != s2['spec'].shape[1]:
+        error("Mass Spectra are of different length\n\n" +
+              " Use IntensityMatrix.crop_mass() to set\n" +
+              " same length for all Mass Spectra")
+
+    _TOL = 0.001
+    cutoff = D*math.sqrt(-2.0*math.log(_TOL))
+
+    cols = numpy.nonzero(s2['counts'])[0]
+    col_starts = s2['starts'][cols]
+    rows = numpy.nonzero(s1['counts'])[0]
+    row_ends = s1['starts'][rows] + s1['counts'][rows]
+
+    # peak rows of the first alignment scored together
+    block = max(1, _SCORE_BATCH/len(s2['rt']))
+
+    lo = 0
+    while lo < len(rows):
+        r0 = s1['starts'][rows[lo]]
+        hi = numpy.searchsorted(row_ends, r0 + block, side='right')
+        hi = max(hi, lo + 1)
+        r1 = row_ends[hi-1]
+        pos = rows[lo:hi]
+
+        top = numpy.dot(s1['spec'][r0:r1], s2['spec'].T)
+        bot = numpy.sqrt(numpy.outer(s1['sumsq'][r0:r1], s2['sumsq']))
+        cos = numpy.where(bot > 0, top/numpy.where(bot > 0, bot, 1.0), 0.0)
+
+        diff = s1['rt'][r0:r1, numpy.newaxis] - s2['rt'][numpy.newaxis, :]
+        rtime = numpy.exp(-(diff/float(D))**2 / 2.0)
+        score = 1.0 - cos*rtime
+        score[numpy.abs(diff) > cutoff] = 1.0
+
+        # sum peak pair scores over the peaks of each position pair
+        score = numpy.add.reduceat(score, s1['starts'][pos] - r0, axis=0)
+        score = numpy.add.reduceat(score, col_starts, axis=1)
+        count = numpy.outer(s1['counts'][pos], s2['counts'][cols])
+
+        M[pos[:, numpy.newaxis], cols[numpy.newaxis, :]] = \
+            score/count.astype('d')
 
-    for algt1pos in a1.peakalgt:
-        for algt2pos in a2.peakalgt:
-            sim_score = position_similarity(algt1pos, algt2pos, D)
-            score_matrix[row][col] = sim_score
-            col = col+1
-        row = row+1
-        col = 0
+        lo = hi
 
-    return score_matrix
+    return M
 
 def position_similarity(pos1, pos2, D):
 
@@ -117,7 +117,8 @@ def fill_peaks(data, peak_list, D, minutes=False):
     # reweight so RT weight at nearest peak is _PEN
     _PEN = 0.5
 
-    datamat = data.get_matrix_list()
+    # direct access, don't modify
+    datamat = data.intensity_array
     mass_list = data.get_mass_list()
     datatimes = data.get_time_list()
     minrt = min(datatimes)
@@ -158,7 +159,6 @@ def fill_peaks(data, peak_list, D, minutes=False):
 
         # Get sub matrix of scans in bounds
         submat = datamat[lowii:upii+1]
-        submat = numpy.array(submat, dtype='d')
         subrts = datatimes[lowii:upii+1]
         subrts = numpy.array(subrts, dtype='d')
 
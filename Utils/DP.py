@@ -25,16 +25,26 @@ Dynamic Programming routine
 import numpy
 #from mpi4py import MPI
 
-def dp(S, gap_penalty):
+from pyms.Utils.Error import error
+
+def dp(S, gap_penalty, band=None):
     
     """ 
     @summary: Solves optimal path in score matrix based on global sequence
     alignment
 
+        If 'band' is given, matches are only considered in the given
+        columns of each row of the score matrix. The rows of the returned
+        'D' and 'phi' matrices then hold only the band, row i starting
+        at column result['band'][0][i].
+
     @param S: Score matrix
     @type S: numpy.
     @param gap_penalty: Gap penalty
     @type gap_penalty: FloatType
+    @param band: The first and last column of each row of 'S' where a
+        match may be made
+    @type band: TupleType
 
     @return: A dictionary of results
     @rtype: DictType
@@ -48,47 +58,75 @@ def dp(S, gap_penalty):
     row_length = len(S[:,0])
     col_length = len(S[0,:])
 
-    #D contains the score of the optimal alignment
-    D = numpy.zeros((row_length+1,col_length+1), dtype='d')
-    for i in range(1, row_length+1):
-        D[i,0] = gap_penalty*i
-    for j in range(1, col_length+1):
-        D[0,j] = gap_penalty*j
-    D[0,0] = 0.0
-    D[1:(row_length+1), 1:(col_length+1)] = S.copy();
+    lo, hi = __dp_band(row_length, col_length, band)
+    width = numpy.max(hi - lo) + 1
+
+    #D contains the score of the optimal alignment, row i holding
+    #columns lo[i], ..., hi[i]
+    D = numpy.empty((row_length+1, width), dtype='d')
+    D[:] = numpy.inf
 
     # Directions for trace
     # 0 - match               (move diagonal)
     # 1 - peaks1 has no match (move up)
     # 2 - peaks2 has no match (move left)
     # 3 - stop
-    trace_matrix = numpy.zeros((row_length+1,col_length+1))
-    trace_matrix[:,0] = 1; 
-    trace_matrix[0,:] = 2;
-    trace_matrix[0,0] = 3;
-   
-    for i in range(1,row_length+1):
-        for j in range(1,col_length+1):
- 
-            #
-            # Needleman-Wunsch Algorithm assuming a score function S(x,x)=0
-            #
-            #              | D[i-1,j-1] + S(i,j)
-            # D[i,j] = min | D(i-1,j] + gap
-            #              | D[i,j-1] + gap
-            #
-
-            darray = [D[i-1,j-1]+S[i-1,j-1], D[i-1,j]+gap_penalty, D[i,j-1]+gap_penalty]
-            D[i,j] = min(darray)
-            #Store direction in trace matrix
-            trace_matrix[i,j] = darray.index(D[i,j])
+    trace_matrix = numpy.empty((row_length+1, width), dtype=numpy.int8)
+    trace_matrix[:] = 3
+
+    first_col = numpy.nonzero(lo == 0)[0]
+    D[first_col,0] = gap_penalty*first_col
+    trace_matrix[first_col,0] = 1
+    D[0,:hi[0]+1] = gap_penalty*numpy.arange(hi[0]+1)
+    trace_matrix[0,:hi[0]+1] = 2
+    D[0,0] = 0.0
+    trace_matrix[0,0] = 3
+
+    #
+    # Needleman-Wunsch Algorithm assuming a score function S(x,x)=0
+    #
+    #              | D[i-1,j-1] + S(i,j)
+    # D[i,j] = min | D(i-1,j] + gap
+    #              | D[i,j-1] + gap
+    #
+    # Cells on an anti-diagonal (i+j constant) depend only on the two
+    # previous anti-diagonals, so each anti-diagonal is filled at once.
+    # Ties are resolved in the order match, up, left.
+
+    rows = numpy.arange(row_length+1)
+    diag_lo = rows + lo
+    diag_hi = rows + hi
+
+    for k in range(2, row_length+col_length+1):
+
+        # rows whose band meets this anti-diagonal, away from the edges
+        i_first = max(1, k-col_length, numpy.searchsorted(diag_hi, k))
+        i_last = min(row_length, k-1,
+            numpy.searchsorted(diag_lo, k, side='right')-1)
+        if i_first > i_last:
+            continue
+
+        i = numpy.arange(i_first, i_last+1)
+        j = k - i
+
+        match = __band_values(D, lo, hi, width, i-1, j-1) + S[i-1,j-1]
+        up = __band_values(D, lo, hi, width, i-1, j) + gap_penalty
+        left = __band_values(D, lo, hi, width, i, j-1) + gap_penalty
+
+        best = numpy.minimum(numpy.minimum(match, up), left)
+        direction = numpy.where(numpy.logical_and(match <= up, match <= left),
+            0, numpy.where(up <= left, 1, 2))
+
+        D[i,j-lo[i]] = best
+        #Store direction in trace matrix
+        trace_matrix[i,j-lo[i]] = direction
 
     # Trace back from bottom right
     trace = []
     matches = []
     i = row_length
     j = col_length
-    direction = trace_matrix[i,j]
+    direction = trace_matrix[i,j-lo[i]]
     p = [row_length-1]
     q = [col_length-1]
     
@@ -104,8 +142,8 @@ def dp(S, gap_penalty):
             j = j-1
         p.append(i-1)
         q.append(j-1)
-        trace.append(direction)
-        direction=trace_matrix[i,j]
+        trace.append(int(direction))
+        direction=trace_matrix[i,j-lo[i]]
 
     #remove 'stop' entry
     p.pop()
@@ -116,5 +154,80 @@ def dp(S, gap_penalty):
     trace.reverse()
     matches.reverse()
 
-    return {'p':p, 'q':q, 'trace':trace, 'matches':matches, 'D':D, 'phi':trace_matrix}
+    return {'p':p, 'q':q, 'trace':trace, 'matches':matches, 'D':D,
+        'phi':trace_matrix, 'band':(lo, hi)}
+
+def __dp_band(row_length, col_length, band):
+
+    """
+    @summary: Finds the columns of each row of the DP matrix to compute
+
+        The band is widened so that any path of matches inside it can
+        be joined by gaps without leaving it, and so that it reaches
+        both corners of the DP matrix.
+
+    @param row_length: The number of rows of the score matrix
+    @type row_length: IntType
+    @param col_length: The number of columns of the score matrix
+    @type col_length: IntType
+    @param band: The first and last column of each row of the score
+        matrix where a match may be made, or None for all columns
+    @type band: TupleType
+
+    @return: The first and the last column of each DP matrix row
+    @rtype: TupleType
+    """
+
+    lo = numpy.zeros(row_length+1, dtype=int)
+    hi = numpy.zeros(row_length+1, dtype=int) + col_length
+
+    if band is None:
+        return lo, hi
+
+    if len(band) != 2 or len(band[0]) != row_length or \
+        len(band[1]) != row_length:
+        error("'band' must give the first and last column of each row")
+
+    # DP rows and columns are one ahead of those of the score matrix
+    lo[1:] = numpy.clip(numpy.asarray(band[0]) + 1, 0, col_length)
+    hi[1:] = numpy.clip(numpy.asarray(band[1]) + 1, 0, col_length)
+    hi[0] = 0
+    hi[-1] = col_length
+
+    # a match is reached from the previous row and column
+    lo[:-1] = numpy.maximum(numpy.minimum(lo[:-1], lo[1:]-1), 0)
+    hi[:-1] = numpy.maximum(hi[:-1], hi[1:]-1)
+
+    # both bounds never decrease, and each row overlaps the next one
+    lo = numpy.minimum.accumulate(lo[::-1])[::-1]
+    hi = numpy.maximum.accumulate(numpy.maximum(hi, lo))
+    hi[:-1] = numpy.maximum(hi[:-1], lo[1:])
+
+    return lo, hi
+
+def __band_values(D, lo, hi, width, i, j):
+
+    """
+    @summary: Reads DP matrix cells stored by band, infinite outside it
+
+    @param D: The DP matrix, stored by band
+    @type D: numpy.ndarray
+    @param lo: The first column of each DP matrix row
+    @type lo: numpy.ndarray
+    @param hi: The last column of each DP matrix row
+    @type hi: numpy.ndarray
+    @param width: The number of columns stored per row
+    @type width: IntType
+    @param i: The rows of the cells
+    @type i: numpy.ndarray
+    @param j: The columns of the cells
+    @type j: numpy.ndarray
+
+    @return: The values of the cells
+    @rtype: numpy.ndarray
+    """
+
+    inside = numpy.logical_and(j >= lo[i], j <= hi[i])
+    values = D[i, numpy.clip(j-lo[i], 0, width-1)]
 
+    return numpy.where(inside, values, numpy.inf)
@@ -22,11 +22,18 @@ General I/O functions
  #                                                                           #
  #############################################################################
 
-import types, os, string, cPickle
+import types, os, string, cPickle, json, struct, zlib
+
+import numpy
 
 from pyms.Utils.Error import error
 from pyms.Utils.Utils import is_number, is_str, is_list
 
+# array container file format: magic string, header length, a JSON
+# header, then the arrays, each starting on an aligned offset
+_CONTAINER_MAGIC = "PYMSARR1"
+_CONTAINER_ALIGN = 64
+
 def dump_object(object, file_name):
 
     """
@@ -262,3 +269,245 @@ def save_data(file_name, data, format_str="%.6f", prepend="", sep=" ",
         if status != 0:
             error("gzip compress failed")
 
+def write_container(file_name, arrays, attrs=None, compress=False,
+        chunk_rows=1024):
+
+    """
+    @summary: Writes numpy arrays to an array container file
+
+        The file holds a short JSON header followed by the raw little
+        endian data of each array, aligned so that uncompressed arrays
+        can be memory mapped. If 'compress' is True, arrays are split
+        into chunks of 'chunk_rows' rows which are compressed
+        separately, so that a range of rows can be read without
+        decompressing the whole array.
+
+    @param file_name: Name of the container file
+    @type file_name: StringType
+    @param arrays: Arrays to store, as a list of (name, array) pairs
+    @type arrays: ListType
+    @param attrs: Attributes to store in the header. Must be
+        representable in JSON
+    @type attrs: DictType
+    @param compress: Whether to compress the arrays
+    @type compress: BooleanType
+    @param chunk_rows: Number of rows in a compressed chunk
+    @type chunk_rows: IntType
+
+    @return: none
+    @rtype: NoneType
+    """
+
+    if not is_str(file_name):
+        error("'file_name' is not a string")
+    if not is_list(arrays):
+        error("'arrays' is not a list of (name, array) pairs")
+    if chunk_rows < 1:
+        error("'chunk_rows' must be at least one")
+
+    if attrs == None:
+        attrs = {}
+
+    # the data section, with offsets relative to its start
+    blocks = []
+    entries = []
+    offset = 0
+    for name, array in arrays:
+        array = numpy.asarray(array)
+        dtype = array.dtype.newbyteorder('<')
+        array = numpy.require(array, dtype=dtype, requirements='C')
+        entry = {'name':name, 'dtype':dtype.str, 'shape':list(array.shape)}
+
+        offset = offset + (-offset % _CONTAINER_ALIGN)
+        entry['offset'] = offset
+
+        if compress:
+            if array.ndim > 0:
+                n_rows = array.shape[0]
+            else:
+                n_rows = 1
+            flat = array.reshape((n_rows, int(numpy.prod(array.shape[1:]))))
+            chunk_sizes = []
+            for begin in xrange(0, n_rows, chunk_rows):
+                chunk = zlib.compress(flat[begin:begin+chunk_rows].tostring())
+                blocks.append((offset, chunk))
+                chunk_sizes.append(len(chunk))
+                offset = offset + len(chunk)
+            entry['chunk_rows'] = chunk_rows
+            entry['chunk_sizes'] = chunk_sizes
+        else:
+            data = array.tostring()
+            blocks.append((offset, data))
+            offset = offset + len(data)
+
+        entries.append(entry)
+
+    header = json.dumps({'attrs':attrs, 'arrays':entries})
+    start = len(_CONTAINER_MAGIC) + 8 + len(header)
+    start = start + (-start % _CONTAINER_ALIGN)
+
+    try:
+        fp = open(file_name, "wb")
+    except IOError:
+        error("Cannot open '%s' for writing" % (file_name))
+
+    fp.write(_CONTAINER_MAGIC)
+    fp.write(struct.pack('<Q', len(header)))
+    fp.write(header)
+    for offset, data in blocks:
+        fp.seek(start + offset)
+        fp.write(data)
+    fp.close()
+
+def read_container_header(file_name):
+
+    """
+    @summary: Reads the header of an array container file
+
+    @param file_name: Name of the container file
+    @type file_name: StringType
+
+    @return: The attributes, and a dictionary describing each array
+        by name. Array offsets are absolute file offsets
+    @rtype: TupleType
+    """
+
+    if not is_str(file_name):
+        error("'file_name' is not a string")
+    try:
+        fp = open(file_name, "rb")
+    except IOError:
+        error("'%s' does not exist" % (file_name))
+
+    magic = fp.read(len(_CONTAINER_MAGIC))
+    if magic != _CONTAINER_MAGIC:
+        fp.close()
+        error("'%s' is not an array container file" % (file_name))
+
+    header_length = struct.unpack('<Q', fp.read(8))[0]
+    header = json.loads(fp.read(header_length))
+    fp.close()
+
+    start = len(_CONTAINER_MAGIC) + 8 + header_length
+    start = start + (-start % _CONTAINER_ALIGN)
+
+    entries = {}
+    for entry in header['arrays']:
+        entry['name'] = str(entry['name'])
+        entry['dtype'] = str(entry['dtype'])
+        entry['shape'] = tuple(entry['shape'])
+        entry['offset'] = start + entry['offset']
+        entries[entry['name']] = entry
+
+    return header['attrs'], entries
+
+def read_container(file_name, names=None, mmap=False):
+
+    """
+    @summary: Reads arrays from an array container file
+
+    @param file_name: Name of the container file
+    @type file_name: StringType
+    @param names: Names of the arrays to read, or None for all
+    @type names: ListType
+    @param mmap: If True, uncompressed arrays are memory mapped
+        instead of read. The maps are copy-on-write, changes to them
+        are not written to the file
+    @type mmap: BooleanType
+
+    @return: The attributes, and a dictionary of arrays by name
+    @rtype: TupleType
+    """
+
+    attrs, entries = read_container_header(file_name)
+
+    if names == None:
+        names = entries.keys()
+
+    arrays = {}
+    for name in names:
+        if not entries.has_key(name):
+            error("no array '%s' in '%s'" % (name, file_name))
+        entry = entries[name]
+        if mmap and not entry.has_key('chunk_sizes') and \
+           numpy.prod(entry['shape']) > 0:
+            arrays[name] = numpy.memmap(file_name, dtype=entry['dtype'],
+                mode='c', offset=entry['offset'], shape=entry['shape'])
+        else:
+            arrays[name] = read_container_rows(file_name, name,
+                entries=entries)
+
+    return attrs, arrays
+
+def read_container_rows(file_name, name, begin=None, end=None, entries=None):
+
+    """
+    @summary: Reads a range of rows of an array in an array container
+        file
+
+        Only the bytes, or compressed chunks, holding the rows are
+        read.
+
+    @param file_name: Name of the container file
+    @type file_name: StringType
+    @param name: Name of the array
+    @type name: StringType
+    @param begin: First row to read (default first row)
+    @type begin: IntType
+    @param end: Row after the last row to read (default all rows)
+    @type end: IntType
+    @param entries: Array descriptions from read_container_header(),
+        to avoid reading the header again
+    @type entries: DictType
+
+    @return: The rows
+    @rtype: numpy.ndarray
+    """
+
+    if entries == None:
+        attrs, entries = read_container_header(file_name)
+    if not entries.has_key(name):
+        error("no array '%s' in '%s'" % (name, file_name))
+
+    entry = entries[name]
+    dtype = numpy.dtype(entry['dtype'])
+    shape = entry['shape']
+
+    if len(shape) == 0:
+        n_rows = 1
+        row_shape = ()
+    else:
+        n_rows = shape[0]
+        row_shape = shape[1:]
+    row_size = int(numpy.prod(row_shape))
+
+    begin, end, step = slice(begin, end).indices(n_rows)
+    end = max(begin, end)
+
+    fp = open(file_name, "rb")
+
+    if entry.has_key('chunk_sizes'):
+        # read and decompress only the chunks holding the rows
+        chunk_rows = entry['chunk_rows']
+        chunk_offsets = numpy.cumsum([0] + entry['chunk_sizes'])
+        first_chunk = begin/chunk_rows
+        last_chunk = (end-1)/chunk_rows
+        data = []
+        for ii in xrange(first_chunk, last_chunk+1):
+            fp.seek(entry['offset'] + chunk_offsets[ii])
+            data.append(zlib.decompress(fp.read(entry['chunk_sizes'][ii])))
+        data = "".join(data)
+        skip = (begin - first_chunk*chunk_rows)*row_size*dtype.itemsize
+        count = (end - begin)*row_size
+        array = numpy.frombuffer(data, dtype=dtype, count=count,
+            offset=skip).copy()
+    else:
+        fp.seek(entry['offset'] + begin*row_size*dtype.itemsize)
+        array = numpy.fromfile(fp, dtype=dtype, count=(end-begin)*row_size)
+
+    fp.close()
+
+    if len(shape) == 0:
+        return array.reshape(())
+
+    return array.reshape((end-begin,) + row_shape)
@@ -24,8 +24,10 @@ Time conversion and related functions
 
 import math
 
+import numpy
+
 from pyms.Utils.Error import error
-from pyms.Utils.Utils import is_int, is_str, is_str_num
+from pyms.Utils.Utils import is_int, is_str, is_str_num, is_number
 
 def time_str_secs(time_str):
 
@@ -115,3 +117,72 @@ def window_sele_points(ic, window_sele, half_window=False):
 
     return points
 
+def nearest_time_index(time_array, time):
+
+    """
+    @summary: Returns the index of the time nearest to the given time,
+        by binary search of sorted times
+
+        If the time is halfway between two times, the lower index is
+        returned.
+
+    @param time_array: Retention times in increasing order
+    @type time_array: numpy.ndarray
+    @param time: Time in seconds
+    @type time: FloatType
+
+    @return: Nearest index corresponding to given time
+    @rtype: IntType
+    """
+
+    if not is_number(time):
+        error("'time' must be a number")
+
+    if time < time_array[0] or time > time_array[-1]:
+        error("time %.2f is out of bounds (min: %.2f, max: %.2f)" %
+              (time, time_array[0], time_array[-1]))
+
+    # first index with a time not less than the given time
+    ix = int(numpy.searchsorted(time_array, time))
+
+    if ix > 0 and (ix == len(time_array) or \
+       time - time_array[ix-1] <= time_array[ix] - time):
+        ix = ix - 1
+
+    return ix
+
+def nearest_time_indices(time_array, times):
+
+    """
+    @summary: Returns the indices of the times nearest to each of the
+        given times, by binary search of sorted times
+
+        If a time is halfway between two times, the lower index is
+        returned.
+
+    @param time_array: Retention times in increasing order
+    @type time_array: numpy.ndarray
+    @param times: Times in seconds
+    @type times: ListType or numpy.ndarray
+
+    @return: Nearest index corresponding to each time
+    @rtype: numpy.ndarray
+    """
+
+    times = numpy.asarray(times, dtype='d')
+
+    if len(times) > 0 and \
+       (times.min() < time_array[0] or times.max() > time_array[-1]):
+        error("times out of bounds (min: %.2f, max: %.2f)" %
+              (time_array[0], time_array[-1]))
+
+    ix = numpy.searchsorted(time_array, times)
+
+    # step back to the lower neighbour when it is at least as near
+    upper = numpy.minimum(ix, len(time_array)-1)
+    lower = numpy.maximum(ix-1, 0)
+    lower_nearer = numpy.logical_or(ix == len(time_array),
+        times - time_array[lower] <= time_array[upper] - times)
+    ix = numpy.where(numpy.logical_and(ix > 0, lower_nearer), lower, ix)
+
+    return ix